@@ -3,10 +3,23 @@
 HEARTBEAT_FILE=$1
 INTERVAL=$2
 
+# With the built-in endpoint enabled, ask the daemon itself (no successful cycle within HEALTH_MAX_AGE_SECONDS -> 503)
+if [ -n "$METRICS_PORT" ]; then
+  python3 -c 'import sys, urllib.request; urllib.request.urlopen(sys.argv[1], timeout=2)' \
+    "http://127.0.0.1:${METRICS_PORT}/healthz" >/dev/null 2>&1 && exit 0
+  exit 255
+fi
+
 current_date=$(date +%s)
 if [ -f "$HEARTBEAT_FILE" ]; then
   m_time=$(stat --format='%Y' "$HEARTBEAT_FILE")
-  if (((current_date - m_time) < INTERVAL)); then
+  # The daemon writes the longest gap between two cycles it may leave (intervals, error backoff and jitter included),
+  # the interval passed as second argument only applies to empty heartbeat files
+  max_age=$(head -n 1 "$HEARTBEAT_FILE")
+  if ! [[ "$max_age" =~ ^[0-9]+$ ]]; then
+    max_age=$INTERVAL
+  fi
+  if (((current_date - m_time) < max_age)); then
     exit 0
   fi
 fi
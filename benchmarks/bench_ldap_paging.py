@@ -0,0 +1,117 @@
+"""
+Client side cost of the LDAP search: The unpaged search returning all attributes (previous get_email_list) versus the
+paged search restricted to LDAP_EMAIL_ATTR, collected to a list (get_email_list) or consumed while it arrives
+(iter_email_list). The directory is simulated in process, the decoded result entries are built when the client
+receives them, so network and server time are not part of the numbers.
+
+Usage: python3 -m benchmarks.bench_ldap_paging [--entries 100000] [--page-size 500]
+"""
+import argparse
+import gc
+import os
+import time
+import tracemalloc
+from typing import Callable, List, Optional, Tuple
+from unittest import mock
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+from vaultwarden_user_sync.email_sources.ldap import LdapConnector
+
+LDAP_ENV = {'LDAP_SERVER': 'dc1.example.com', 'LDAP_BIND_DN': 'cn=sync,dc=example,dc=com', 'LDAP_BIND_PW': 'secret',
+            'LDAP_BASE_DN': 'dc=example,dc=com', 'LDAP_SEARCH_FILTER': '(objectClass=person)',
+            'LDAP_EMAIL_ATTR': 'mail'}
+
+
+def make_entry(i: int, attrlist: Optional[List[str]]) -> Tuple[str, dict]:
+    """
+    A user entry as decoded by python-ldap, with the attributes a typical directory returns for a person
+    """
+    attrs = {
+        'mail': ['user{:07d}@example.com'.format(i).encode()],
+        'objectClass': [b'top', b'person', b'organizationalPerson', b'inetOrgPerson'],
+        'cn': ['User {:07d}'.format(i).encode()], 'sn': [b'User'], 'givenName': ['{:07d}'.format(i).encode()],
+        'uid': ['user{:07d}'.format(i).encode()], 'displayName': ['User {:07d}'.format(i).encode()],
+        'telephoneNumber': [b'+41 31 000 00 00'], 'title': [b'Engineer'], 'department': [b'Research'],
+        'memberOf': ['cn=group{},ou=groups,dc=example,dc=com'.format(g).encode() for g in range(i % 8)],
+        'description': [b'x' * 200], 'modifyTimestamp': [b'20260101000000Z'],
+    }
+    if attrlist is not None:
+        attrs = {key: value for key, value in attrs.items() if key in attrlist}
+    return 'uid=user{:07d},ou=people,dc=example,dc=com'.format(i), attrs
+
+
+class SimulatedDirectory:
+    """
+    Bound connection serving `entries` users, page by page if the Simple Paged Results control is sent
+    """
+
+    def __init__(self, entries: int):
+        self.entries = entries
+        self._pending = {}
+
+    def search_s(self, base, scope, filterstr, attrlist=None):
+        if base == '':
+            # Root DSE, read by the liveness probe of the persistent connection
+            return [('', {})]
+        return [make_entry(i, attrlist) for i in range(self.entries)]
+
+    def search_ext(self, base, scope, filterstr, attrlist=None, serverctrls=None):
+        page = next(control for control in serverctrls if control.controlType == SimplePagedResultsControl.controlType)
+        start = int(page.cookie or 0)
+        end = min(self.entries, start + page.size)
+        self._pending[start] = (start, end, attrlist, str(end).encode() if end < self.entries else b'')
+        return start
+
+    def result3(self, msg_id):
+        start, end, attrlist, cookie = self._pending.pop(msg_id)
+        return (ldap.RES_SEARCH_RESULT, [make_entry(i, attrlist) for i in range(start, end)], msg_id,
+                [SimplePagedResultsControl(criticality=False, size=end - start, cookie=cookie)])
+
+    def unbind_s(self):
+        pass
+
+
+def connector(directory: SimulatedDirectory, page_size: int) -> LdapConnector:
+    with mock.patch.dict(os.environ, dict(LDAP_ENV, LDAP_PAGE_SIZE=str(page_size))):
+        ldap_connector = LdapConnector('bench')
+    ldap_connector._bind = lambda server: directory
+    return ldap_connector
+
+
+def unpaged_all_attributes(ldap_connector: LdapConnector) -> List[str]:
+    with ldap_connector.connect() as conn:
+        results = conn.search_s(ldap_connector.ldap_base_dn, ldap.SCOPE_SUBTREE, ldap_connector.ldap_search_filter)
+    return [entry[1][ldap_connector.ldap_email_attr][0].decode() for entry in results]
+
+
+def measure(run: Callable[[], object]) -> Tuple[float, int]:
+    gc.collect()
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='LDAP paged search benchmark')
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--page-size', type=int, default=500)
+    args = parser.parse_args()
+
+    directory = SimulatedDirectory(args.entries)
+    unpaged = connector(directory, page_size=0)
+    paged = connector(directory, page_size=args.page_size)
+    print('{} entries, page size {}'.format(args.entries, args.page_size))
+    for label, run in [('unpaged, all attributes', lambda: unpaged_all_attributes(unpaged)),
+                       ('unpaged, email attribute', unpaged.get_email_list),
+                       ('paged, collected to list', paged.get_email_list),
+                       ('paged, not collected', lambda: sum(1 for _ in paged.iter_email_list()))]:
+        seconds, peak = measure(run)
+        print('{:<26} {:>8.3f}s {:>10.1f} MiB peak'.format(label, seconds, peak / 2 ** 20))
@@ -0,0 +1,44 @@
+"""
+Per-cycle LocalStore write time: One commit per mutation (rollback journal) versus a batch in WAL mode
+
+Usage: python3 -m benchmarks.bench_localstore [--users 5000]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from vaultwarden_user_sync.backends.localstore import LocalStore
+
+
+def run_cycle(ls: LocalStore, users: int, batched: bool) -> float:
+    start = time.perf_counter()
+    if batched:
+        with ls.batch():
+            for i in range(users):
+                ls.set_user_state('ID_{}'.format(i), 'DISABLED')
+    else:
+        for i in range(users):
+            ls.set_user_state('ID_{}'.format(i), 'DISABLED')
+    return time.perf_counter() - start
+
+
+def bench(users: int, journal_mode: str, batched: bool) -> float:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ls = LocalStore(os.path.join(tmp_dir, 'bench.sqlite'), journal_mode=journal_mode)
+        with ls.batch():
+            for i in range(users):
+                ls.register_user('user{}@example.com'.format(i), 'ID_{}'.format(i))
+        elapsed = run_cycle(ls, users, batched)
+        ls.con.close()
+        return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='LocalStore write benchmark')
+    parser.add_argument('--users', type=int, default=5000, help='Number of users touched per cycle')
+    args = parser.parse_args()
+    for label, journal_mode, batched in [('per mutation commit, DELETE journal', 'DELETE', False),
+                                         ('per mutation commit, WAL', 'WAL', False),
+                                         ('batch, WAL', 'WAL', True)]:
+        print('{:<40} {:>8.3f}s'.format(label, bench(args.users, journal_mode, batched)))
@@ -0,0 +1,66 @@
+"""
+Throughput and tail latency of the real VaultwardenConnector against the local fake admin API
+
+Usage: python3 -m benchmarks.bench_vaultwarden [--users 10000] [--invites 500] [--latency 0.02] [--error-rate 0.01]
+"""
+import argparse
+import os
+import time
+from typing import List
+from unittest import mock
+
+from tests.fake_vaultwarden import FakeVaultwardenServer, FakeVaultwardenConfig
+from vaultwarden_user_sync.backends.vaultwarden import VaultwardenConnector
+from vaultwarden_user_sync.compare import ChangeSet
+from vaultwarden_user_sync.executor import ChangeExecutor
+
+
+def percentile(samples: List[float], share: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def timed(method, samples: List[float]):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+
+    return wrapper
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='VaultwardenConnector benchmark against the fake admin API')
+    parser.add_argument('--users', type=int, default=10000, help='Users present in the fake instance')
+    parser.add_argument('--invites', type=int, default=500, help='Number of invites to send')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.02, help='Server side delay per request in seconds')
+    parser.add_argument('--latency-jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    config = FakeVaultwardenConfig(users=args.users, latency=args.latency, latency_jitter=args.latency_jitter,
+                                   error_rate=args.error_rate)
+    with FakeVaultwardenServer(config) as server:
+        with mock.patch.dict(os.environ, {'VAULTWARDEN_URL': server.url,
+                                          'VAULTWARDEN_ADMIN_TOKEN': config.admin_token,
+                                          'VAULTWARDEN_MAX_WORKERS': str(args.workers)}):
+            vwc = VaultwardenConnector()
+
+        start = time.perf_counter()
+        users = vwc.get_all_users()
+        print('get_all_users: {} users in {:.3f}s'.format(len(users), time.perf_counter() - start))
+
+        samples: List[float] = []
+        vwc.invite_user = timed(vwc.invite_user, samples)
+        change_set = ChangeSet(invite_emails={'bench{:07d}@example.com'.format(i) for i in range(args.invites)})
+        start = time.perf_counter()
+        failed = sum(1 for result in ChangeExecutor(vwc, max_workers=args.workers).run(change_set) if not result.ok)
+        elapsed = time.perf_counter() - start
+        print('invites: {} in {:.3f}s ({:.1f}/s), {} failed'.format(args.invites, elapsed, args.invites / elapsed,
+                                                                    failed))
+        print('latency p50 {:.1f}ms p95 {:.1f}ms p99 {:.1f}ms max {:.1f}ms'.format(
+            *(percentile(samples, share) * 1000 for share in [0.5, 0.95, 0.99, 1.0])))
+        print('transport: {}'.format(vwc.transport.get_stats()))
@@ -0,0 +1,70 @@
+"""
+Decoding of the /admin/users payload: json.loads() of the whole document plus a lowercased copy of every user
+(previous get_all_users) versus incremental decoding extracting three fields (iter_all_users)
+
+Usage: python3 -m benchmarks.bench_vaultwarden_decode [--users 100000] [--key-casing camel]
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+from typing import Callable, List, Tuple
+
+from tests.fake_vaultwarden import FakeVaultwardenState, FakeVaultwardenConfig
+from vaultwarden_user_sync.backends.json_stream import iter_json_array
+from vaultwarden_user_sync.backends.vaultwarden import VaultwardenUser, USERS_CHUNK_SIZE, _get_field
+
+
+def decode_whole(raw: bytes) -> List[VaultwardenUser]:
+    all_vw_users = []
+    for user_item in json.loads(raw):
+        normalized_user_item = {key.lower(): value for key, value in user_item.items()}
+        all_vw_users.append(VaultwardenUser(user_id=normalized_user_item['id'],
+                                            enabled=normalized_user_item['userenabled'],
+                                            email=normalized_user_item['email']))
+    return all_vw_users
+
+
+def decode_streaming(raw: bytes) -> List[VaultwardenUser]:
+    chunks = (raw[i:i + USERS_CHUNK_SIZE] for i in range(0, len(raw), USERS_CHUNK_SIZE))
+    return [VaultwardenUser(user_id=_get_field(item, 'id', 'Id'),
+                            enabled=_get_field(item, 'userEnabled', 'UserEnabled'),
+                            email=_get_field(item, 'email', 'Email'))
+            for item in iter_json_array(chunks)]
+
+
+def count_streaming(raw: bytes) -> int:
+    # Consumer that does not keep the users (e.g. the streaming diff spilling them to disk)
+    chunks = (raw[i:i + USERS_CHUNK_SIZE] for i in range(0, len(raw), USERS_CHUNK_SIZE))
+    return sum(1 for _ in iter_json_array(chunks))
+
+
+def measure(decode: Callable[[bytes], object], raw: bytes) -> Tuple[float, int]:
+    gc.collect()
+    start = time.perf_counter()
+    decode(raw)
+    seconds = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    decode(raw)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vaultwarden user list decoding benchmark')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--key-casing', choices=['camel', 'pascal'], default='camel')
+    args = parser.parse_args()
+
+    state = FakeVaultwardenState(FakeVaultwardenConfig(users=args.users, key_casing=args.key_casing))
+    raw = json.dumps([state.render_user(user) for user in state.users.values()]).encode()
+    del state
+    print('payload: {} users, {:.1f} MiB'.format(args.users, len(raw) / 2 ** 20))
+    for label, decode in [('json.loads + lowercased copies', decode_whole),
+                          ('incremental, collected to list', decode_streaming),
+                          ('incremental, not collected', count_streaming)]:
+        seconds, peak = measure(decode, raw)
+        print('{:<34} {:>8.3f}s {:>10.1f} MiB peak'.format(label, seconds, peak / 2 ** 20))
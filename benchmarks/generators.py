@@ -0,0 +1,81 @@
+"""
+Deterministic synthetic inputs for the benchmarks: LDAP email lists, Vaultwarden users and pre-populated LocalStores
+"""
+import random
+from dataclasses import dataclass
+from typing import List
+
+from vaultwarden_user_sync.backends.localstore import LocalStore
+from vaultwarden_user_sync.backends.vaultwarden import MockVaultwardenConnector, VaultwardenUser
+from vaultwarden_user_sync.email_sources import EmailSource
+
+
+class StaticEmailSource(EmailSource):
+    """
+    Email source returning a fixed list (stands in for LDAP)
+    """
+
+    def __init__(self, source_name: str, emails: List[str]):
+        super().__init__(source_name)
+        self.emails = emails
+
+    def get_email_list(self) -> List[str]:
+        return list(self.emails)
+
+
+@dataclass
+class Scenario:
+    """
+    A steady state with some churn: Out of `users` managed users, a share left the email source (to be disabled),
+    changed their email or were disabled in Vaultwarden. New users show up in the email source (to be invited) and
+    Vaultwarden knows some users not managed by us.
+    """
+    users: int
+    seed: int = 1
+    vanished_from_source: float = 0.03
+    new_in_source: float = 0.05
+    email_changed_in_vw: float = 0.01
+    disabled_in_vw: float = 0.01
+    unmanaged_in_vw: float = 0.02
+
+    @staticmethod
+    def email(i: int) -> str:
+        return 'user{:07d}@example.com'.format(i)
+
+    @staticmethod
+    def user_id(i: int) -> str:
+        return '{:08x}-0000-4000-8000-{:012x}'.format(i, i)
+
+    def _sample(self, rnd: random.Random, population: range, share: float) -> set:
+        return set(rnd.sample(population, int(len(population) * share)))
+
+    def source_emails(self) -> List[str]:
+        rnd = random.Random(self.seed)
+        vanished = self._sample(rnd, range(self.users), self.vanished_from_source)
+        emails = [self.email(i) for i in range(self.users) if i not in vanished]
+        emails += [self.email(i) for i in range(self.users, self.users + int(self.users * self.new_in_source))]
+        rnd.shuffle(emails)
+        return emails
+
+    def vaultwarden_users(self) -> List[VaultwardenUser]:
+        rnd = random.Random(self.seed + 1)
+        changed = self._sample(rnd, range(self.users), self.email_changed_in_vw)
+        disabled = self._sample(rnd, range(self.users), self.disabled_in_vw)
+        vw_users = [VaultwardenUser(user_id=self.user_id(i),
+                                    email='changed.' + self.email(i) if i in changed else self.email(i),
+                                    enabled=i not in disabled)
+                    for i in range(self.users)]
+        offset = 10 * self.users
+        vw_users += [VaultwardenUser(user_id=self.user_id(i), email=self.email(i), enabled=True)
+                     for i in range(offset, offset + int(self.users * self.unmanaged_in_vw))]
+        return vw_users
+
+    def mock_vaultwarden(self) -> MockVaultwardenConnector:
+        vwc = MockVaultwardenConnector()
+        vwc._vw_user_by_id = {user.user_id: user for user in self.vaultwarden_users()}
+        return vwc
+
+    def populate_local_store(self, ls: LocalStore):
+        with ls.batch():
+            for i in range(self.users):
+                ls.register_user(self.email(i), self.user_id(i))
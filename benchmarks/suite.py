@@ -0,0 +1,142 @@
+"""
+Scale benchmark of the full sync pipeline (run_cycle) against synthetic data, reporting wall time and peak memory
+per phase. Compares against stored baselines and exits non-zero on regressions.
+
+Usage: python3 -m benchmarks.suite [--sizes 1000,10000,100000,1000000] [--update-baseline]
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List
+
+from benchmarks.generators import Scenario, StaticEmailSource
+from vaultwarden_user_sync.backends.localstore import LocalStore
+from vaultwarden_user_sync.cycle import CycleOptions, run_cycle
+from vaultwarden_user_sync.executor import ChangeExecutor
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baselines.json')
+# Absolute slack on top of the relative tolerance, keeps tiny phases from failing on noise
+TIME_SLACK_SECONDS = 0.05
+MEMORY_SLACK_BYTES = 1024 * 1024
+
+
+def run_scenario(scenario: Scenario, trace_memory: bool, streaming_diff: bool = False) -> Dict[str, Dict[str, float]]:
+    """
+    Runs a cycle applying the churn of the scenario, and a steady state cycle (nothing changed) afterwards
+
+    :return: Phase name -> {'seconds': ..., 'peak_bytes': ...}
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ls = LocalStore(os.path.join(tmp_dir, 'bench.sqlite'))
+        scenario.populate_local_store(ls)
+        ems = StaticEmailSource('bench', scenario.source_emails())
+        vwc = scenario.mock_vaultwarden()
+        executor = ChangeExecutor(vwc, max_workers=4)
+        options = CycleOptions(safe_guard=sys.maxsize, cleanup_vanished_users=True, streaming_diff=streaming_diff,
+                               spill_dir=tmp_dir)
+        gc.collect()
+
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            report = run_cycle(ems, vwc, ls, executor, options)
+            cycle_seconds = time.perf_counter() - start
+            # Cycles settling the local state after the applied changes, the cycle after that is the steady state
+            for _ in range(5):
+                if run_cycle(ems, vwc, ls, executor, options).skipped:
+                    break
+            start = time.perf_counter()
+            steady_report = run_cycle(ems, vwc, ls, executor, options)
+            steady_seconds = time.perf_counter() - start
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+        assert steady_report.skipped, 'Steady state cycle was expected to be skipped'
+        ls.con.close()
+
+    results = {name: {'seconds': seconds, 'peak_bytes': report.phase_peak_memory.get(name, 0)}
+               for name, seconds in report.phase_durations.items()}
+    results['cycle_total'] = {'seconds': cycle_seconds, 'peak_bytes': max(report.phase_peak_memory.values(),
+                                                                          default=0)}
+    results['steady_state_cycle'] = {'seconds': steady_seconds,
+                                      'peak_bytes': max(steady_report.phase_peak_memory.values(), default=0)}
+    return results
+
+
+def measure(size: int, streaming_diff: bool = False) -> Dict[str, Dict[str, float]]:
+    # Timing and memory are measured in separate runs, tracemalloc slows down allocations considerably
+    timings = run_scenario(Scenario(users=size), trace_memory=False, streaming_diff=streaming_diff)
+    memory = run_scenario(Scenario(users=size), trace_memory=True, streaming_diff=streaming_diff)
+    for name, values in timings.items():
+        values['peak_bytes'] = memory.get(name, {}).get('peak_bytes', 0)
+    return timings
+
+
+def find_regressions(results: Dict[str, Dict[str, Dict[str, float]]], baselines: Dict[str, Dict[str, Dict[str, float]]],
+                     time_tolerance: float, memory_tolerance: float) -> List[str]:
+    regressions = []
+    for size, phases in results.items():
+        for name, values in phases.items():
+            baseline = baselines.get(size, {}).get(name)
+            if baseline is None:
+                continue
+            if values['seconds'] > baseline['seconds'] * time_tolerance + TIME_SLACK_SECONDS:
+                regressions.append('{} users, {}: {:.3f}s (baseline {:.3f}s)'.format(
+                    size, name, values['seconds'], baseline['seconds']))
+            if values['peak_bytes'] > baseline['peak_bytes'] * memory_tolerance + MEMORY_SLACK_BYTES:
+                regressions.append('{} users, {}: {:.1f} MiB (baseline {:.1f} MiB)'.format(
+                    size, name, values['peak_bytes'] / 2 ** 20, baseline['peak_bytes'] / 2 ** 20))
+    return regressions
+
+
+def print_results(size: str, phases: Dict[str, Dict[str, float]]):
+    print('{} users'.format(size))
+    for name, values in phases.items():
+        print('  {:<22} {:>9.3f}s {:>10.1f} MiB'.format(name, values['seconds'], values['peak_bytes'] / 2 ** 20))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync pipeline scale benchmark')
+    parser.add_argument('--sizes', type=str, default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='Comma separated numbers of users')
+    parser.add_argument('--baseline', type=str, default=BASELINE_FILE, help='Baseline file')
+    parser.add_argument('--update-baseline', action='store_true', help='Store the results as new baseline')
+    parser.add_argument('--time-tolerance', type=float, default=1.5,
+                        help='Fail if a phase takes longer than baseline * tolerance')
+    parser.add_argument('--memory-tolerance', type=float, default=1.2,
+                        help='Fail if a phase needs more memory than baseline * tolerance')
+    parser.add_argument('--diff-mode', choices=['memory', 'streaming'], default='memory',
+                        help='Diff implementation (DIFF_MODE), streaming results are stored as "<size>-streaming"')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results = {}
+    for size in [int(s) for s in args.sizes.split(',')]:
+        key = str(size) if args.diff_mode == 'memory' else '{}-{}'.format(size, args.diff_mode)
+        results[key] = measure(size, streaming_diff=args.diff_mode == 'streaming')
+        print_results(key, results[key])
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    if args.update_baseline:
+        baselines.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print('Baseline written to {}'.format(args.baseline))
+        sys.exit(0)
+
+    regressions = find_regressions(results, baselines, args.time_tolerance, args.memory_tolerance)
+    for regression in regressions:
+        print('REGRESSION: {}'.format(regression))
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,241 @@
+"""
+Local fake of the Vaultwarden admin API (/admin, /admin/users, /admin/invite, /admin/users/<id>/enable|disable) for
+exercising the real VaultwardenConnector (HTTP, cookie auth, JSON decoding) offline, with configurable latency, error
+rates and cookie expiry.
+
+Usage: python3 -m tests.fake_vaultwarden --port 8080 --users 10000 --latency 0.02
+"""
+import argparse
+import json
+import random
+import secrets
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.cookies import SimpleCookie
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+
+from vaultwarden_user_sync.backends.vaultwarden import ADMIN_COOKIE_NAME
+
+
+@dataclass
+class FakeVaultwardenConfig:
+    admin_token: str = 'fake-admin-token'
+    # Number of users present on startup
+    users: int = 0
+    # Response delay in seconds: latency + uniform(0, latency_jitter)
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    # Share of requests answered with error_status instead of being processed
+    error_rate: float = 0.0
+    error_status: int = 503
+    # Lifetime of admin cookies in seconds, requests with expired cookies are answered with 401
+    cookie_lifetime: float = 1200
+    # 'camel' (Vaultwarden >= 1.32.0) or 'pascal' (older versions)
+    key_casing: str = 'camel'
+    seed: int = 1
+
+
+@dataclass
+class FakeVaultwardenState:
+    config: FakeVaultwardenConfig
+    # user_id -> user item (camelCase keys)
+    users: Dict[str, dict] = field(default_factory=dict)
+    # cookie -> expiry timestamp
+    sessions: Dict[str, float] = field(default_factory=dict)
+    # Number of handled requests per endpoint
+    request_counts: Dict[str, int] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def __post_init__(self):
+        self.random = random.Random(self.config.seed)
+        for i in range(self.config.users):
+            self.add_user('user{:07d}@example.com'.format(i), user_id=str(uuid.UUID(int=i + 1)))
+
+    def add_user(self, email: str, user_id: Optional[str] = None, enabled: bool = True) -> dict:
+        user_id = user_id or str(uuid.uuid4())
+        # Roughly what Vaultwarden returns per user, most of it is ignored by the connector
+        user = {
+            'object': 'user', 'id': user_id, 'name': email.split('@')[0], 'email': email, 'emailVerified': True,
+            'premium': True, 'masterPasswordHint': None, 'culture': 'en-US', 'twoFactorEnabled': False,
+            'key': 'x' * 120, 'privateKey': None, 'securityStamp': str(uuid.uuid4()), 'forcePasswordReset': False,
+            'usesKeyConnector': False, 'organizations': [
+                {'id': str(uuid.UUID(int=1)), 'name': 'Example Org', 'status': 2, 'type': 2, 'enabled': True}
+            ],
+            'userEnabled': enabled, 'createdAt': '2024-01-01 00:00:00 UTC', 'lastActive': None,
+            'twoFactorProviders': [], 'providerOrganizations': [],
+        }
+        self.users[user_id] = user
+        return user
+
+    def render_user(self, user: dict) -> dict:
+        if self.config.key_casing == 'pascal':
+            return {key[0].upper() + key[1:]: value for key, value in user.items()}
+        return user
+
+
+def _make_handler(state: FakeVaultwardenState):
+    class FakeVaultwardenHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body in one segment, keeps delayed ACKs from dominating the measured latency
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _count(self, endpoint: str):
+            with state.lock:
+                state.request_counts[endpoint] = state.request_counts.get(endpoint, 0) + 1
+
+        def _send(self, status: int, body: Optional[object] = None, headers: Optional[Dict[str, str]] = None):
+            payload = json.dumps(body).encode() if body is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _read_body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def _delay_and_fail(self) -> bool:
+            config = state.config
+            with state.lock:
+                delay = config.latency + state.random.uniform(0, config.latency_jitter)
+                fail = state.random.random() < config.error_rate
+            if delay:
+                time.sleep(delay)
+            if fail:
+                self._read_body()
+                self._send(config.error_status)
+            return fail
+
+        def _authenticated(self) -> bool:
+            cookie = SimpleCookie(self.headers.get('Cookie', ''))
+            if ADMIN_COOKIE_NAME not in cookie:
+                return False
+            with state.lock:
+                expires_at = state.sessions.get(cookie[ADMIN_COOKIE_NAME].value)
+            return expires_at is not None and expires_at > time.time()
+
+        def do_GET(self):
+            if self._delay_and_fail():
+                return
+            if self.path != '/admin/users':
+                return self._send(404)
+            self._count('users')
+            if not self._authenticated():
+                return self._send(401)
+            with state.lock:
+                users = [state.render_user(user) for user in state.users.values()]
+            self._send(200, users)
+
+        def do_POST(self):
+            if self._delay_and_fail():
+                return
+            body = self._read_body()
+            if self.path == '/admin':
+                self._count('login')
+                token = parse_qs(body.decode()).get('token', [''])[0]
+                if token != state.config.admin_token:
+                    return self._send(401)
+                cookie = secrets.token_hex(16)
+                with state.lock:
+                    state.sessions[cookie] = time.time() + state.config.cookie_lifetime
+                return self._send(200, {}, headers={
+                    'Set-Cookie': '{}={}; Max-Age={}; Path=/admin; HttpOnly'.format(
+                        ADMIN_COOKIE_NAME, cookie, int(state.config.cookie_lifetime))})
+
+            if not self._authenticated():
+                self._count('unauthorized')
+                return self._send(401)
+            if self.path == '/admin/invite':
+                self._count('invite')
+                email = json.loads(body)['email']
+                with state.lock:
+                    if any(user['email'] == email for user in state.users.values()):
+                        return self._send(409, {'message': 'User already exists'})
+                    user = state.add_user(email)
+                    return self._send(200, state.render_user(user))
+            parts = self.path.strip('/').split('/')
+            if len(parts) == 4 and parts[:2] == ['admin', 'users'] and parts[3] in ['enable', 'disable']:
+                self._count(parts[3])
+                with state.lock:
+                    user = state.users.get(parts[2])
+                    if user is None:
+                        return self._send(404)
+                    user['userEnabled'] = parts[3] == 'enable'
+                return self._send(200)
+            self._send(404)
+
+    return FakeVaultwardenHandler
+
+
+class FakeVaultwardenServer:
+    """
+    Runs the fake admin API in a background thread, usable as context manager
+    """
+
+    def __init__(self, config: Optional[FakeVaultwardenConfig] = None, host: str = '127.0.0.1', port: int = 0):
+        """
+        :param port: 0 picks a free port, see url
+        """
+        self.state = FakeVaultwardenState(config or FakeVaultwardenConfig())
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self.state))
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self) -> "FakeVaultwardenServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-vaultwarden', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def expire_sessions(self):
+        """
+        Invalidate all admin cookies handed out so far
+        """
+        with self.state.lock:
+            self.state.sessions.clear()
+
+    def __enter__(self) -> "FakeVaultwardenServer":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Vaultwarden admin API')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0, help='Response delay in seconds')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='Additional random delay in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests failing with 503')
+    parser.add_argument('--cookie-lifetime', type=float, default=1200, help='Admin cookie lifetime in seconds')
+    parser.add_argument('--key-casing', choices=['camel', 'pascal'], default='camel')
+    parser.add_argument('--admin-token', type=str, default='fake-admin-token')
+    args = parser.parse_args()
+    server = FakeVaultwardenServer(FakeVaultwardenConfig(
+        admin_token=args.admin_token, users=args.users, latency=args.latency, latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate, cookie_lifetime=args.cookie_lifetime, key_casing=args.key_casing),
+        port=args.port)
+    print('Fake Vaultwarden listening on {} (VAULTWARDEN_ADMIN_TOKEN={})'.format(server.url, args.admin_token))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
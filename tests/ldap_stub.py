@@ -0,0 +1,108 @@
+"""
+Stand-in for the parts of python-ldap the LDAP connectors use, so their tests run where python-ldap (which needs the
+OpenLDAP client libraries to build) is not installed. Only used if importing the real package fails.
+"""
+import sys
+import types
+
+SCOPE_NAMES = ['SCOPE_BASE', 'SCOPE_ONELEVEL', 'SCOPE_SUBTREE']
+
+
+class LDAPError(Exception):
+    pass
+
+
+class RequestControl:
+
+    def __init__(self, controlType=None, criticality=False, encodedControlValue=None):
+        self.controlType = controlType
+        self.criticality = criticality
+        self.encodedControlValue = encodedControlValue
+
+
+class ResponseControl:
+
+    def __init__(self, controlType=None, criticality=False):
+        self.controlType = controlType
+        self.criticality = criticality
+
+
+class SimplePagedResultsControl(RequestControl, ResponseControl):
+    controlType = '1.2.840.113556.1.4.319'
+
+    def __init__(self, criticality=True, size=10, cookie=''):
+        self.criticality = criticality
+        self.size = size
+        self.cookie = cookie or ''
+
+
+class SyncRequestControl(RequestControl):
+    controlType = '1.3.6.1.4.1.4203.1.9.1.1'
+
+    def __init__(self, criticality=1, cookie=None, mode='refreshOnly', reloadHint=False):
+        self.criticality = criticality
+        self.cookie = cookie
+        self.mode = mode
+        self.reloadHint = reloadHint
+
+
+class SyncStateControl(ResponseControl):
+    controlType = '1.3.6.1.4.1.4203.1.9.1.2'
+
+
+class SyncDoneControl(ResponseControl):
+    controlType = '1.3.6.1.4.1.4203.1.9.1.3'
+
+
+class SyncInfoMessage:
+    responseName = '1.3.6.1.4.1.4203.1.9.1.4'
+
+    def __init__(self, encodedMessage):
+        raise NotImplementedError('Intermediate messages are not decoded by the stub')
+
+
+class SimpleLDAPObject:
+    pass
+
+
+def escape_filter_chars(assertion_value: str, escape_mode: int = 0) -> str:
+    escaped = assertion_value.replace('\\', r'\5c')
+    for char, replacement in [('*', r'\2a'), ('(', r'\28'), (')', r'\29'), ('\x00', r'\00')]:
+        escaped = escaped.replace(char, replacement)
+    return escaped
+
+
+def initialize(uri: str, *args, **kwargs):
+    # Tests replace LdapConnector._bind, nothing may reach a real server
+    raise sys.modules['ldap'].SERVER_DOWN({'desc': "Can't contact LDAP server", 'info': uri})
+
+
+def _module(name: str, **attrs) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install():
+    """
+    Registers the stub as the ldap package (and its submodules) unless python-ldap can be imported
+    """
+    try:
+        import ldap
+        return
+    except ImportError:
+        pass
+    errors = {name: type(name, (LDAPError,), {})
+              for name in ['SERVER_DOWN', 'TIMEOUT', 'UNAVAILABLE', 'BUSY', 'NO_SUCH_OBJECT', 'OTHER', 'FILTER_ERROR']}
+    ldap = _module('ldap', LDAPError=LDAPError, initialize=initialize,
+                   OPT_NETWORK_TIMEOUT=0x5005, OPT_TIMEOUT=0x5002,
+                   RES_SEARCH_ENTRY=0x64, RES_SEARCH_RESULT=0x65, RES_INTERMEDIATE=0x79,
+                   **{name: value for value, name in enumerate(SCOPE_NAMES)}, **errors)
+    ldap.__path__ = []
+    ldap.controls = _module('ldap.controls', RequestControl=RequestControl, ResponseControl=ResponseControl,
+                            SimplePagedResultsControl=SimplePagedResultsControl)
+    ldap.filter = _module('ldap.filter', escape_filter_chars=escape_filter_chars)
+    ldap.ldapobject = _module('ldap.ldapobject', SimpleLDAPObject=SimpleLDAPObject)
+    ldap.syncrepl = _module('ldap.syncrepl', SyncRequestControl=SyncRequestControl, SyncStateControl=SyncStateControl,
+                            SyncDoneControl=SyncDoneControl, SyncInfoMessage=SyncInfoMessage)
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+from requests.cookies import create_cookie
+
+from vaultwarden_user_sync.backends.vaultwarden import AdminSession, ADMIN_COOKIE_NAME
+
+
+class StubLoginClient:
+    """
+    Stands in for requests.Session, answers every login with a fresh cookie
+    """
+
+    def __init__(self, expires_in: int = 3600):
+        self.expires_in = expires_in
+        self.logins = 0
+        self.cookies = requests.cookies.RequestsCookieJar()
+
+    def post(self, url, data=None, timeout=None):
+        time.sleep(0.01)
+        self.logins += 1
+        response = requests.Response()
+        response.status_code = 200
+        response.cookies.set_cookie(create_cookie(ADMIN_COOKIE_NAME, 'cookie{}'.format(self.logins),
+                                                  expires=int(time.time()) + self.expires_in))
+        return response
+
+
+class AdminSessionTest(unittest.TestCase):
+
+    def test_cookie_reused(self):
+        client = StubLoginClient()
+        session = AdminSession(client, 'http://vw', 'token')
+        self.assertEqual(('cookie1', 1), session.get_cookie())
+        self.assertEqual(('cookie1', 1), session.get_cookie())
+        self.assertEqual(1, client.logins)
+
+    def test_refresh_before_expiry(self):
+        client = StubLoginClient(expires_in=30)
+        session = AdminSession(client, 'http://vw', 'token', refresh_margin=60)
+        session.get_cookie()
+        session.get_cookie()
+        self.assertEqual(2, client.logins)
+
+    def test_concurrent_invalidate_logs_in_once(self):
+        client = StubLoginClient()
+        session = AdminSession(client, 'http://vw', 'token')
+        _, generation = session.get_cookie()
+        threads = [threading.Thread(target=session.invalidate, args=(generation,)) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2, client.logins)
+        self.assertEqual(('cookie2', 2), session.get_cookie())
+
+    def test_persisted_only_on_change(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cookie_file = os.path.join(tmp_dir, 'cookie.json')
+            session = AdminSession(StubLoginClient(), 'http://vw', 'token', cookie_file=cookie_file)
+            session.get_cookie()
+            first_write = os.stat(cookie_file).st_mtime_ns
+            session.get_cookie()
+            self.assertEqual(first_write, os.stat(cookie_file).st_mtime_ns)
+
+            client = StubLoginClient()
+            restored = AdminSession(client, 'http://vw', 'token', cookie_file=cookie_file)
+            self.assertEqual('cookie1', restored.get_cookie()[0])
+            self.assertEqual(0, client.logins)
@@ -0,0 +1,140 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from typing import List
+
+from vaultwarden_user_sync.email_sources import EmailSource
+from vaultwarden_user_sync.email_sources.cached import CachedEmailSource
+from vaultwarden_user_sync.email_sources.merged import MergedEmailSource
+
+
+class ChangingSource(EmailSource):
+    """
+    Returns the addresses it is set to at the time of the fetch, counting the fetches
+    """
+
+    def __init__(self, emails: List[str], config: str = 'ldap://dc1'):
+        super().__init__('LDAP')
+        self.emails = emails
+        self.config = config
+        self.error = None
+        self.fetches = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def get_email_list(self) -> List[str]:
+        self.release.wait()
+        self.fetches += 1
+        if self.error:
+            raise self.error
+        return list(self.emails)
+
+    def config_key(self) -> str:
+        return self.config
+
+
+class CachedEmailSourceTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.snapshot_file = os.path.join(self.tmp_dir.name, 'snapshot.json')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def cached(self, source: EmailSource, ttl: float = 60, force_refresh: bool = False) -> CachedEmailSource:
+        return CachedEmailSource(source, self.snapshot_file, ttl=ttl, force_refresh=force_refresh)
+
+    def test_warm_start(self):
+        source = ChangingSource(['a@test.com'])
+        first = self.cached(source)
+        self.assertEqual(['a@test.com'], first.get_email_list())
+        self.assertEqual(1, source.fetches)
+        self.assertEqual(0o600, os.stat(self.snapshot_file).st_mode & 0o777)
+
+        # Restart: Served from the snapshot, the fetch happens in the background
+        source.emails = ['a@test.com', 'b@test.com']
+        source.release.clear()
+        restarted = self.cached(source)
+        self.assertEqual(['a@test.com'], restarted.get_email_list())
+        source.release.set()
+        restarted.wait_for_refresh()
+        self.assertEqual(2, source.fetches)
+        with open(self.snapshot_file) as f:
+            self.assertEqual(['a@test.com', 'b@test.com'], json.load(f)['emails'])
+
+        # Later cycles get the live result, not the one of the previous cycle
+        source.emails = ['b@test.com']
+        self.assertEqual(['b@test.com'], restarted.get_email_list())
+        source.emails = ['c@test.com']
+        self.assertEqual(['c@test.com'], restarted.get_email_list())
+        restarted.close()
+        self.assertEqual(4, source.fetches)
+        self.assertEqual({'snapshot': 1, 'fetched': 2, 'refreshed': 1, 'refresh_errors': 0}, restarted.stats)
+
+    def test_expired_snapshot(self):
+        source = ChangingSource(['a@test.com'])
+        self.cached(source).get_email_list()
+        source.emails = ['b@test.com']
+        expired = self.cached(source, ttl=0)
+        self.assertEqual(['b@test.com'], expired.get_email_list())
+        self.assertEqual({'snapshot': 0, 'fetched': 1, 'refreshed': 0, 'refresh_errors': 0}, expired.stats)
+
+    def test_force_refresh(self):
+        source = ChangingSource(['a@test.com'])
+        self.cached(source).get_email_list()
+        source.emails = ['b@test.com']
+        self.assertEqual(['b@test.com'], self.cached(source, force_refresh=True).get_email_list())
+
+        cached = self.cached(source)
+        source.emails = ['c@test.com']
+        cached.force_refresh()
+        self.assertEqual(['c@test.com'], cached.get_email_list())
+
+    def test_configuration_changed(self):
+        self.cached(ChangingSource(['a@test.com'])).get_email_list()
+        other = ChangingSource(['b@test.com'], config='ldap://dc2')
+        self.assertEqual(['b@test.com'], self.cached(other).get_email_list())
+        self.assertEqual(1, other.fetches)
+
+    def test_failing_refresh_keeps_snapshot(self):
+        source = ChangingSource(['a@test.com'])
+        self.cached(source).get_email_list()
+        source.error = ConnectionError('down')
+        cached = self.cached(source)
+        self.assertEqual(['a@test.com'], cached.get_email_list())
+        cached.wait_for_refresh()
+        self.assertEqual(1, cached.stats['refresh_errors'])
+        # The next cycle fetches in the foreground, the error surfaces
+        with self.assertRaises(ConnectionError):
+            cached.get_email_list()
+        # The snapshot is still there for the next start
+        self.assertEqual(['a@test.com'], self.cached(source).get_email_list())
+
+    def test_unreadable_snapshot(self):
+        with open(self.snapshot_file, 'w') as f:
+            f.write('{"version": 1, ')
+        source = ChangingSource(['a@test.com'])
+        self.assertEqual(['a@test.com'], self.cached(source).get_email_list())
+        self.assertEqual(1, source.fetches)
+
+    def test_describe(self):
+        # Logged at startup, the wrapped sources are described as without snapshot
+        staff, students = ChangingSource([]), ChangingSource([])
+        students.source_name = 'STUDENTS'
+        cached = self.cached(MergedEmailSource('merged', [staff, students]), ttl=600)
+        self.assertEqual(['LDAP', 'STUDENTS', 'Email source snapshot: {} (served for 600s)'.format(self.snapshot_file)],
+                         cached.describe())
+        cached.source.close()
+
+    def test_thread_unsafe_source(self):
+        source = ChangingSource([])
+        source.thread_safe = False
+        with self.assertRaises(ValueError):
+            self.cached(source)
+
+
+if __name__ == '__main__':
+    unittest.main()
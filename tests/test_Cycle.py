@@ -0,0 +1,119 @@
+import asyncio
+import contextlib
+import os
+import tempfile
+import time
+import unittest
+from typing import List, Iterator, Tuple
+
+from vaultwarden_user_sync.backends.localstore import LocalStore
+from vaultwarden_user_sync.backends.vaultwarden import MockVaultwardenConnector, VaultwardenUser
+from vaultwarden_user_sync.cycle import CycleOptions, run_cycle, run_cycle_async
+from vaultwarden_user_sync.email_sources import EmailSource
+from vaultwarden_user_sync.executor import ChangeExecutor
+
+FETCH_DELAY = 0.2
+
+
+class SlowEmailSource(EmailSource):
+
+    def __init__(self, emails: List[str], delay: float = 0.0):
+        super().__init__('test')
+        self.emails = emails
+        self.delay = delay
+
+    def get_email_list(self) -> List[str]:
+        time.sleep(self.delay)
+        return list(self.emails)
+
+
+class SlowVaultwardenConnector(MockVaultwardenConnector):
+    delay = 0.0
+
+    def get_all_users(self) -> List[VaultwardenUser]:
+        time.sleep(self.delay)
+        return super().get_all_users()
+
+
+@contextlib.contextmanager
+def cycle_fixture() -> Iterator[Tuple[LocalStore, SlowVaultwardenConnector, CycleOptions]]:
+    """
+    Empty local store and Vaultwarden, removed again on exit
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ls = LocalStore(os.path.join(tmp_dir, 'test.sqlite'))
+        vwc = SlowVaultwardenConnector()
+        vwc.clear_test_data()
+        try:
+            yield ls, vwc, CycleOptions(safe_guard=100, cleanup_vanished_users=True)
+        finally:
+            ls.con.close()
+
+
+class CycleTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        stack = contextlib.ExitStack()
+        self.addCleanup(stack.close)
+        self.ls, self.vwc, self.options = stack.enter_context(cycle_fixture())
+
+    @staticmethod
+    def state(ls: LocalStore, vwc: MockVaultwardenConnector):
+        return (sorted((user.email, user.enabled) for user in vwc.get_all_users()),
+                sorted((user.invite_email, user.enabled) for user in ls.get_all_managed_users()))
+
+    @staticmethod
+    def run_engine(engine: str, ems: EmailSource, ls: LocalStore, vwc: MockVaultwardenConnector,
+                   options: CycleOptions):
+        executor = ChangeExecutor(vwc, max_workers=4)
+        options.streaming_diff = engine == 'streaming'
+        if engine == 'async':
+            return asyncio.run(run_cycle_async(ems, vwc, ls, executor, options))
+        return run_cycle(ems, vwc, ls, executor, options)
+
+    def test_engines_equivalent(self):
+        states = {}
+        for engine in ['sync', 'async', 'streaming']:
+            with self.subTest(engine=engine), cycle_fixture() as (ls, vwc, options):
+                ems = SlowEmailSource(['user{}@test.com'.format(i) for i in range(10)])
+                self.run_engine(engine, ems, ls, vwc, options)
+                ems.emails = ems.emails[3:] + ['new@test.com']
+                # Settles within a few cycles, from then on nothing changes
+                self.assertTrue(any(self.run_engine(engine, ems, ls, vwc, options).skipped for _ in range(5)))
+                states[engine] = self.state(ls, vwc)
+        self.assertEqual(states['sync'], states['async'])
+        self.assertEqual(states['sync'], states['streaming'])
+        self.assertIn(('user0@test.com', False), states['async'][0])
+
+    def test_fetches_overlap(self):
+        self.vwc.delay = FETCH_DELAY
+        ems = SlowEmailSource(['a@test.com'], delay=FETCH_DELAY)
+        start = time.perf_counter()
+        report = self.run_engine('async', ems, self.ls, self.vwc, self.options)
+        self.assertLess(time.perf_counter() - start, 2 * FETCH_DELAY)
+        self.assertGreaterEqual(report.phase_durations['source_fetch'], FETCH_DELAY)
+        self.assertGreaterEqual(report.phase_durations['vaultwarden_fetch'], FETCH_DELAY)
+        self.assertEqual([('a@test.com', True)], self.state(self.ls, self.vwc)[0])
+
+    def test_source_bound_to_local_store(self):
+        ls = self.ls
+
+        class LocalStoreSource(SlowEmailSource):
+            thread_safe = False
+
+            def get_email_list(self) -> List[str]:
+                # Raises ProgrammingError if called from another thread
+                return ls.get_source_emails('test') + super().get_email_list()
+
+        self.vwc.delay = FETCH_DELAY
+        self.run_engine('async', LocalStoreSource(['a@test.com'], delay=FETCH_DELAY), self.ls, self.vwc,
+                        self.options)
+        self.assertEqual([('a@test.com', True)], self.state(self.ls, self.vwc)[0])
+
+    def test_fetch_error_propagates(self):
+        class FailingSource(EmailSource):
+            def get_email_list(self) -> List[str]:
+                raise ConnectionError('LDAP down')
+
+        with self.assertRaises(ConnectionError):
+            self.run_engine('async', FailingSource('test'), self.ls, self.vwc, self.options)
@@ -0,0 +1,93 @@
+import random
+import unittest
+from typing import List
+
+from vaultwarden_user_sync.backends.localstore import ManagedUser
+from vaultwarden_user_sync.backends.vaultwarden import VaultwardenUser
+from vaultwarden_user_sync.compare import SyncResult
+
+
+def legacy_diff(vw_users: List[VaultwardenUser], ma_users: List[ManagedUser], source_email_addresses: List[str]):
+    """
+    Set based implementation SyncResult.factory used before the UserIndex, kept as reference
+    """
+    ma_user_ids_all = {u.vw_user_id for u in ma_users}
+    ma_user_ids_enabled = {u.vw_user_id for u in ma_users if u.enabled}
+    ma_user_ids_disabled = {u.vw_user_id for u in ma_users if not u.enabled}
+    ma_users_by_id = {u.vw_user_id: u for u in ma_users}
+    ma_id_by_email = {u.invite_email: u.vw_user_id for u in ma_users}
+    ma_user_emails_all_vw = {u.vw_email for u in ma_users}
+    ma_user_emails_enabled = {u.invite_email for u in ma_users if u.enabled}
+    ma_user_emails_disabled = {u.invite_email for u in ma_users if not u.enabled}
+    ma_users_emails_all_inv = {u.invite_email for u in ma_users}
+
+    vw_user_ids_all = {u.user_id for u in vw_users}
+    vw_user_ids_enabled = {u.user_id for u in vw_users if u.enabled}
+    vw_user_ids_disabled = {u.user_id for u in vw_users if not u.enabled}
+    vw_users_by_id = {u.user_id: u for u in vw_users}
+    vw_users_by_email = {u.email: u for u in vw_users}
+    vw_user_emails = {u.email for u in vw_users}
+    vw_user_emails_disabled = {u.email for u in vw_users if not u.enabled}
+    source = set(source_email_addresses)
+
+    changed = []
+    for user_id in ma_user_ids_all.intersection(vw_user_ids_all):
+        if ma_users_by_id[user_id].vw_email != vw_users_by_id[user_id].email:
+            changed.append((user_id, ma_users_by_id[user_id].vw_email, vw_users_by_id[user_id].email))
+    return {
+        'email_vanished_in_src': ma_user_emails_all_vw.difference(vw_user_emails.union(source)),
+        'email_vanished_in_both': ma_user_emails_all_vw.difference(vw_user_emails.union(source)),
+        'user_ids_vanished_in_vw': ma_user_ids_all.difference(vw_user_ids_all),
+        'user_ids_disabled_in_vw': vw_user_ids_disabled.intersection(ma_user_ids_enabled),
+        'user_ids_enabled_in_vw': vw_user_ids_enabled.intersection(ma_user_ids_disabled),
+        'users_with_changed_email': sorted(changed),
+        'adoption_candidates': sorted(vw_users_by_email[em].user_id for em in
+                                      source.intersection(vw_user_emails).difference(ma_users_emails_all_inv)),
+        'invite_emails': source.difference(vw_user_emails | ma_users_emails_all_inv | ma_user_emails_all_vw),
+        'disable_user_ids': {ma_id_by_email[ue] for ue in ma_user_emails_enabled.difference(source)},
+        # Unmanaged (disabled) Vaultwarden users used to raise a KeyError here
+        'enable_user_ids': {ma_id_by_email[ue] for ue in
+                            (ma_user_emails_disabled | vw_user_emails_disabled).intersection(source)
+                            if ue in ma_id_by_email},
+    }
+
+
+def as_comparable(sync_result: SyncResult):
+    return {
+        'email_vanished_in_src': sync_result.email_vanished_in_src,
+        'email_vanished_in_both': sync_result.email_vanished_in_both,
+        'user_ids_vanished_in_vw': sync_result.user_ids_vanished_in_vw,
+        'user_ids_disabled_in_vw': sync_result.user_ids_disabled_in_vw,
+        'user_ids_enabled_in_vw': sync_result.user_ids_enabled_in_vw,
+        'users_with_changed_email': sorted((c.user_id, c.old_email, c.new_email)
+                                           for c in sync_result.users_with_changed_email),
+        'adoption_candidates': sorted(u.user_id for u in sync_result.adoption_candidates),
+        'invite_emails': sync_result.pending_changes.invite_emails,
+        'disable_user_ids': sync_result.pending_changes.disable_user_ids,
+        'enable_user_ids': sync_result.pending_changes.enable_user_ids,
+    }
+
+
+class DiffEngineTest(unittest.TestCase):
+
+    @staticmethod
+    def random_inputs(rnd: random.Random, size: int):
+        emails = ['user{}@test.com'.format(i) for i in range(size)]
+        ids = ['ID_{}'.format(i) for i in range(size)]
+        vw_users = [VaultwardenUser(user_id=rnd.choice(ids), email=rnd.choice(emails), enabled=rnd.random() < 0.7)
+                    for _ in range(rnd.randint(0, size))]
+        ma_users = []
+        for _ in range(rnd.randint(0, size)):
+            invite_email = rnd.choice(emails)
+            ma_users.append(ManagedUser(vw_user_id=rnd.choice(ids), invite_email=invite_email,
+                                        vw_email=invite_email if rnd.random() < 0.8 else rnd.choice(emails),
+                                        enabled=rnd.random() < 0.7))
+        source = rnd.sample(emails, rnd.randint(0, size))
+        return vw_users, ma_users, source
+
+    def test_identical_to_legacy_diff(self):
+        rnd = random.Random(42)
+        for _ in range(500):
+            vw_users, ma_users, source = self.random_inputs(rnd, rnd.randint(1, 30))
+            self.assertEqual(legacy_diff(vw_users, ma_users, source),
+                             as_comparable(SyncResult.from_inputs(vw_users, ma_users, source)))
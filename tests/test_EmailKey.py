@@ -0,0 +1,106 @@
+import os
+import random
+import tempfile
+import unittest
+
+from tests import test_DiffEngine
+from vaultwarden_user_sync.backends.localstore import LocalStore, ManagedUser
+from vaultwarden_user_sync.backends.vaultwarden import VaultwardenUser
+from vaultwarden_user_sync.compare import SyncResult
+from vaultwarden_user_sync.email_key import EmailKeyRules, register_rule, RULES
+from vaultwarden_user_sync.streaming_diff import DiffSpill
+
+
+def respell(rnd: random.Random, email: str) -> str:
+    return (' ' if rnd.random() < 0.2 else '') + ''.join(c.upper() if rnd.random() < 0.3 else c for c in email)
+
+
+class EmailKeyRulesTest(unittest.TestCase):
+
+    def test_default(self):
+        self.assertEqual('john.doe@example.com', EmailKeyRules().key(' John.Doe@Example.COM\n'))
+        self.assertEqual('', EmailKeyRules().spec)
+
+    def test_domain_rules(self):
+        rules = EmailKeyRules.from_spec('gmail.com=plus,dots; googlemail.com=alias:GMail.com; *=plus:-')
+        self.assertEqual('johndoe@gmail.com', rules.key('John.Doe+vault@gmail.com'))
+        self.assertEqual('johndoe@gmail.com', rules.key('john.doe@googlemail.com'))
+        self.assertEqual('john.doe@example.com', rules.key('John.Doe-Vault@example.com'))
+        self.assertEqual('john+doe@example.com', rules.key('john+doe@example.com'))
+        self.assertEqual('not-an-address', rules.key('Not-An-Address'))
+        self.assertEqual('*=plus:-;gmail.com=plus,dots;googlemail.com=alias:GMail.com', rules.spec)
+        self.assertEqual(rules.spec, EmailKeyRules.from_spec(rules.spec).spec)
+
+    def test_unknown_rule(self):
+        with self.assertRaises(ValueError):
+            EmailKeyRules.from_spec('example.com=nonsense')
+
+    def test_register_rule(self):
+        register_rule('drop_digits', lambda local, domain, argument: (local.rstrip('0123456789'), domain))
+        try:
+            self.assertEqual('john@example.com',
+                             EmailKeyRules.from_spec('example.com=drop_digits').key('John42@example.com'))
+        finally:
+            del RULES['drop_digits']
+
+
+class KeyedDiffTest(unittest.TestCase):
+
+    def test_spelling_differences_match(self):
+        vw_users = [VaultwardenUser(user_id='ID_a', email='alice@example.com', enabled=True),
+                    VaultwardenUser(user_id='ID_b', email='bob@example.com', enabled=True)]
+        ma_users = [ManagedUser(vw_user_id='ID_a', vw_email='Alice@Example.com', invite_email='Alice@Example.com',
+                                enabled=True)]
+        source = ['ALICE@example.com ', 'Bob@Example.com', 'Carol+Vault@Example.com', 'carol@example.com']
+        sync_result = SyncResult.from_inputs(vw_users, ma_users, source)
+        self.assertEqual([], sync_result.users_with_changed_email)
+        self.assertEqual(set(), sync_result.pending_changes.disable_user_ids)
+        self.assertEqual(['ID_b'], [u.user_id for u in sync_result.adoption_candidates])
+        # Invites keep the address as returned by the source
+        self.assertEqual({'Carol+Vault@Example.com', 'carol@example.com'}, sync_result.pending_changes.invite_emails)
+
+        rules = EmailKeyRules.from_spec('example.com=plus')
+        self.assertEqual({'Carol+Vault@Example.com'},
+                         SyncResult.from_inputs(vw_users, ma_users, source, rules).pending_changes.invite_emails)
+
+    def test_streaming_identical_to_in_memory(self):
+        rnd = random.Random(11)
+        rules = EmailKeyRules.from_spec('test.com=plus')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for i in range(50):
+                vw_users, ma_users, source = test_DiffEngine.DiffEngineTest.random_inputs(rnd, rnd.randint(1, 20))
+                vw_users = [VaultwardenUser(user_id=u.user_id, email=respell(rnd, u.email), enabled=u.enabled)
+                            for u in vw_users]
+                source = [respell(rnd, email.replace('@', '+x@') if rnd.random() < 0.2 else email)
+                          for email in source]
+                ls = LocalStore(os.path.join(tmp_dir, 'test{}.sqlite'.format(i)), email_key=rules)
+                with ls.batch():
+                    for ma_user in {u.vw_user_id: u for u in ma_users}.values():
+                        ls.register_user(respell(rnd, ma_user.invite_email), ma_user.vw_user_id,
+                                         'ENABLED' if ma_user.enabled else 'DISABLED')
+                        ls.update_vw_email(ma_user.vw_user_id, respell(rnd, ma_user.vw_email))
+                with DiffSpill(tmp_dir, rules) as spill:
+                    spill.add_source_emails(source)
+                    spill.add_vw_users(vw_users)
+                    streamed = spill.diff(ls)
+                expected = SyncResult.from_inputs(vw_users, ls.get_all_managed_users(), source, rules)
+                self.assertEqual(test_DiffEngine.as_comparable(expected), test_DiffEngine.as_comparable(streamed))
+                ls.con.close()
+
+
+class LocalStoreKeysTest(unittest.TestCase):
+
+    def test_keys_recomputed_when_rules_change(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_file = os.path.join(tmp_dir, 'keys.sqlite')
+            ls = LocalStore(db_file)
+            ls.register_user('John+Vault@Example.com', 'ID_j')
+            self.assertEqual('john+vault@example.com', ls.get_all_managed_users()[0].invite_key)
+            ls.con.close()
+
+            ls = LocalStore(db_file, email_key=EmailKeyRules.from_spec('example.com=plus'))
+            user = ls.get_all_managed_users()[0]
+            self.assertEqual(('john@example.com', 'john@example.com'), (user.invite_key, user.vw_key))
+            ls.delete_user_by_email('JOHN@example.com')
+            self.assertEqual([], ls.get_all_managed_users())
+            ls.con.close()
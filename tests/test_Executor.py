@@ -0,0 +1,98 @@
+import asyncio
+import time
+import unittest
+
+from vaultwarden_user_sync.backends.vaultwarden import MockVaultwardenConnector
+from vaultwarden_user_sync.compare import ChangeSet
+from vaultwarden_user_sync.executor import ChangeExecutor, RateLimiter, ACTION_INVITE, ACTION_DISABLE
+
+
+class FailingVaultwardenConnector(MockVaultwardenConnector):
+
+    def disable_user(self, vw_user_id: str):
+        raise ConnectionError('Request returned unexpected return code expected: 200 actual: 500')
+
+
+class SlowVaultwardenConnector(MockVaultwardenConnector):
+
+    def __init__(self):
+        self.calls = 0
+
+    def invite_user(self, user_email: str) -> str:
+        self.calls += 1
+        time.sleep(0.05)
+        return super().invite_user(user_email)
+
+
+class ExecutorTest(unittest.TestCase):
+    vwc: MockVaultwardenConnector = None
+
+    @classmethod
+    def setUp(cls) -> None:
+        cls.vwc = MockVaultwardenConnector()
+        cls.vwc.clear_test_data()
+
+    def test_all_changes_applied(self):
+        user_id = self.vwc.invite_user('existing@test.com')
+        change_set = ChangeSet(invite_emails={'user{}@test.com'.format(i) for i in range(20)},
+                               disable_user_ids={user_id})
+        results = list(ChangeExecutor(self.vwc, max_workers=4).run(change_set))
+
+        self.assertEqual(21, len(results))
+        self.assertTrue(all(result.ok for result in results))
+        invited = {result.target: result.user_id for result in results if result.action == ACTION_INVITE}
+        self.assertEqual(change_set.invite_emails, set(invited.keys()))
+        self.assertFalse(self.vwc._vw_user_by_id[user_id].enabled)
+        self.assertEqual(21, len(self.vwc.get_all_users()))
+
+    def test_failures_are_collected_per_user(self):
+        vwc = FailingVaultwardenConnector()
+        vwc.clear_test_data()
+        change_set = ChangeSet(invite_emails={'new@test.com'}, disable_user_ids={'ID_a', 'ID_b'})
+        results = list(ChangeExecutor(vwc, max_workers=2).run(change_set))
+
+        failed = {result.target for result in results if not result.ok}
+        self.assertEqual({'ID_a', 'ID_b'}, failed)
+        self.assertTrue(all(result.action == ACTION_DISABLE for result in results if not result.ok))
+        vwc.clear_test_data()
+
+    def test_rate_limit(self):
+        limiter = RateLimiter(max_per_second=50)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.acquire()
+        # first call passes immediately, the others are spaced 20ms apart
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_early_exit_drops_pending_calls(self):
+        vwc = SlowVaultwardenConnector()
+        vwc.clear_test_data()
+        change_set = ChangeSet(invite_emails={'user{}@test.com'.format(i) for i in range(40)})
+        results = ChangeExecutor(vwc, max_workers=2).run(change_set)
+        start = time.monotonic()
+        next(results)
+        results.close()
+        # Only the calls in flight were completed, not the remaining queue (40 calls take 1s on 2 workers)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertLessEqual(vwc.calls, 4)
+        vwc.clear_test_data()
+
+    def test_early_exit_drops_pending_calls_async(self):
+        vwc = SlowVaultwardenConnector()
+        vwc.clear_test_data()
+        change_set = ChangeSet(invite_emails={'user{}@test.com'.format(i) for i in range(40)})
+
+        async def first_result():
+            results = ChangeExecutor(vwc, max_workers=2).run_async(change_set)
+            await results.__anext__()
+            await results.aclose()
+
+        start = time.monotonic()
+        asyncio.run(first_result())
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertLessEqual(vwc.calls, 4)
+        vwc.clear_test_data()
+
+    @classmethod
+    def tearDown(cls) -> None:
+        cls.vwc.clear_test_data()
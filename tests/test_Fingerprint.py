@@ -0,0 +1,37 @@
+import unittest
+
+from vaultwarden_user_sync.backends.localstore import LocalStore
+from vaultwarden_user_sync.backends.vaultwarden import VaultwardenUser
+from vaultwarden_user_sync.fingerprint import CycleFingerprint, multiset_hash
+
+
+class FingerprintTest(unittest.TestCase):
+    vw_users = [VaultwardenUser(user_id='1', email='a@test.com', enabled=True),
+                VaultwardenUser(user_id='2', email='b@test.com', enabled=False)]
+
+    def test_order_independent(self):
+        self.assertEqual(multiset_hash(['a', 'b', 'c']), multiset_hash(['c', 'a', 'b']))
+        self.assertNotEqual(multiset_hash(['a', 'b']), multiset_hash(['a', 'b', 'b']))
+        self.assertEqual(CycleFingerprint.compute(['a@test.com', 'b@test.com'], self.vw_users, 3),
+                         CycleFingerprint.compute(['b@test.com', 'a@test.com'], list(reversed(self.vw_users)), 3))
+
+    def test_changes_detected(self):
+        fingerprint = CycleFingerprint.compute(['a@test.com'], self.vw_users, 3)
+        self.assertNotEqual(fingerprint, CycleFingerprint.compute(['a@test.com', 'c@test.com'], self.vw_users, 3))
+        self.assertNotEqual(fingerprint, CycleFingerprint.compute(['a@test.com'], self.vw_users, 4))
+        self.assertNotEqual(fingerprint, CycleFingerprint.compute(['a@test.com'], self.vw_users, 3, 'cleanup=1'))
+        enabled = [VaultwardenUser(user_id='1', email='a@test.com', enabled=True),
+                   VaultwardenUser(user_id='2', email='b@test.com', enabled=True)]
+        self.assertNotEqual(fingerprint, CycleFingerprint.compute(['a@test.com'], enabled, 3))
+
+    def test_users_version(self):
+        ls = LocalStore("file::test_fingerprint:?cache=shared&mode=memory")
+        version = ls.get_users_version()
+        ls.register_user('a@test.com', 'ID_a')
+        ls.set_user_state('ID_a', 'DISABLED')
+        ls.update_vw_email('ID_a', 'b@test.com')
+        ls.delete_user_by_id('ID_a')
+        self.assertEqual(version + 4, ls.get_users_version())
+        ls.set_meta('cycle_fingerprint', 'abc')
+        self.assertEqual(version + 4, ls.get_users_version())
+        self.assertEqual('abc', ls.get_meta('cycle_fingerprint'))
@@ -0,0 +1,36 @@
+import json
+import random
+import unittest
+
+from vaultwarden_user_sync.backends.json_stream import iter_json_array
+
+
+def split(raw: bytes, size: int):
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+class JsonStreamTest(unittest.TestCase):
+
+    def test_any_chunk_size(self):
+        rnd = random.Random(3)
+        for _ in range(200):
+            document = [{'id': str(i), 'email': 'usér{}@test.com'.format(i), 'userEnabled': rnd.random() < 0.5,
+                         'organizations': [{'id': 1, 'name': 'Org [1], "a"'}], 'score': rnd.random()}
+                        for i in range(rnd.randint(0, 10))] + [rnd.randint(0, 10 ** 12)]
+            raw = json.dumps(document, indent=rnd.choice([None, 2]), ensure_ascii=rnd.random() < 0.5).encode()
+            self.assertEqual(document, list(iter_json_array(split(raw, rnd.randint(1, 50)))))
+
+    def test_empty(self):
+        self.assertEqual([], list(iter_json_array([b' [ ', b' ] '])))
+
+    def test_malformed(self):
+        for raw in [b'', b'{}', b'[', b'[1,', b'[1,]', b'[1 2]', b'[1] 2', b'[{"id": ]']:
+            with self.assertRaises(ValueError, msg=raw):
+                list(iter_json_array(split(raw, 2)))
+
+    def test_lazy(self):
+        def chunks():
+            yield b'[1, 2, '
+            raise AssertionError('read too far')
+
+        self.assertEqual(1, next(iter_json_array(chunks())))
@@ -0,0 +1,357 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from typing import Dict, List, Tuple, Union
+from unittest import mock
+
+from tests import ldap_stub
+
+# python-ldap needs the OpenLDAP client libraries to build, without it the connectors are tested against a stand-in
+ldap_stub.install()
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+from ldap.syncrepl import SyncRequestControl, SyncStateControl, SyncDoneControl
+
+from vaultwarden_user_sync.backends.localstore import LocalStore
+from vaultwarden_user_sync.email_sources.ldap import LdapConnector, IncrementalLdapConnector
+
+LDAP_ENV = {'LDAP_SERVER': 'dc1.example.com', 'LDAP_BIND_DN': 'cn=sync,dc=example,dc=com', 'LDAP_BIND_PW': 'secret',
+            'LDAP_BASE_DN': 'dc=example,dc=com', 'LDAP_SEARCH_FILTER': '(objectClass=person)',
+            'LDAP_EMAIL_ATTR': 'mail'}
+
+
+def make_entries(count: int) -> List[Tuple[str, dict]]:
+    return [('uid=user{},dc=example,dc=com'.format(i),
+             {'mail': ['user{}@example.com'.format(i).encode()], 'cn': [b'User'], 'objectClass': [b'person']})
+            for i in range(count)]
+
+
+class FakeDirectory:
+    """
+    Stands in for a bound python-ldap connection. Honors the requested attributes and the Simple Paged Results control,
+    the cookie is the offset of the next page.
+    """
+
+    def __init__(self, entries: List[Tuple[str, dict]], paging: bool = True, delay: float = 0.0):
+        self.entries = entries
+        self.paging = paging
+        # Seconds each search (page) takes
+        self.delay = delay
+        # (base DN, filter, attributes, cookie) of each search
+        self.searches = []
+        self.error = None
+        self.unbound = False
+        self._results = {}
+
+    def _select(self, attrlist, start: int = 0, size: int = None) -> List[Tuple[str, dict]]:
+        selected = self.entries[start:] if size is None else self.entries[start:start + size]
+        return [(dn, {key: value for key, value in attrs.items() if attrlist is None or key in attrlist})
+                for dn, attrs in selected]
+
+    def search_ext(self, base, scope, filterstr, attrlist=None, serverctrls=None):
+        if self.error:
+            raise self.error
+        page = next((control for control in serverctrls or []
+                     if control.controlType == SimplePagedResultsControl.controlType), None)
+        self.searches.append((base, filterstr, attrlist, page.cookie if page else None))
+        if page is None or not self.paging:
+            result, controls = self._select(attrlist), []
+        else:
+            start = int(page.cookie or 0)
+            result = self._select(attrlist, start, page.size)
+            more = start + page.size < len(self.entries)
+            controls = [SimplePagedResultsControl(criticality=False, size=page.size,
+                                                  cookie=str(start + page.size).encode() if more else b'')]
+        self._results[len(self.searches)] = result, controls
+        return len(self.searches)
+
+    def result3(self, msg_id):
+        time.sleep(self.delay)
+        result, controls = self._results.pop(msg_id)
+        return ldap.RES_SEARCH_RESULT, result, msg_id, controls
+
+    def search_s(self, base, scope, filterstr, attrlist=None):
+        if base == '':
+            # Root DSE, read by the liveness probe
+            return [('', {})]
+        if self.error:
+            raise self.error
+        self.searches.append((base, filterstr, attrlist, None))
+        return self._select(attrlist)
+
+    def unbind_s(self):
+        self.unbound = True
+
+
+def sync_control(control_class, **attrs):
+    """
+    Response control as decoded by python-ldap
+    """
+    control = control_class()
+    control.__dict__.update(attrs)
+    return control
+
+
+class FakeSyncDirectory:
+    """
+    Stands in for a bound python-ldap connection of a server supporting content synchronization (RFC 4533,
+    refreshOnly). The cookie is the number of changes made so far. Changes since a cookie are sent with delete states
+    (refreshDeletes), or in present_phase mode as the changed entries plus a present state for every unchanged one.
+    """
+
+    def __init__(self):
+        # entryUUID -> (DN, email)
+        self.entries = {}
+        # entryUUID of each change
+        self.changes = []
+        self.present_phase = False
+        # Oldest cookie the server still has the changes for
+        self.oldest_cookie = 0
+        # Cookie sent with each search
+        self.searches = []
+        self._results = {}
+
+    def add(self, entry_uuid: str, email: str):
+        self.entries[entry_uuid] = ('uid={},dc=example,dc=com'.format(entry_uuid), email)
+        self.changes.append(entry_uuid)
+
+    def delete(self, entry_uuid: str):
+        del self.entries[entry_uuid]
+        self.changes.append(entry_uuid)
+
+    def _entry(self, entry_uuid: str, state: str) -> tuple:
+        dn, email = self.entries.get(entry_uuid, ('uid={},dc=example,dc=com'.format(entry_uuid), None))
+        attrs = {'mail': [email.encode()]} if email and state in ['add', 'modify'] else {}
+        return dn, attrs, [sync_control(SyncStateControl, state=state, entryUUID=entry_uuid, cookie=None)]
+
+    def search_ext(self, base, scope, filterstr, attrlist=None, serverctrls=None):
+        request = next(control for control in serverctrls if isinstance(control, SyncRequestControl))
+        self.searches.append(request.cookie)
+        since = int(request.cookie) if request.cookie is not None else None
+        if since is not None and since < self.oldest_cookie:
+            raise ldap.OTHER({'desc': 'Other (e.g., implementation specific) error', 'info': 'e-syncRefreshRequired'})
+        if since is None:
+            entries, refresh_deletes = [self._entry(entry_uuid, 'add') for entry_uuid in self.entries], False
+        else:
+            changed = set(self.changes[since:])
+            entries = [self._entry(entry_uuid, 'modify') for entry_uuid in self.entries if entry_uuid in changed]
+            if self.present_phase:
+                entries += [self._entry(entry_uuid, 'present') for entry_uuid in self.entries
+                            if entry_uuid not in changed]
+            else:
+                entries += [self._entry(entry_uuid, 'delete') for entry_uuid in changed
+                            if entry_uuid not in self.entries]
+            refresh_deletes = not self.present_phase
+        done = sync_control(SyncDoneControl, cookie=str(len(self.changes)).encode(), refreshDeletes=refresh_deletes)
+        self._results[len(self.searches)] = [(ldap.RES_SEARCH_ENTRY, entries, []),
+                                             (ldap.RES_SEARCH_RESULT, [], [done])]
+        return len(self.searches)
+
+    def result4(self, msg_id, all=0, add_ctrls=0, add_intermediates=0):
+        result_type, result_data, controls = self._results[msg_id].pop(0)
+        return result_type, result_data, msg_id, controls, None, None
+
+    def search_s(self, base, scope, filterstr, attrlist=None):
+        # Root DSE, read by the liveness probe
+        return [('', {})]
+
+    def unbind_s(self):
+        pass
+
+
+class LdapConnectorTest(unittest.TestCase):
+
+    def connector(self, directory: Union[FakeDirectory, Dict[str, FakeDirectory]], **env) -> LdapConnector:
+        """
+        :param directory: The directory all servers serve, or the one of each server
+        """
+        with mock.patch.dict(os.environ, dict(LDAP_ENV, **env)):
+            connector = LdapConnector('LDAP')
+        # Servers bound to, in order
+        self.binds = []
+
+        def bind(server: str) -> FakeDirectory:
+            self.binds.append(server)
+            return directory[server] if isinstance(directory, dict) else directory
+
+        connector._bind = bind
+        return connector
+
+    def test_paged_search(self):
+        directory = FakeDirectory(make_entries(1050))
+        emails = self.connector(directory, LDAP_PAGE_SIZE='500').get_email_list()
+        self.assertEqual(['user{}@example.com'.format(i) for i in range(1050)], emails)
+        self.assertEqual(['', b'500', b'1000'], [search[3] for search in directory.searches])
+        # Only the email attribute is requested
+        self.assertTrue(all(search[2] == ['mail'] for search in directory.searches))
+
+    def test_last_page_full(self):
+        directory = FakeDirectory(make_entries(1000))
+        self.assertEqual(1000, len(self.connector(directory, LDAP_PAGE_SIZE='500').get_email_list()))
+        self.assertEqual(2, len(directory.searches))
+
+    def test_server_without_paging(self):
+        directory = FakeDirectory(make_entries(30), paging=False)
+        self.assertEqual(30, len(self.connector(directory, LDAP_PAGE_SIZE='10').get_email_list()))
+        self.assertEqual(1, len(directory.searches))
+
+    def test_paging_disabled(self):
+        directory = FakeDirectory(make_entries(30))
+        self.assertEqual(30, len(self.connector(directory, LDAP_PAGE_SIZE='0').get_email_list()))
+        self.assertEqual([('dc=example,dc=com', '(objectClass=person)', ['mail'], None)], directory.searches)
+
+    def test_streaming(self):
+        directory = FakeDirectory(make_entries(25))
+        emails = self.connector(directory, LDAP_PAGE_SIZE='10').iter_email_list()
+        self.assertEqual('user0@example.com', next(emails))
+        # The next page is only requested once the first one is consumed
+        self.assertEqual(1, len(directory.searches))
+        self.assertEqual(24, len(list(emails)))
+        self.assertEqual(3, len(directory.searches))
+
+    def test_entries_without_email_skipped(self):
+        entries = make_entries(3)
+        del entries[1][1]['mail']
+        directory = FakeDirectory(entries)
+        self.assertEqual(['user0@example.com', 'user2@example.com'], self.connector(directory).get_email_list())
+
+    def test_no_such_object(self):
+        directory = FakeDirectory(make_entries(3))
+        directory.error = ldap.NO_SUCH_OBJECT({'desc': 'No such object'})
+        self.assertEqual([], self.connector(directory).get_email_list())
+
+    def test_failover_to_other_server(self):
+        directories = {'dc1': FakeDirectory(make_entries(3)), 'dc2': FakeDirectory(make_entries(3))}
+        connector = self.connector(directories, LDAP_SERVER='dc1,dc2')
+        connector.server_pool.record_success('dc1', 0.1)
+        connector.server_pool.record_success('dc2', 0.2)
+        directories['dc1'].error = ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+
+        # dc1 is not ejected after a single failure and still ranks first, the search is repeated on dc2 nonetheless
+        self.assertEqual(3, len(connector.get_email_list()))
+        self.assertEqual(['dc1', 'dc2'], self.binds)
+        self.assertEqual(1, len(directories['dc2'].searches))
+        self.assertEqual(['dc1', 'dc2'], connector.server_pool.candidates())
+
+    def test_slow_search_server_given_up(self):
+        directories = {'dc1': FakeDirectory(make_entries(30), delay=0.05), 'dc2': FakeDirectory(make_entries(30))}
+        connector = self.connector(directories, LDAP_SERVER='dc1,dc2', LDAP_PAGE_SIZE='10')
+        # dc1 binds faster, but its searches are slow
+        connector.server_pool.record_success('dc1', 0.001)
+        connector.server_pool.record_success('dc2', 0.002)
+        connector.get_email_list()
+        self.assertEqual(['dc1'], self.binds)
+        self.assertGreater(connector.server_pool.get_stats()['dc1']['latency'], 0.01)
+
+        # The kept connection is given up for the faster server
+        connector.get_email_list()
+        self.assertEqual(['dc1', 'dc2'], self.binds)
+        self.assertEqual(3, len(directories['dc2'].searches))
+        connector.get_email_list()
+        self.assertEqual(['dc1', 'dc2'], self.binds)
+        self.assertEqual({'opened': 1, 'reused': 1, 'reopened': 1}, connector.bind_stats)
+
+    def test_persistent_connection(self):
+        connector = self.connector(FakeDirectory(make_entries(3)))
+        connector.get_email_list()
+        connector.get_email_list()
+        self.assertEqual(1, len(self.binds))
+        self.assertEqual({'opened': 1, 'reused': 1, 'reopened': 0}, connector.bind_stats)
+
+        connector.ldap_idle_timeout = -1
+        connector.get_email_list()
+        self.assertEqual(1, connector.bind_stats['reopened'])
+        connector.close()
+        self.assertIsNone(connector._conn)
+
+    def test_slow_consumer_does_not_block(self):
+        directory = FakeDirectory(make_entries(25))
+        connector = self.connector(directory, LDAP_PAGE_SIZE='10')
+        connector.get_email_list()
+        slow = connector.iter_email_list()
+        next(slow)
+
+        # Another user of the connector (here: another tenant) gets a connection of its own
+        results = []
+        other = threading.Thread(target=lambda: results.append(connector.get_email_list()), daemon=True)
+        other.start()
+        other.join(timeout=5)
+        self.assertEqual([25], [len(emails) for emails in results])
+        self.assertEqual(2, len(self.binds))
+
+        # Returned while another connection is persistent: Closed
+        directory.unbound = False
+        self.assertEqual(24, len(list(slow)))
+        self.assertTrue(directory.unbound)
+        self.assertIsNotNone(connector._conn)
+
+
+class IncrementalLdapConnectorTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.ls = LocalStore(os.path.join(self.tmp_dir.name, 'test.sqlite'))
+        self.directory = FakeSyncDirectory()
+        for i in range(5):
+            self.directory.add('uuid{}'.format(i), 'user{}@example.com'.format(i))
+        with mock.patch.dict(os.environ, dict(LDAP_ENV, LDAP_INCREMENTAL_MODE='syncrepl')):
+            self.connector = IncrementalLdapConnector('LDAP', self.ls)
+        self.connector._bind = lambda server: self.directory
+
+    def tearDown(self) -> None:
+        self.ls.con.close()
+        self.tmp_dir.cleanup()
+
+    def emails(self) -> List[str]:
+        return sorted(self.connector.get_email_list())
+
+    def test_full_sync(self):
+        self.assertEqual(['user{}@example.com'.format(i) for i in range(5)], self.emails())
+        self.assertEqual([None], self.directory.searches)
+        state = self.ls.get_source_sync_state('LDAP')
+        self.assertEqual(b'5', state.cookie)
+        self.assertEqual('dc1.example.com', state.server)
+
+    def test_incremental_sync(self):
+        self.emails()
+        self.directory.add('uuid5', 'user5@example.com')
+        self.directory.add('uuid1', 'renamed1@example.com')
+        self.assertEqual(['renamed1@example.com', 'user0@example.com', 'user2@example.com', 'user3@example.com',
+                          'user4@example.com', 'user5@example.com'], self.emails())
+        self.assertEqual([None, b'5'], self.directory.searches)
+        # Nothing changed: Nothing transferred, nothing lost
+        self.assertEqual(6, len(self.emails()))
+        self.assertEqual(b'7', self.directory.searches[-1])
+
+    def test_delete_detected(self):
+        self.emails()
+        self.directory.delete('uuid2')
+        self.assertNotIn('user2@example.com', self.emails())
+        self.assertEqual(4, len(self.ls.get_source_entry_ids('LDAP')))
+
+    def test_delete_detected_present_phase(self):
+        self.emails()
+        self.directory.present_phase = True
+        self.directory.delete('uuid2')
+        self.directory.add('uuid5', 'user5@example.com')
+        emails = self.emails()
+        self.assertNotIn('user2@example.com', emails)
+        self.assertIn('user5@example.com', emails)
+        self.assertEqual(5, len(emails))
+
+    def test_stale_cookie_full_resync(self):
+        self.emails()
+        self.directory.delete('uuid0')
+        self.directory.add('uuid5', 'user5@example.com')
+        # The server dropped the changes since our cookie
+        self.directory.oldest_cookie = 6
+        self.assertEqual(['user{}@example.com'.format(i) for i in range(1, 6)], self.emails())
+        self.assertEqual([None, b'5', None], self.directory.searches)
+        self.assertEqual(b'7', self.ls.get_source_sync_state('LDAP').cookie)
+
+
+if __name__ == '__main__':
+    unittest.main()
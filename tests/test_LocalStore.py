@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from vaultwarden_user_sync.backends.localstore import LocalStore, SourceSyncState
+from vaultwarden_user_sync.backends.migrations import MIGRATIONS, get_schema_version
+
+
+class LocalStoreTest(unittest.TestCase):
+    ls: LocalStore = None
+
+    @classmethod
+    def setUp(cls) -> None:
+        cls.ls = LocalStore("file::test_localstore:?cache=shared&mode=memory")
+        cls.ls.init_db()
+
+    def test_source_full_sync(self):
+        state = SourceSyncState(source_name='LDAP', cookie='c1', watermark=None, last_full_sync=1.0, server='dc1')
+        self.ls.apply_source_changes(state, {'uuid1': 'a@test.com', 'uuid2': 'b@test.com'}, replace_all=True)
+        self.assertEqual({'a@test.com', 'b@test.com'}, set(self.ls.get_source_emails('LDAP')))
+        self.assertEqual(state, self.ls.get_source_sync_state('LDAP'))
+
+    def test_source_incremental_sync(self):
+        state = SourceSyncState(source_name='LDAP', cookie=None, watermark='10', last_full_sync=1.0)
+        self.ls.apply_source_changes(state, {'dn1': 'a@test.com', 'dn2': 'b@test.com'}, replace_all=True)
+
+        state.watermark = '12'
+        self.ls.apply_source_changes(state, {'dn1': 'a_new@test.com', 'dn3': 'c@test.com'}, deletes=['dn2'])
+        self.assertEqual({'a_new@test.com', 'c@test.com'}, set(self.ls.get_source_emails('LDAP')))
+        self.assertEqual('12', self.ls.get_source_sync_state('LDAP').watermark)
+        self.assertEqual([], self.ls.get_source_emails('OTHER'))
+        self.assertIsNone(self.ls.get_source_sync_state('OTHER'))
+
+    def test_batch_commits_once(self):
+        version = self.ls.get_users_version()
+        with self.ls.batch():
+            self.ls.register_user('a@test.com', 'ID_a')
+            self.ls.register_user('b@test.com', 'ID_b')
+            self.ls.set_user_state('ID_a', 'DISABLED')
+            # Not yet written
+            self.assertEqual(version, self.ls.get_users_version())
+        users = {user.vw_user_id: user for user in self.ls.get_all_managed_users()}
+        self.assertEqual({'ID_a', 'ID_b'}, set(users.keys()))
+        self.assertFalse(users['ID_a'].enabled)
+
+    def test_batch_rollback(self):
+        self.ls.register_user('a@test.com', 'ID_a')
+        with self.assertRaises(RuntimeError):
+            with self.ls.batch():
+                self.ls.set_user_state('ID_a', 'DISABLED')
+                self.ls.register_user('b@test.com', 'ID_b')
+                raise RuntimeError('cycle aborted')
+        users = self.ls.get_all_managed_users()
+        self.assertEqual(1, len(users))
+        self.assertTrue(users[0].enabled)
+
+    def test_batch_flush_every(self):
+        with self.ls.batch(flush_every=2):
+            self.ls.register_user('a@test.com', 'ID_a')
+            self.ls.register_user('b@test.com', 'ID_b')
+            self.assertEqual(2, len(self.ls.get_all_managed_users()))
+            self.ls.register_user('c@test.com', 'ID_c')
+        self.assertEqual(3, len(self.ls.get_all_managed_users()))
+
+    def test_duplicate_registration_rejected(self):
+        self.ls.register_user('a@test.com', 'ID_a')
+        with self.assertLogs(level='WARNING'):
+            self.ls.register_user('other@test.com', 'ID_a')
+        with self.assertLogs(level='WARNING'):
+            with self.ls.batch():
+                self.ls.register_user('b@test.com', 'ID_b')
+                self.ls.register_user('other@test.com', 'ID_a')
+        self.assertEqual({'a@test.com', 'b@test.com'},
+                         {user.invite_email for user in self.ls.get_all_managed_users()})
+
+    def test_lookups_use_indexes(self):
+        for sql in ['UPDATE Users SET state = 1 WHERE vw_user_id = 1', 'DELETE FROM Users WHERE vw_key = 1',
+                    'SELECT * FROM Users WHERE invite_key = 1', 'SELECT * FROM Users WHERE invite_email = 1']:
+            plan = ' '.join(row[-1] for row in self.ls.con.execute('EXPLAIN QUERY PLAN ' + sql))
+            self.assertIn('INDEX', plan, sql)
+
+    def test_upgrade_legacy_database(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_file = os.path.join(tmp_dir, 'legacy.sqlite')
+            con = sqlite3.connect(db_file)
+            # Schema as created before versioned migrations were introduced
+            con.execute(MIGRATIONS[0][0])
+            con.executemany('INSERT INTO Users (invite_email, vw_email, vw_user_id, last_touched, state) '
+                            'VALUES (?,?,?,?,?)', [('a@test.com', 'a@test.com', 'ID_a', '1', 'ENABLED'),
+                                                   ('a@test.com', 'a@test.com', 'ID_a', '2', 'DISABLED'),
+                                                   ('b@test.com', 'b@test.com', 'ID_b', '1', 'ENABLED')])
+            con.commit()
+            con.close()
+
+            ls = LocalStore(db_file)
+            self.assertEqual(len(MIGRATIONS), get_schema_version(ls.con))
+            users = {user.vw_user_id: user for user in ls.get_all_managed_users()}
+            self.assertEqual({'ID_a', 'ID_b'}, set(users.keys()))
+            self.assertFalse(users['ID_a'].enabled)
+            # Triggers survive the table rebuild
+            version = ls.get_users_version()
+            ls.delete_user_by_id('ID_b')
+            self.assertEqual(version + 1, ls.get_users_version())
+            ls.con.close()
+
+    @classmethod
+    def tearDown(cls) -> None:
+        cls.ls.con.execute('DELETE FROM SourceEntries;')
+        cls.ls.con.execute('DELETE FROM SourceSyncState;')
+        cls.ls.truncate()
@@ -0,0 +1,105 @@
+import threading
+import time
+import unittest
+from typing import List
+
+from vaultwarden_user_sync.email_sources import EmailSource
+from vaultwarden_user_sync.email_sources.merged import MergedEmailSource
+
+DELAY = 0.2
+
+
+class StaticSource(EmailSource):
+
+    def __init__(self, source_name: str, emails: List[str], delay: float = 0.0, error: Exception = None):
+        super().__init__(source_name)
+        self.emails = emails
+        self.delay = delay
+        self.error = error
+        self.fetch_thread = None
+
+    def get_email_list(self) -> List[str]:
+        self.fetch_thread = threading.current_thread()
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return list(self.emails)
+
+
+class MergedEmailSourceTest(unittest.TestCase):
+
+    def test_fetched_concurrently_and_merged(self):
+        merged = MergedEmailSource('merged', [StaticSource('a', ['1@test.com', '2@test.com'], DELAY),
+                                              StaticSource('b', ['2@test.com', '3@test.com'], DELAY)])
+        start = time.perf_counter()
+        self.assertEqual(['1@test.com', '2@test.com', '3@test.com'], merged.get_email_list())
+        self.assertLess(time.perf_counter() - start, 2 * DELAY)
+        durations = merged.get_fetch_durations()
+        self.assertEqual({'a', 'b'}, set(durations))
+        self.assertGreaterEqual(durations['a'], DELAY)
+        merged.close()
+
+    def test_failing_source_aborts(self):
+        merged = MergedEmailSource('merged', [StaticSource('a', ['1@test.com']),
+                                              StaticSource('b', [], error=ConnectionError('LDAP down'))])
+        with self.assertRaises(ConnectionError):
+            merged.get_email_list()
+        merged.close()
+
+    def test_timeout(self):
+        merged = MergedEmailSource('merged', [StaticSource('a', ['1@test.com']), StaticSource('b', [], DELAY)],
+                                   timeouts={'b': DELAY / 4})
+        start = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            merged.get_email_list()
+        self.assertLess(time.perf_counter() - start, DELAY)
+        merged.close()
+
+    def test_timed_out_source_not_resubmitted(self):
+        slow = StaticSource('b', ['2@test.com'], DELAY)
+        merged = MergedEmailSource('merged', [StaticSource('a', ['1@test.com']), slow], timeouts={'b': DELAY / 4})
+        with self.assertRaises(TimeoutError):
+            merged.get_email_list()
+        fetches = []
+        slow.get_email_list = lambda: fetches.append(1) or StaticSource.get_email_list(slow)
+        # The first fetch of b still runs: Fails fast instead of queueing another one behind it
+        with self.assertRaisesRegex(TimeoutError, 'still busy'):
+            merged.get_email_list()
+        self.assertEqual([], fetches)
+
+        time.sleep(DELAY)
+        merged.timeouts = {}
+        self.assertEqual(['1@test.com', '2@test.com'], merged.get_email_list())
+        self.assertEqual([1], fetches)
+        merged.close()
+
+    def test_not_thread_safe_source_on_calling_thread(self):
+        bound = StaticSource('bound', ['1@test.com'], DELAY)
+        bound.thread_safe = False
+        other = StaticSource('other', ['2@test.com'], DELAY)
+        merged = MergedEmailSource('merged', [bound, other])
+        self.assertFalse(merged.thread_safe)
+        start = time.perf_counter()
+        self.assertEqual(['1@test.com', '2@test.com'], merged.get_email_list())
+        self.assertLess(time.perf_counter() - start, 2 * DELAY)
+        self.assertIs(threading.current_thread(), bound.fetch_thread)
+        self.assertIsNot(threading.current_thread(), other.fetch_thread)
+        merged.close()
+
+    def test_timeout_independent_of_calling_thread_sources(self):
+        bound = StaticSource('bound', ['1@test.com'], DELAY)
+        bound.thread_safe = False
+        # Done long before the bound source, but later than its own deadline
+        late = StaticSource('late', ['2@test.com'], DELAY / 2)
+        merged = MergedEmailSource('merged', [bound, late], timeouts={'late': DELAY / 4})
+        with self.assertRaisesRegex(TimeoutError, 'late'):
+            merged.get_email_list()
+
+        # The bound source does not eat into the deadline of the others
+        merged.timeouts = {'late': DELAY * 0.75}
+        self.assertEqual(['1@test.com', '2@test.com'], merged.get_email_list())
+        merged.close()
+
+    def test_unique_names(self):
+        with self.assertRaises(ValueError):
+            MergedEmailSource('merged', [StaticSource('a', []), StaticSource('a', [])])
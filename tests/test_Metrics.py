@@ -0,0 +1,77 @@
+import unittest
+import urllib.error
+import urllib.request
+
+from vaultwarden_user_sync.compare import SyncResult, ChangeSet
+from vaultwarden_user_sync.cycle import CycleReport
+from vaultwarden_user_sync.metrics import SyncMetrics, MetricsServer
+
+
+class MetricsTest(unittest.TestCase):
+
+    def report(self) -> CycleReport:
+        sync_result = SyncResult(user_ids_disabled_in_vw={'ID_a', 'ID_b'},
+                                 pending_changes=ChangeSet(invite_emails={'c@test.com'}))
+        return CycleReport(sync_result=sync_result, phase_durations={'source_fetch': 0.5, 'diff': 0.25})
+
+    def test_render(self):
+        metrics = SyncMetrics(max_age=60, transport_stats=lambda: {
+            'requests': 7, 'retries': 2, 'failures': 1, 'circuit_trips': 0, 'circuit_rejected': 0})
+        metrics.observe_cycle(self.report())
+        metrics.observe_cycle(CycleReport(skipped=True, phase_durations={'source_fetch': 0.25}))
+        metrics.observe_error(ConnectionError('down'))
+        text = metrics.render()
+
+        self.assertIn('vus_cycles_total{outcome="success"} 1', text)
+        self.assertIn('vus_cycles_total{outcome="skipped"} 1', text)
+        self.assertIn('vus_cycles_total{outcome="error"} 1', text)
+        self.assertIn('vus_phase_duration_seconds_sum{phase="source_fetch"} 0.75', text)
+        self.assertIn('vus_phase_duration_seconds_count{phase="source_fetch"} 2', text)
+        self.assertIn('vus_last_cycle_phase_duration_seconds{phase="source_fetch"} 0.25', text)
+        self.assertIn('vus_sync_result_users{category="user_ids_disabled_in_vw"} 2', text)
+        self.assertIn('vus_pending_changes{action="invite"} 0', text)
+        self.assertIn('vus_vaultwarden_retries_total 2', text)
+        self.assertIn('# TYPE vus_phase_duration_seconds summary', text)
+
+    def test_health(self):
+        metrics = SyncMetrics(max_age=60)
+        self.assertTrue(metrics.is_live())
+        self.assertFalse(metrics.is_ready())
+        metrics.observe_cycle(self.report())
+        self.assertTrue(metrics.is_ready())
+        metrics.last_success -= 120
+        self.assertFalse(metrics.is_live())
+
+    def test_safe_guard_is_not_success(self):
+        metrics = SyncMetrics(max_age=60)
+        metrics.observe_cycle(self.report())
+        self.assertTrue(metrics.last_cycle_succeeded)
+        last_success = metrics.last_success
+        metrics.observe_cycle(CycleReport(sync_result=self.report().sync_result, safe_guard_exceeded=True))
+        self.assertEqual(last_success, metrics.last_success)
+        self.assertFalse(metrics.last_cycle_succeeded)
+        self.assertIn('vus_cycles_total{outcome="safe_guard_exceeded"} 1', metrics.render())
+        metrics.last_success -= 120
+        self.assertFalse(metrics.is_live())
+
+        # Never ready while the safe guard stops every cycle
+        metrics = SyncMetrics(max_age=60)
+        metrics.observe_cycle(CycleReport(safe_guard_exceeded=True))
+        self.assertFalse(metrics.is_ready())
+        self.assertFalse(metrics.last_cycle_succeeded)
+
+    def test_server(self):
+        metrics = SyncMetrics(max_age=60)
+        server = MetricsServer(metrics, host='127.0.0.1', port=0).start()
+        url = 'http://127.0.0.1:{}'.format(server.port)
+        try:
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(url + '/readyz')
+            self.assertEqual(503, context.exception.code)
+            metrics.observe_cycle(self.report())
+            self.assertEqual(200, urllib.request.urlopen(url + '/readyz').status)
+            self.assertEqual(200, urllib.request.urlopen(url + '/healthz').status)
+            body = urllib.request.urlopen(url + '/metrics').read().decode()
+            self.assertIn('vus_up 1', body)
+        finally:
+            server.stop()
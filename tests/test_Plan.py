@@ -0,0 +1,146 @@
+import os
+import tempfile
+import unittest
+from typing import List
+
+from vaultwarden_user_sync.backends.localstore import LocalStore
+from vaultwarden_user_sync.backends.vaultwarden import MockVaultwardenConnector
+from vaultwarden_user_sync.cycle import CycleOptions, compute_plan, apply_saved_plan, run_cycle
+from vaultwarden_user_sync.email_sources import EmailSource
+from vaultwarden_user_sync.executor import ChangeExecutor
+from vaultwarden_user_sync.plan import ChangePlan
+
+
+class StaticEmailSource(EmailSource):
+
+    def __init__(self, emails: List[str]):
+        super().__init__('test')
+        self.emails = emails
+
+    def get_email_list(self) -> List[str]:
+        return list(self.emails)
+
+
+class CountingVaultwardenConnector(MockVaultwardenConnector):
+    """
+    Counts the invites reaching Vaultwarden, optionally crashing the process on one of them or failing some
+    """
+
+    def __init__(self):
+        self.invited: List[str] = []
+        self.crash_on = None
+        self.failing: List[str] = []
+
+    def invite_user(self, user_email: str) -> str:
+        if user_email == self.crash_on:
+            self.crash_on = None
+            raise KeyboardInterrupt()
+        if user_email in self.failing:
+            raise ConnectionError('Request returned unexpected return code expected: 200 actual: 502')
+        self.invited.append(user_email)
+        return super().invite_user(user_email)
+
+
+class PlanTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.ls = LocalStore(os.path.join(self.tmp_dir.name, 'test.sqlite'))
+        self.vwc = CountingVaultwardenConnector()
+        self.vwc.clear_test_data()
+        self.executor = ChangeExecutor(self.vwc, max_workers=1)
+        self.options = CycleOptions(safe_guard=100, cleanup_vanished_users=True)
+        self.ems = StaticEmailSource(['user{}@test.com'.format(i) for i in range(10)])
+
+    def tearDown(self) -> None:
+        self.ls.con.close()
+        self.tmp_dir.cleanup()
+
+    def test_serialization(self):
+        plan = compute_plan(self.ems, self.vwc, self.ls, self.options)
+        self.assertEqual(10, len(plan.changes))
+        path = os.path.join(self.tmp_dir.name, 'plan.json')
+        plan.save(path)
+        loaded = ChangePlan.load(path)
+        self.assertEqual(plan, loaded)
+        self.assertEqual(plan.plan_id, loaded.plan_id)
+        # Nothing was changed by computing the plan
+        self.assertEqual([], self.vwc.invited)
+        self.assertEqual([], self.ls.get_all_managed_users())
+
+        with self.assertRaises(ValueError):
+            ChangePlan.from_json(plan.to_json().replace('user1@', 'evil@'))
+
+    def test_apply_once(self):
+        plan = compute_plan(self.ems, self.vwc, self.ls, self.options)
+        apply_saved_plan(plan, self.executor, self.vwc, self.ls, self.options)
+        self.assertEqual(sorted(self.ems.emails), sorted(self.vwc.invited))
+        self.assertEqual(10, len(self.ls.get_all_managed_users()))
+        self.assertEqual('DONE', self.ls.get_plan_state(plan.plan_id))
+
+        apply_saved_plan(plan, self.executor, self.vwc, self.ls, self.options)
+        self.assertEqual(10, len(self.vwc.invited))
+
+    def test_resume_after_interruption(self):
+        plan = compute_plan(self.ems, self.vwc, self.ls, self.options)
+        self.vwc.crash_on = 'user4@test.com'
+        with self.assertRaises(KeyboardInterrupt):
+            apply_saved_plan(plan, self.executor, self.vwc, self.ls, self.options)
+        self.assertEqual('ACTIVE', self.ls.get_plan_state(plan.plan_id))
+        invited_before = list(self.vwc.invited)
+        self.assertIn('user0@test.com', invited_before)
+
+        # Invites that reached Vaultwarden after the crash point but were never recorded are not repeated either
+        apply_saved_plan(ChangePlan.from_json(plan.to_json()), self.executor, self.vwc, self.ls, self.options)
+        self.assertEqual(sorted(self.ems.emails), sorted(self.vwc.invited))
+        self.assertEqual(sorted(self.ems.emails), sorted(u.invite_email for u in self.ls.get_all_managed_users()))
+        self.assertEqual('DONE', self.ls.get_plan_state(plan.plan_id))
+
+    def test_cycle_resumes_interrupted_plan(self):
+        self.vwc.crash_on = 'user4@test.com'
+        with self.assertRaises(KeyboardInterrupt):
+            run_cycle(self.ems, self.vwc, self.ls, self.executor, self.options)
+        self.assertIsNotNone(self.ls.get_active_plan())
+        report = run_cycle(self.ems, self.vwc, self.ls, self.executor, self.options)
+        self.assertIn('resume', report.phase_durations)
+        self.assertEqual(sorted(self.ems.emails), sorted(self.vwc.invited))
+        self.assertIsNone(self.ls.get_active_plan())
+
+    def test_failed_calls_retried(self):
+        ems = StaticEmailSource(['b@test.com'])
+        self.vwc.failing = ['b@test.com']
+        with self.assertRaises(ConnectionError):
+            run_cycle(ems, self.vwc, self.ls, self.executor, self.options)
+        self.assertIsNone(self.ls.get_active_plan())
+
+        # Same inputs, same plan: The failed invite is made once Vaultwarden recovered
+        self.vwc.failing = []
+        run_cycle(ems, self.vwc, self.ls, self.executor, self.options)
+        self.assertEqual(['b@test.com'], self.vwc.invited)
+        self.assertEqual(['b@test.com'], [u.invite_email for u in self.ls.get_all_managed_users()])
+        run_cycle(ems, self.vwc, self.ls, self.executor, self.options)
+        self.assertEqual(['b@test.com'], self.vwc.invited)
+
+    def test_partially_failed_plan(self):
+        self.vwc.failing = ['user3@test.com']
+        plan = compute_plan(self.ems, self.vwc, self.ls, self.options)
+        with self.assertRaises(ConnectionError):
+            apply_saved_plan(plan, self.executor, self.vwc, self.ls, self.options)
+        self.assertEqual('FAILED', self.ls.get_plan_state(plan.plan_id))
+        self.assertEqual(9, len(self.vwc.invited))
+
+        self.vwc.failing = []
+        apply_saved_plan(plan, self.executor, self.vwc, self.ls, self.options)
+        self.assertEqual(sorted(self.ems.emails), sorted(self.vwc.invited))
+        self.assertEqual('DONE', self.ls.get_plan_state(plan.plan_id))
+
+    def test_stale_plan_refused(self):
+        plan = compute_plan(self.ems, self.vwc, self.ls, self.options)
+        self.ls.register_user('other@test.com', 'ID_other')
+        with self.assertRaises(ValueError):
+            apply_saved_plan(plan, self.executor, self.vwc, self.ls, self.options)
+        self.options.safe_guard = 5
+        with self.assertRaises(ValueError):
+            apply_saved_plan(compute_plan(self.ems, self.vwc, self.ls, self.options), self.executor, self.vwc,
+                             self.ls, self.options)
+        self.assertEqual([], self.vwc.invited)
@@ -0,0 +1,75 @@
+import io
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+
+from vaultwarden_user_sync.profiling import CycleProfiler, SamplingProfiler, report, FOLDED_FILE
+
+
+def busy_cycle(seconds: float):
+    data = []
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        data.append(str(len(data)))
+    return data
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def test_next_n_cycles(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profiler = CycleProfiler(tmp_dir, profile_cycles=2, trace_memory_cycles=1)
+            for _ in range(3):
+                with profiler.cycle():
+                    busy_cycle(0.01)
+            files = sorted(os.listdir(tmp_dir))
+            self.assertEqual(2, len([name for name in files if name.endswith('.prof')]))
+            self.assertEqual(1, len([name for name in files if name.endswith('.tracemalloc')]))
+            self.assertFalse(tracemalloc.is_tracing())
+
+            out = io.StringIO()
+            report(tmp_dir, top=5, out=out)
+            self.assertIn('busy_cycle', out.getvalue())
+            self.assertIn('== tracemalloc', out.getvalue())
+
+    def test_sampling(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profiler = CycleProfiler(tmp_dir, sample_interval=0.001)
+            try:
+                with profiler.cycle():
+                    busy_cycle(0.2)
+            finally:
+                profiler.sampler.stop()
+            with open(os.path.join(tmp_dir, FOLDED_FILE)) as f:
+                folded = f.read()
+            self.assertIn('busy_cycle (test_Profiling.py', folded)
+
+            out = io.StringIO()
+            report(tmp_dir, top=5, out=out)
+            self.assertIn('by self samples', out.getvalue())
+
+    def test_sampling_all_threads(self):
+        sampler = SamplingProfiler(interval=0.001).start()
+        worker = threading.Thread(target=busy_cycle, args=(0.2,), name='worker')
+        sampler.active.set()
+        worker.start()
+        try:
+            busy_cycle(0.2)
+        finally:
+            worker.join()
+            sampler.stop()
+        roots = {stack.split(';')[0] for stack in sampler.stacks}
+        self.assertIn('thread worker', roots)
+        self.assertIn('thread MainThread', roots)
+        self.assertNotIn('thread sampling-profiler', roots)
+        self.assertTrue(any(stack.startswith('thread worker;') and 'busy_cycle (test_Profiling.py' in stack
+                            for stack in sampler.stacks))
+
+    def test_sampling_only_while_active(self):
+        sampler = SamplingProfiler(interval=0.001).start()
+        time.sleep(0.05)
+        sampler.stop()
+        self.assertEqual({}, sampler.stacks)
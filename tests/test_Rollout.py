@@ -0,0 +1,173 @@
+import os
+import tempfile
+import unittest
+from typing import List
+
+from vaultwarden_user_sync.backends.localstore import LocalStore
+from vaultwarden_user_sync.backends.vaultwarden import MockVaultwardenConnector
+from vaultwarden_user_sync.cycle import CycleOptions, run_cycle, FINGERPRINT_META_KEY
+from vaultwarden_user_sync.email_sources import EmailSource
+from vaultwarden_user_sync.executor import ChangeExecutor, ACTION_INVITE
+from vaultwarden_user_sync.rollout import RolloutPolicy, TokenBucket
+
+
+class ListSource(EmailSource):
+
+    def __init__(self, emails: List[str]):
+        super().__init__('test')
+        self.emails = emails
+
+    def get_email_list(self) -> List[str]:
+        return list(self.emails)
+
+
+class FailingVaultwardenConnector(MockVaultwardenConnector):
+
+    def __init__(self):
+        self.failing: List[str] = []
+
+    def invite_user(self, user_email: str) -> str:
+        if user_email in self.failing:
+            raise ConnectionError('Request returned unexpected return code expected: 200 actual: 502')
+        return super().invite_user(user_email)
+
+
+class RolloutTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.sqlite_file = os.path.join(self.tmp_dir.name, 'test.sqlite')
+        self.ls = LocalStore(self.sqlite_file)
+        self.vwc = FailingVaultwardenConnector()
+        self.vwc.clear_test_data()
+        self.executor = ChangeExecutor(self.vwc, max_workers=2)
+
+    def tearDown(self) -> None:
+        self.ls.close()
+        self.tmp_dir.cleanup()
+
+    def options(self, **policy) -> CycleOptions:
+        return CycleOptions(safe_guard=policy.get('max_per_cycle', 10), cleanup_vanished_users=True,
+                            rollout=RolloutPolicy(**dict({'max_per_cycle': 10}, **policy)))
+
+    def invited(self) -> List[str]:
+        return sorted(user.email for user in self.vwc.get_all_users())
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(capacity=60)
+        self.assertEqual(50, bucket.take(50, now=1000))
+        self.assertEqual(10, bucket.take(50, now=1000))
+        self.assertEqual(0, bucket.take(1, now=1000))
+        # One token per minute
+        self.assertEqual(2, bucket.take(5, now=1000 + 150))
+        self.assertEqual(60, TokenBucket(capacity=60, tokens=0, updated=0).take(100, now=1e6))
+
+    def test_policy_validation(self):
+        with self.assertRaises(ValueError):
+            RolloutPolicy(max_per_cycle=10, order='random')
+        with self.assertRaises(ValueError):
+            RolloutPolicy(max_per_cycle=10, abort_threshold=5)
+
+    def test_backlog_drains(self):
+        ems = ListSource(['user{:02d}@test.com'.format(i) for i in range(25)])
+        options = self.options()
+        counts = []
+        for _ in range(3):
+            report = run_cycle(ems, self.vwc, self.ls, self.executor, options)
+            counts.append((len(self.invited()), report.deferred_changes[ACTION_INVITE]))
+            self.assertFalse(report.safe_guard_exceeded)
+        self.assertEqual([(10, 15), (20, 5), (25, 0)], counts)
+        # Once drained, unchanged inputs are skipped again
+        self.assertFalse(run_cycle(ems, self.vwc, self.ls, self.executor, options).found_changes)
+        self.assertTrue(run_cycle(ems, self.vwc, self.ls, self.executor, options).skipped)
+
+    def test_deferred_changes_are_not_skipped(self):
+        ems = ListSource(['a@test.com', 'b@test.com'])
+        options = self.options(max_per_cycle=1)
+        run_cycle(ems, self.vwc, self.ls, self.executor, options)
+        self.assertIsNone(self.ls.get_meta(FINGERPRINT_META_KEY))
+        report = run_cycle(ems, self.vwc, self.ls, self.executor, options)
+        self.assertFalse(report.skipped)
+        self.assertEqual(['a@test.com', 'b@test.com'], self.invited())
+
+    def test_hourly_limit(self):
+        ems = ListSource(['user{:02d}@test.com'.format(i) for i in range(25)])
+        options = self.options(max_per_hour=12)
+        run_cycle(ems, self.vwc, self.ls, self.executor, options)
+        self.assertEqual(10, len(self.invited()))
+        # The bucket survives a restart
+        self.ls.close()
+        self.ls = LocalStore(self.sqlite_file)
+        report = run_cycle(ems, self.vwc, self.ls, self.executor, options)
+        self.assertEqual(12, len(self.invited()))
+        self.assertEqual(13, report.deferred_changes[ACTION_INVITE])
+
+    def test_order(self):
+        for streaming_diff in [False, True]:
+            with self.subTest(streaming_diff=streaming_diff):
+                self.vwc.clear_test_data()
+                self.ls.close()
+                os.unlink(self.sqlite_file)
+                self.ls = LocalStore(self.sqlite_file)
+                options = self.options(max_per_cycle=1)
+                options.streaming_diff = streaming_diff
+
+                # Found in the same cycle: Email source order
+                ems = ListSource(['c@test.com', 'b@test.com', 'a@test.com'])
+                run_cycle(ems, self.vwc, self.ls, self.executor, options)
+                self.assertEqual(['c@test.com'], self.invited())
+
+                # Pending for longer than the new entry
+                ems.emails.insert(0, 'aa@test.com')
+                run_cycle(ems, self.vwc, self.ls, self.executor, options)
+                self.assertEqual(['b@test.com', 'c@test.com'], self.invited())
+
+                options.rollout.order = 'email'
+                run_cycle(ems, self.vwc, self.ls, self.executor, options)
+                self.assertEqual(['a@test.com', 'b@test.com', 'c@test.com'], self.invited())
+
+    def test_newest_order(self):
+        ems = ListSource(['c@test.com', 'b@test.com', 'a@test.com'])
+        options = self.options(max_per_cycle=1, order='newest')
+        run_cycle(ems, self.vwc, self.ls, self.executor, options)
+        self.assertEqual(['c@test.com'], self.invited())
+        ems.emails.append('aa@test.com')
+        run_cycle(ems, self.vwc, self.ls, self.executor, options)
+        self.assertEqual(['aa@test.com', 'c@test.com'], self.invited())
+
+    def test_failed_calls_refund_tokens(self):
+        ems = ListSource(['user{:02d}@test.com'.format(i) for i in range(5)])
+        self.vwc.failing = ['user01@test.com', 'user03@test.com']
+        options = self.options(max_per_hour=12)
+        with self.assertRaises(ConnectionError):
+            run_cycle(ems, self.vwc, self.ls, self.executor, options)
+        self.assertEqual(3, len(self.invited()))
+        tokens, _ = self.ls.get_rollout_bucket(ACTION_INVITE)
+        self.assertAlmostEqual(12 - 3, tokens, places=2)
+
+        # The retry takes the tokens again
+        self.vwc.failing = []
+        run_cycle(ems, self.vwc, self.ls, self.executor, options)
+        self.assertEqual(5, len(self.invited()))
+        tokens, _ = self.ls.get_rollout_bucket(ACTION_INVITE)
+        self.assertAlmostEqual(12 - 5, tokens, places=2)
+
+    def test_abort_threshold(self):
+        ems = ListSource(['user{:02d}@test.com'.format(i) for i in range(25)])
+        report = run_cycle(ems, self.vwc, self.ls, self.executor, self.options(abort_threshold=20))
+        self.assertTrue(report.safe_guard_exceeded)
+        self.assertEqual([], self.invited())
+
+    def test_dry_run(self):
+        ems = ListSource(['user{:02d}@test.com'.format(i) for i in range(25)])
+        options = self.options(max_per_hour=12)
+        options.dry_run = True
+        report = run_cycle(ems, self.vwc, self.ls, self.executor, options)
+        self.assertEqual(15, report.deferred_changes[ACTION_INVITE])
+        self.assertEqual([], self.invited())
+        self.assertIsNone(self.ls.get_rollout_bucket(ACTION_INVITE))
+        self.assertEqual({}, self.ls.get_rollout_queue(ACTION_INVITE))
+
+
+if __name__ == '__main__':
+    unittest.main()
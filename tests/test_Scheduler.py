@@ -0,0 +1,111 @@
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from vaultwarden_user_sync.scheduler import SyncScheduler, OUTCOME_CHANGED, OUTCOME_UNCHANGED, OUTCOME_ERROR, \
+    HEALTH_MARGIN, touch_heartbeat
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_adaptive_interval(self):
+        scheduler = SyncScheduler(100, min_interval=10, max_interval=400, jitter=0)
+        self.assertEqual(50, scheduler.next_delay(OUTCOME_CHANGED))
+        self.assertEqual(25, scheduler.next_delay(OUTCOME_CHANGED))
+        self.assertEqual(12.5, scheduler.next_delay(OUTCOME_CHANGED))
+        self.assertEqual(10, scheduler.next_delay(OUTCOME_CHANGED))
+        self.assertEqual(15, scheduler.next_delay(OUTCOME_UNCHANGED))
+        for _ in range(20):
+            scheduler.next_delay(OUTCOME_UNCHANGED)
+        self.assertEqual(400, scheduler.next_delay(OUTCOME_UNCHANGED))
+
+    def test_error_backoff(self):
+        scheduler = SyncScheduler(100, min_interval=10, error_max_interval=60, jitter=0)
+        self.assertEqual([10, 20, 40, 60, 60], [scheduler.next_delay(OUTCOME_ERROR) for _ in range(5)])
+        self.assertEqual(100, scheduler.next_delay(OUTCOME_UNCHANGED))
+        self.assertEqual(10, scheduler.next_delay(OUTCOME_ERROR))
+
+    def test_jitter(self):
+        scheduler = SyncScheduler(100, jitter=0.2)
+        delays = [scheduler.next_delay(OUTCOME_UNCHANGED) for _ in range(50)]
+        self.assertTrue(all(80 <= delay <= 120 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_health_max_age(self):
+        scheduler = SyncScheduler(100, min_interval=10, max_interval=400, jitter=0.1)
+        self.assertEqual(400 * 1.1 + HEALTH_MARGIN, scheduler.health_max_age)
+        # No delay exceeds it while nothing changes
+        delays = [scheduler.next_delay(OUTCOME_UNCHANGED) for _ in range(30)]
+        self.assertLess(max(delays) + HEALTH_MARGIN, scheduler.health_max_age + 1e-9)
+        # The error backoff extends it by its last delay only
+        scheduler.next_delay(OUTCOME_ERROR)
+        self.assertEqual(410 * 1.1 + HEALTH_MARGIN, scheduler.health_max_age)
+        for _ in range(30):
+            scheduler.next_delay(OUTCOME_ERROR)
+        self.assertEqual(2000 * 1.1 + HEALTH_MARGIN, scheduler.health_max_age)
+        scheduler.next_delay(OUTCOME_UNCHANGED)
+        self.assertEqual(400 * 1.1 + HEALTH_MARGIN, scheduler.health_max_age)
+        self.assertEqual(900, SyncScheduler(100, health_max_age=900).health_max_age)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            heartbeat_file = os.path.join(tmp_dir, 'health')
+            touch_heartbeat(heartbeat_file, scheduler.health_max_age)
+            touch_heartbeat(heartbeat_file, scheduler.health_max_age)
+            with open(heartbeat_file) as f:
+                self.assertEqual('740\n', f.read())
+
+    def test_trigger_and_shutdown(self):
+        scheduler = SyncScheduler(100)
+        threading.Timer(0.05, scheduler.trigger).start()
+        start = time.monotonic()
+        self.assertTrue(scheduler.wait(10))
+        self.assertLess(time.monotonic() - start, 1)
+        threading.Timer(0.05, scheduler.shutdown).start()
+        self.assertFalse(scheduler.wait(10))
+
+    def test_trigger_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trigger_file = os.path.join(tmp_dir, 'sync_now')
+            scheduler = SyncScheduler(100, trigger_file=trigger_file)
+            open(trigger_file, 'w').close()
+            self.assertTrue(scheduler.wait(10))
+            self.assertFalse(os.path.exists(trigger_file))
+
+    def test_trigger_socket(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            socket_path = os.path.join(tmp_dir, 'sync.sock')
+            scheduler = SyncScheduler(100, trigger_socket=socket_path).start()
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                    client.connect(socket_path)
+                    self.assertEqual(b'ok\n', client.recv(3))
+                start = time.monotonic()
+                self.assertTrue(scheduler.wait(10))
+                self.assertLess(time.monotonic() - start, 1)
+            finally:
+                scheduler.close()
+            self.assertFalse(os.path.exists(socket_path))
+
+    def test_signals(self):
+        scheduler = SyncScheduler(100)
+        previous = {signum: signal.getsignal(signum) for signum in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]}
+        scheduler.install_signal_handlers()
+        try:
+            os.kill(os.getpid(), signal.SIGHUP)
+            # The handler only sets flags, the log line is written by wait()
+            self.assertEqual(signal.SIGHUP, scheduler.received_signal)
+            with self.assertLogs(level='INFO') as logs:
+                self.assertTrue(scheduler.wait(10))
+            self.assertIn('SIGHUP received', logs.output[0])
+            self.assertIsNone(scheduler.received_signal)
+            os.kill(os.getpid(), signal.SIGTERM)
+            with self.assertLogs(level='WARNING') as logs:
+                self.assertFalse(scheduler.wait(10))
+            self.assertIn('SIGTERM received', logs.output[0])
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
@@ -0,0 +1,92 @@
+import unittest
+from unittest import mock
+
+from vaultwarden_user_sync.email_sources.server_pool import ServerPool
+
+
+class ServerPoolTest(unittest.TestCase):
+
+    def test_unmeasured_first_then_by_latency(self):
+        pool = ServerPool(['dc1', 'dc2', 'dc3'])
+        pool.record_success('dc1', 0.5)
+        pool.record_success('dc2', 0.1)
+        self.assertEqual(['dc3', 'dc2', 'dc1'], pool.candidates())
+        pool.record_success('dc3', 0.3)
+        self.assertEqual(['dc2', 'dc3', 'dc1'], pool.candidates())
+
+    def test_latency_moving_average(self):
+        pool = ServerPool(['dc1', 'dc2'], ewma_alpha=0.5)
+        pool.record_success('dc1', 0.1)
+        pool.record_success('dc2', 0.2)
+        # One slow response does not make dc1 lose its place, a sustained slowdown does
+        pool.record_success('dc1', 0.25)
+        self.assertAlmostEqual(0.175, pool.get_stats()['dc1']['latency'])
+        self.assertEqual(['dc1', 'dc2'], pool.candidates())
+        pool.record_success('dc1', 0.4)
+        self.assertEqual(['dc2', 'dc1'], pool.candidates())
+
+    def test_avoided_last(self):
+        pool = ServerPool(['dc1', 'dc2', 'dc3'])
+        pool.record_success('dc1', 0.1)
+        pool.record_success('dc2', 0.2)
+        pool.record_success('dc3', 0.3)
+        self.assertEqual(['dc2', 'dc3', 'dc1'], pool.candidates(avoid=['dc1']))
+        self.assertEqual(['dc3', 'dc1', 'dc2'], pool.candidates(avoid=['dc1', 'dc2']))
+
+    def test_outranked(self):
+        pool = ServerPool(['dc1', 'dc2', 'dc3'], ewma_alpha=1.0, switch_margin=0.2)
+        pool.record_success('dc1', 0.1)
+        self.assertFalse(pool.is_outranked('dc1'))
+        # Slightly faster is not worth a rebind, clearly faster is
+        pool.record_success('dc2', 0.09)
+        self.assertFalse(pool.is_outranked('dc1'))
+        pool.record_success('dc2', 0.05)
+        self.assertTrue(pool.is_outranked('dc1'))
+        self.assertFalse(pool.is_outranked('dc2'))
+        # Unless the faster one is ejected
+        pool.record_failure('dc2')
+        pool.record_failure('dc2')
+        self.assertFalse(pool.is_outranked('dc1'))
+
+    @mock.patch('vaultwarden_user_sync.email_sources.server_pool.time.monotonic')
+    def test_ejection(self, monotonic):
+        monotonic.return_value = 1000.0
+        pool = ServerPool(['dc1', 'dc2'], eject_after=2, eject_seconds=30, max_eject_seconds=100)
+        pool.record_success('dc1', 0.1)
+        pool.record_success('dc2', 0.2)
+        pool.record_failure('dc1')
+        self.assertEqual(['dc1', 'dc2'], pool.candidates())
+        pool.record_failure('dc1')
+        self.assertEqual(['dc2', 'dc1'], pool.candidates())
+        self.assertTrue(pool.get_stats()['dc1']['ejected'])
+
+        # Ejection doubles with every further failure, capped
+        monotonic.return_value = 1031.0
+        self.assertEqual(['dc1', 'dc2'], pool.candidates())
+        pool.record_failure('dc1')
+        monotonic.return_value = 1031.0 + 59
+        self.assertEqual(['dc2', 'dc1'], pool.candidates())
+        pool.record_failure('dc1')
+        pool.record_failure('dc1')
+        monotonic.return_value = 1090.0 + 99
+        self.assertEqual(['dc2', 'dc1'], pool.candidates())
+        monotonic.return_value = 1090.0 + 101
+        self.assertEqual(['dc1', 'dc2'], pool.candidates())
+
+        pool.record_success('dc1', 0.1)
+        stats = pool.get_stats()['dc1']
+        self.assertFalse(stats['ejected'])
+        self.assertEqual((5, 4), (stats['failures'], stats['ejections']))
+
+    @mock.patch('vaultwarden_user_sync.email_sources.server_pool.time.monotonic')
+    def test_all_ejected_still_tried(self, monotonic):
+        monotonic.return_value = 1000.0
+        pool = ServerPool(['dc1', 'dc2'], eject_after=1, eject_seconds=30)
+        pool.record_failure('dc2')
+        monotonic.return_value = 1010.0
+        pool.record_failure('dc1')
+        self.assertEqual(['dc2', 'dc1'], pool.candidates())
+
+    def test_requires_servers(self):
+        with self.assertRaises(ValueError):
+            ServerPool([])
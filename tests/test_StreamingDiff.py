@@ -0,0 +1,40 @@
+import os
+import random
+import tempfile
+import unittest
+
+from tests import test_DiffEngine
+from vaultwarden_user_sync.backends.localstore import LocalStore
+from vaultwarden_user_sync.compare import SyncResult
+from vaultwarden_user_sync.streaming_diff import DiffSpill, merge_groups
+
+
+class StreamingDiffTest(unittest.TestCase):
+
+    def test_merge_groups(self):
+        merged = list(merge_groups((['a', 'b', 'b'], lambda e: e), ([('b', 1), ('c', 2)], lambda t: t[0])))
+        self.assertEqual([('a', [['a'], []]), ('b', [['b', 'b'], [('b', 1)]]), ('c', [[], [('c', 2)]])], merged)
+
+    def test_identical_to_in_memory_diff(self):
+        rnd = random.Random(7)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for i in range(100):
+                vw_users, ma_users, source = test_DiffEngine.DiffEngineTest.random_inputs(rnd, rnd.randint(1, 30))
+                ls = LocalStore(os.path.join(tmp_dir, 'test{}.sqlite'.format(i)))
+                with ls.batch():
+                    for ma_user in {u.vw_user_id: u for u in ma_users}.values():
+                        ls.register_user(ma_user.invite_email, ma_user.vw_user_id,
+                                         'ENABLED' if ma_user.enabled else 'DISABLED')
+                        ls.update_vw_email(ma_user.vw_user_id, ma_user.vw_email)
+                with DiffSpill(tmp_dir) as spill:
+                    spill.add_source_emails(source + source[:3])
+                    spill.add_vw_users(vw_users)
+                    streamed = spill.diff(ls)
+                expected = SyncResult.from_inputs(vw_users, ls.get_all_managed_users(), source)
+                self.assertEqual(test_DiffEngine.as_comparable(expected), test_DiffEngine.as_comparable(streamed))
+                self.assertEqual(expected.invite_positions, streamed.invite_positions)
+                for user_id in streamed.pending_changes.disable_user_ids | streamed.user_ids_vanished_in_vw:
+                    self.assertEqual(expected.get_ma_user_by_id(user_id), streamed.get_ma_user_by_id(user_id))
+                ls.con.close()
+            # Spill databases are removed
+            self.assertFalse([name for name in os.listdir(tmp_dir) if name.startswith('vus_diff_')])
@@ -0,0 +1,192 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from typing import List
+
+from vaultwarden_user_sync.backends.vaultwarden import MockVaultwardenConnector
+from vaultwarden_user_sync.cycle import CycleOptions
+from vaultwarden_user_sync.email_sources import EmailSource
+from vaultwarden_user_sync.email_sources.shared import SearchCache, SharedSearchSource, LdapQuery
+from vaultwarden_user_sync.metrics import SyncMetrics, TenantMetrics
+from vaultwarden_user_sync.scheduler import SyncScheduler
+from vaultwarden_user_sync.tenants import load_tenant_config, tenant_environment, Tenant, TenantRunner
+
+
+class StaticSource(EmailSource):
+
+    def __init__(self, emails: List[str], error: Exception = None):
+        super().__init__('test')
+        self.emails = emails
+        self.error = error
+
+    def get_email_list(self) -> List[str]:
+        if self.error:
+            raise self.error
+        return list(self.emails)
+
+
+class CountingConnector(EmailSource):
+    """
+    Stands in for a shared LdapConnector: Answers each query with one address per search run so far
+    """
+
+    def __init__(self, delay: float = 0.0):
+        super().__init__('ldap-1')
+        self.delay = delay
+        self.searches = 0
+        self.lock = threading.Lock()
+
+    def get_email_list(self) -> List[str]:
+        raise NotImplementedError
+
+    def search(self, query: LdapQuery) -> List[str]:
+        time.sleep(self.delay)
+        with self.lock:
+            self.searches += 1
+        return ['{}@{}'.format(query.search_filter, self.searches)]
+
+
+class TenantsTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def write_config(self, config: dict) -> str:
+        path = os.path.join(self.tmp_dir.name, 'tenants.json')
+        with open(path, 'w') as f:
+            json.dump(config, f)
+        return path
+
+    def tenant(self, name: str, ems: EmailSource, interval: float = 60) -> Tenant:
+        vwc = MockVaultwardenConnector()
+        vwc.clear_test_data()
+        return Tenant(name, vwc, ems, os.path.join(self.tmp_dir.name, '{}.sqlite'.format(name)),
+                      options=CycleOptions(safe_guard=100),
+                      scheduler=SyncScheduler(interval, min_interval=interval, max_interval=interval, jitter=0),
+                      metrics=SyncMetrics(max_age=60))
+
+    def test_load_config(self):
+        path = self.write_config({
+            'defaults': {'LDAP_SERVER': 'dc1', 'SYNC_INTERVAL_SECONDS': 300},
+            'tenants': [
+                {'name': 'a', 'settings': {'VAULTWARDEN_URL': 'https://a', 'SQLITE_DB': 'a.sqlite'}},
+                {'name': 'b', 'settings': {'VAULTWARDEN_URL': 'https://b', 'SQLITE_DB': 'b.sqlite',
+                                           'LDAP_SERVER': 'dc2'}},
+            ]})
+        tenants = load_tenant_config(path)
+        self.assertEqual(['a', 'b'], [tenant.name for tenant in tenants])
+        self.assertEqual({'LDAP_SERVER': 'dc1', 'SYNC_INTERVAL_SECONDS': '300', 'VAULTWARDEN_URL': 'https://a',
+                          'SQLITE_DB': 'a.sqlite'}, tenants[0].settings)
+        self.assertEqual('dc2', tenants[1].settings['LDAP_SERVER'])
+
+    def test_invalid_config(self):
+        tenant = {'name': 'a', 'settings': {'VAULTWARDEN_URL': 'https://a', 'SQLITE_DB': 'a.sqlite'}}
+        for config in [{'tenants': []},
+                       {'tenants': [tenant, tenant]},
+                       {'tenants': [dict(tenant, name='a b')]},
+                       {'tenants': [{'name': 'a', 'settings': {'VAULTWARDEN_URL': 'https://a'}}]},
+                       {'tenants': [tenant, dict(tenant, name='b')]}]:
+            with self.assertRaises(ValueError):
+                load_tenant_config(self.write_config(config))
+
+    def test_tenant_environment(self):
+        os.environ['VUS_TEST_KEPT'] = 'process'
+        try:
+            with tenant_environment({'VUS_TEST_KEPT': 'tenant', 'VUS_TEST_ADDED': '1'}):
+                self.assertEqual('tenant', os.getenv('VUS_TEST_KEPT'))
+                self.assertEqual('1', os.getenv('VUS_TEST_ADDED'))
+            self.assertEqual('process', os.getenv('VUS_TEST_KEPT'))
+            self.assertNotIn('VUS_TEST_ADDED', os.environ)
+        finally:
+            del os.environ['VUS_TEST_KEPT']
+
+    def test_search_cache(self):
+        connector = CountingConnector(delay=0.1)
+        cache = SearchCache(ttl=60)
+        query = LdapQuery('OU=Users', 'f', 'mail')
+        sources = [SharedSearchSource('LDAP', connector, query, cache) for _ in range(4)]
+        results = []
+        threads = [threading.Thread(target=lambda source=source: results.append(source.get_email_list()))
+                   for source in sources]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Concurrent identical searches ran once, later ones are served from the cache
+        self.assertEqual([['f@1']] * 4, results)
+        self.assertEqual(['f@1'], sources[0].get_email_list())
+        self.assertEqual(1, connector.searches)
+        # Another query on the same connector is a search of its own
+        self.assertEqual(['g@2'], SharedSearchSource('LDAP', connector, LdapQuery('OU=Users', 'g', 'mail'),
+                                                     cache).get_email_list())
+        self.assertEqual({'hits': 4, 'misses': 2}, cache.get_stats())
+
+        cache.ttl = 0
+        self.assertEqual(['f@3'], sources[0].get_email_list())
+
+    def test_search_cache_error(self):
+        cache = SearchCache(ttl=60)
+        calls = []
+
+        def fail():
+            calls.append(1)
+            raise ConnectionError('down')
+
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                cache.get('key', fail)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(['a@test.com'], cache.get('key', lambda: ['a@test.com']))
+
+    def test_failure_isolation(self):
+        healthy = self.tenant('healthy', StaticSource(['a@test.com', 'b@test.com']))
+        broken = self.tenant('broken', StaticSource([], error=ConnectionError('LDAP down')))
+        runner = TenantRunner([healthy, broken], SyncScheduler(60), workers=2)
+        runner.run(once=True)
+
+        self.assertEqual(['a@test.com', 'b@test.com'], sorted(user.email for user in healthy.vwc.get_all_users()))
+        self.assertEqual({'healthy': 1, 'broken': 1}, runner.cycles)
+        self.assertIsNone(healthy.metrics.last_error)
+        self.assertIn('LDAP down', broken.metrics.last_error)
+        # The failing tenant backs off on its own
+        self.assertEqual(1, broken.scheduler.consecutive_errors)
+        self.assertEqual(0, healthy.scheduler.consecutive_errors)
+
+        metrics = TenantMetrics({tenant.name: tenant.metrics for tenant in [healthy, broken]},
+                                cache_stats=lambda: {'hits': 3, 'misses': 1})
+        text = metrics.render()
+        self.assertEqual(1, text.count('# TYPE vus_cycles_total counter'))
+        self.assertIn('vus_cycles_total{outcome="success",tenant="healthy"} 1', text)
+        self.assertIn('vus_cycles_total{outcome="error",tenant="broken"} 1', text)
+        self.assertIn('vus_ldap_search_cache_hits_total 3', text)
+        self.assertTrue(metrics.is_live())
+        self.assertTrue(metrics.is_ready())
+        self.assertEqual('broken: ConnectionError: LDAP down', metrics.last_error)
+
+    def test_schedules(self):
+        fast = self.tenant('fast', StaticSource(['a@test.com']), interval=0.05)
+        slow = self.tenant('slow', StaticSource(['b@test.com']), interval=60)
+        scheduler = SyncScheduler(60)
+        runner = TenantRunner([fast, slow], scheduler, workers=1)
+        thread = threading.Thread(target=runner.run)
+        thread.start()
+        time.sleep(0.5)
+        scheduler.trigger()
+        time.sleep(0.2)
+        scheduler.shutdown()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertGreater(runner.cycles['fast'], 3)
+        # Once at the start and once more on the trigger
+        self.assertEqual(2, runner.cycles['slow'])
+
+
+if __name__ == '__main__':
+    unittest.main()
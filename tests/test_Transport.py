@@ -0,0 +1,97 @@
+import io
+import unittest
+
+import requests
+
+from vaultwarden_user_sync.backends.transport import Transport, CircuitBreaker, CircuitOpenError
+
+
+class StubClient:
+    """
+    Stands in for requests.Session, replays the given status codes (or exceptions)
+    """
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self.calls.append(timeout)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = requests.Response()
+        response.status_code = outcome
+        response.raw = io.BytesIO(b'')
+        return response
+
+
+class TransportTest(unittest.TestCase):
+
+    @staticmethod
+    def transport(client, **kwargs) -> Transport:
+        return Transport(client, connect_timeout=2, read_timeout=7, backoff_base=0, **kwargs)
+
+    def test_timeouts_enforced(self):
+        client = StubClient([200, 200])
+        transport = self.transport(client)
+        transport.request('GET', 'http://vw/admin/users')
+        transport.request('GET', 'http://vw/admin/users', timeout=1)
+        self.assertEqual([(2, 7), (2, 1)], client.calls)
+
+    def test_idempotent_call_retried(self):
+        client = StubClient([502, requests.exceptions.ReadTimeout(), 200])
+        transport = self.transport(client)
+        self.assertEqual(200, transport.request('GET', 'http://vw/admin/users').status_code)
+        self.assertEqual(2, transport.get_stats()['retries'])
+
+    def test_non_idempotent_call_not_retried(self):
+        client = StubClient([requests.exceptions.ReadTimeout(), 200])
+        transport = self.transport(client)
+        with self.assertRaises(ConnectionError):
+            transport.request('POST', 'http://vw/admin/invite', idempotent=False)
+        self.assertEqual(1, len(client.calls))
+
+    def test_non_idempotent_call_retried_on_connect_timeout(self):
+        client = StubClient([requests.exceptions.ConnectTimeout(), 200])
+        transport = self.transport(client)
+        self.assertEqual(200, transport.request('POST', 'http://vw/admin/invite', idempotent=False).status_code)
+
+    def test_retries_exhausted(self):
+        client = StubClient([503] * 4)
+        transport = self.transport(client, max_retries=3)
+        self.assertEqual(503, transport.request('GET', 'http://vw/admin/users').status_code)
+        self.assertEqual(4, len(client.calls))
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=3600)
+        client = StubClient([503, 503, 200])
+        transport = self.transport(client, max_retries=0, circuit_breaker=breaker)
+        transport.request('GET', 'http://vw/admin/users')
+        transport.request('GET', 'http://vw/admin/users')
+        with self.assertRaises(CircuitOpenError):
+            transport.request('GET', 'http://vw/admin/users')
+        self.assertEqual(2, len(client.calls))
+        self.assertEqual(1, transport.get_stats()['circuit_trips'])
+        self.assertEqual(1, transport.get_stats()['circuit_rejected'])
+
+    def test_circuit_breaker_half_open(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertFalse(breaker.is_closed)
+        # trial call allowed, concurrent calls are still rejected
+        breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+        breaker.record_success()
+        self.assertTrue(breaker.is_closed)
+
+    def test_circuit_breaker_check(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        # The check leaves the trial call to before_call
+        breaker.check()
+        breaker.check()
+        breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            breaker.check()
@@ -0,0 +1,83 @@
+import os
+import unittest
+from unittest import mock
+
+from tests.fake_vaultwarden import FakeVaultwardenServer, FakeVaultwardenConfig
+from vaultwarden_user_sync.backends.vaultwarden import VaultwardenConnector
+
+
+class VaultwardenConnectorTest(unittest.TestCase):
+    """
+    Exercises the real HTTP path against the local fake admin API
+    """
+
+    def connector(self, server: FakeVaultwardenServer) -> VaultwardenConnector:
+        with mock.patch.dict(os.environ, {'VAULTWARDEN_URL': server.url,
+                                          'VAULTWARDEN_ADMIN_TOKEN': server.state.config.admin_token}):
+            vwc = VaultwardenConnector()
+        vwc.transport.backoff_base = 0
+        return vwc
+
+    def test_get_all_users_both_casings(self):
+        for key_casing in ['camel', 'pascal']:
+            with FakeVaultwardenServer(FakeVaultwardenConfig(users=5, key_casing=key_casing)) as server:
+                users = self.connector(server).get_all_users()
+                self.assertEqual(5, len(users), key_casing)
+                self.assertEqual('user0000000@example.com', users[0].email)
+                self.assertTrue(users[0].enabled)
+
+    def test_invite_enable_disable(self):
+        with FakeVaultwardenServer() as server:
+            vwc = self.connector(server)
+            user_id = vwc.invite_user('new@example.com')
+            vwc.disable_user(user_id)
+            self.assertFalse(vwc.get_all_users()[0].enabled)
+            vwc.enable_user(user_id)
+            self.assertTrue(vwc.get_all_users()[0].enabled)
+            with self.assertRaises(ConnectionError):
+                vwc.disable_user('unknown')
+            self.assertEqual(1, server.state.request_counts['login'])
+
+    def test_reauthenticate_on_expired_cookie(self):
+        with FakeVaultwardenServer(FakeVaultwardenConfig(users=1)) as server:
+            vwc = self.connector(server)
+            vwc.get_all_users()
+            server.expire_sessions()
+            self.assertEqual(1, len(vwc.get_all_users()))
+            self.assertEqual(2, server.state.request_counts['login'])
+
+    def test_wrong_token(self):
+        with FakeVaultwardenServer(FakeVaultwardenConfig(admin_token='other')) as server:
+            with mock.patch.dict(os.environ, {'VAULTWARDEN_URL': server.url, 'VAULTWARDEN_ADMIN_TOKEN': 'wrong'}):
+                vwc = VaultwardenConnector()
+            with self.assertRaises(ConnectionError):
+                vwc.get_all_users()
+
+    def test_transient_errors_retried(self):
+        with FakeVaultwardenServer(FakeVaultwardenConfig(users=3, error_rate=0.3)) as server:
+            vwc = self.connector(server)
+            vwc.transport.max_retries = 10
+            for _ in range(5):
+                self.assertEqual(3, len(vwc.get_all_users()))
+            self.assertGreater(vwc.transport.get_stats()['retries'], 0)
+
+    def test_circuit_breaker_recovers(self):
+        with FakeVaultwardenServer(FakeVaultwardenConfig(users=2)) as server:
+            vwc = self.connector(server)
+            vwc.transport.max_retries = 0
+            vwc.transport.circuit_breaker.failure_threshold = 1
+            vwc.transport.circuit_breaker.reset_timeout = 0
+            vwc.get_all_users()
+            server.state.config.error_rate = 1.0
+            with self.assertRaises(ConnectionError):
+                vwc.get_all_users()
+            self.assertFalse(vwc.transport.circuit_breaker.is_closed)
+            # Half-open: The trial call reaches Vaultwarden, fails and re-opens the circuit
+            with self.assertRaises(ConnectionError):
+                vwc.get_all_users()
+            self.assertEqual(2, vwc.transport.get_stats()['failures'])
+
+            server.state.config.error_rate = 0.0
+            self.assertEqual(2, len(vwc.get_all_users()))
+            self.assertTrue(vwc.transport.circuit_breaker.is_closed)
+            self.assertEqual(0, vwc.transport.get_stats()['circuit_rejected'])
@@ -0,0 +1,92 @@
+"""
+Incremental decoding of large JSON arrays, element by element, without holding the whole document (or the whole
+decoded list) in memory.
+"""
+import codecs
+import json
+from typing import Iterable, Iterator, Any, Optional
+
+_WHITESPACE = ' \t\n\r'
+_decoder = json.JSONDecoder()
+
+
+class _ChunkReader:
+
+    def __init__(self, chunks: Iterable[bytes], encoding: str):
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder(encoding)()
+        self.buffer = ''
+        self.pos = 0
+        self.exhausted = False
+
+    def more(self) -> bool:
+        """
+        Appends the next chunk, dropping everything before pos
+
+        :return: False if there are no more chunks
+        """
+        if self.exhausted:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            text = self.text_decoder.decode(b'', final=True)
+        else:
+            text = self.text_decoder.decode(chunk)
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self) -> Optional[str]:
+        """
+        Skips whitespace
+
+        :return: The next character or None at the end of the document
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.more():
+                return None
+
+
+def iter_json_array(chunks: Iterable[bytes], encoding: str = 'utf-8') -> Iterator[Any]:
+    """
+    Decodes a JSON array arriving in chunks (e.g. Response.iter_content()) and yields its elements one at a time
+
+    :param chunks: Raw document in pieces of any size
+    :param encoding: Character encoding of the document
+    :raises ValueError: If the document is not a JSON array (json.JSONDecodeError for malformed elements)
+    """
+    reader = _ChunkReader(chunks, encoding)
+    if reader.peek() != '[':
+        raise ValueError('Expected a JSON array')
+    reader.pos += 1
+    if reader.peek() == ']':
+        reader.pos += 1
+    else:
+        while True:
+            if reader.peek() is None:
+                raise ValueError('Unexpected end of the JSON array')
+            while True:
+                try:
+                    element, end = _decoder.raw_decode(reader.buffer, reader.pos)
+                    # Unless something follows, a number could continue in the next chunk
+                    if end < len(reader.buffer) or reader.exhausted:
+                        break
+                except json.JSONDecodeError:
+                    if reader.exhausted:
+                        raise
+                reader.more()
+            reader.pos = end
+            yield element
+            char = reader.peek()
+            reader.pos += 1
+            if char == ']':
+                break
+            if char != ',':
+                raise ValueError('Expected , or ] in JSON array, got {!r}'.format(char))
+    if reader.peek() is not None:
+        raise ValueError('Unexpected data after the JSON array')
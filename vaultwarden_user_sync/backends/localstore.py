@@ -1,11 +1,19 @@
+import contextlib
 import os.path
 import sqlite3
 import time
 import logging
 from dataclasses import dataclass
-from typing import Tuple, List, Literal
+from typing import Tuple, List, Literal, Optional, Dict, Iterable, Iterator
+
+from vaultwarden_user_sync.backends.migrations import migrate
+from vaultwarden_user_sync.email_key import EmailKeyRules, DEFAULT_EMAIL_KEY
 
 ALLOWED_USER_STATES = ['ENABLED', 'DISABLED', 'DELETED']
+# SyncMeta key of the email key rules the stored keys were computed with
+EMAIL_KEY_RULES_META_KEY = 'email_key_rules'
+# Number of finished (DONE/FAILED/ABANDONED) plans kept for reference
+KEEP_FINISHED_PLANS = 20
 
 
 @dataclass
@@ -16,46 +24,99 @@ class ManagedUser:
     # Original invite email
     invite_email: str
     enabled: bool
+    # Canonical keys of invite_email and vw_email (see email_key.py), None if not read from the LocalStore
+    invite_key: Optional[str] = None
+    vw_key: Optional[str] = None
+
+
+@dataclass
+class SourceSyncState:
+    """
+    Position of an incremental email source (see IncrementalLdapConnector)
+    """
+    source_name: str
+    # RFC 4533 content synchronization cookie
+    cookie: Optional[str]
+    # Highest modifyTimestamp/uSNChanged seen so far
+    watermark: Optional[str]
+    # Unix timestamp of the last full resync
+    last_full_sync: float
+    # Server the position was obtained from, positions are not portable between servers
+    server: Optional[str] = None
 
 
 class LocalStore:
 
-    def __init__(self, sqlite_file: str):
+    def __init__(self, sqlite_file: str, journal_mode: str = 'WAL', email_key: EmailKeyRules = DEFAULT_EMAIL_KEY):
+        """
+        :param sqlite_file: Path (or URI) of the database
+        :param journal_mode: SQLite journal mode, with WAL a commit only needs to append to the log
+        :param email_key: Rules computing the stored email keys (EMAIL_KEY_RULES)
+        """
+        self.email_key = email_key
+        self.closed = False
         self.con = sqlite3.connect(sqlite_file)
+        self.con.execute('PRAGMA journal_mode = {}'.format(journal_mode))
+        if journal_mode.upper() == 'WAL':
+            # Durable across application crashes, only a power loss may lose the last transactions
+            self.con.execute('PRAGMA synchronous = NORMAL')
+        self.con.execute('PRAGMA busy_timeout = 5000')
+        # Mutations buffered by batch(), None if no batch is active
+        self._pending: Optional[List[Tuple[str, tuple]]] = None
+        self._flush_every = 0
         self.init_db()
 
     def init_db(self):
-        schema = '''
-                create table if not exists Users
-        (
-            id           integer not null
-                constraint Users_pk
-                    primary key autoincrement,
-            invite_email TEXT    not null,
-            vw_email     TEXT    not null,
-            vw_user_id   TEXT    not null,
-            last_touched TEXT    not null,
-            state        TEXT    not null
-        );
-        '''
-
-        self.con.cursor().execute(schema)
-        self.con.commit()
+        """
+        Creates the schema or upgrades it to the latest version (see migrations.py) and brings the email keys in line
+        with the configured rules
+        """
+        migrate(self.con)
+        if self.get_meta(EMAIL_KEY_RULES_META_KEY) != self.email_key.spec:
+            self._recompute_email_keys()
+
+    def _recompute_email_keys(self):
+        rows = self.con.execute('SELECT id, invite_email, vw_email FROM Users').fetchall()
+        logging.info('Email key rules changed, recomputing the keys of {} users'.format(len(rows)))
+        with self.con:
+            self.con.executemany('UPDATE Users SET invite_key = ?, vw_key = ? WHERE id = ?',
+                                 ((self.email_key.key(invite_email), self.email_key.key(vw_email), user_id)
+                                  for user_id, invite_email, vw_email in rows))
+            self.con.execute('INSERT OR REPLACE INTO SyncMeta (key, value) VALUES (?,?)',
+                             (EMAIL_KEY_RULES_META_KEY, self.email_key.spec))
+
+    def iter_managed_users(self, order_by: str = 'vw_user_id') -> Iterator[ManagedUser]:
+        """
+        Streams all managed users sorted by one of their keys (ties in insertion order), backed by the indexes
+
+        :param order_by: One of vw_user_id, invite_key or vw_key
+        """
+        if order_by not in ['vw_user_id', 'invite_key', 'vw_key']:
+            raise ValueError('Invalid order_by: {}'.format(order_by))
+        res = self.con.cursor().execute(
+            "SELECT invite_email, vw_email, vw_user_id, state, invite_key, vw_key FROM Users "
+            "ORDER BY {}, id;".format(order_by))
+        for invite_email, vw_email, vw_user_id, state, invite_key, vw_key in res:
+            yield ManagedUser(vw_user_id=vw_user_id, vw_email=vw_email, enabled=state == 'ENABLED',
+                              invite_email=invite_email, invite_key=invite_key, vw_key=vw_key)
 
     def get_all_managed_users(self) -> List[ManagedUser]:
         """
         Get all managed users (-> All users which have been invited by this script)
         :return: A 3-tuple containing enabled, disabled/deleted and all users
         """
-        res = self.con.cursor().execute("SELECT invite_email, vw_email, vw_user_id, state FROM Users;")
+        res = self.con.cursor().execute(
+            "SELECT invite_email, vw_email, vw_user_id, state, invite_key, vw_key FROM Users;")
         managed_users = []
-        for invite_email, vw_email, vw_user_id, state in res.fetchall():
+        for invite_email, vw_email, vw_user_id, state, invite_key, vw_key in res.fetchall():
             managed_users.append(
                 ManagedUser(
                     vw_user_id=vw_user_id,
                     vw_email=vw_email,
                     enabled=state == 'ENABLED',
-                    invite_email=invite_email
+                    invite_email=invite_email,
+                    invite_key=invite_key,
+                    vw_key=vw_key
                 )
             )
         return managed_users
@@ -68,13 +129,11 @@ class LocalStore:
         :param user_id: User ID returned by Vaultwarden
         :return: None
         """
-        cursor = self.con.cursor()
         try:
-
-            cursor.execute(
-                'INSERT INTO Users (invite_email, vw_email, vw_user_id, last_touched, state) VALUES (?,?,?,?,?)',
-                (user_email, user_email, user_id, time.time(), state))
-            self.con.commit()
+            key = self.email_key.key(user_email)
+            self._write('INSERT INTO Users (invite_email, vw_email, vw_user_id, last_touched, state, invite_key, '
+                        'vw_key) VALUES (?,?,?,?,?,?,?)',
+                        (user_email, user_email, user_id, time.time(), state, key, key))
         except sqlite3.IntegrityError as e:
             logging.warning('Could not insert user {}: {}'.format(user_email, e))
 
@@ -88,9 +147,8 @@ class LocalStore:
         if user_state not in ALLOWED_USER_STATES:
             raise ValueError('Invalid user state. Must be one of: {}'.format(ALLOWED_USER_STATES))
         else:
-            self.con.cursor().execute('UPDATE Users SET state = ?, last_touched = ? WHERE vw_user_id = ?',
-                                      (user_state, time.time(), vw_user_id))
-            self.con.commit()
+            self._write('UPDATE Users SET state = ?, last_touched = ? WHERE vw_user_id = ?',
+                        (user_state, time.time(), vw_user_id))
 
     def update_vw_email(self, vw_user_id: str, new_vw_email: str):
         """
@@ -99,23 +157,253 @@ class LocalStore:
         :param new_vw_email: New email
         :return: None
         """
-        self.con.cursor().execute('UPDATE Users SET vw_email = ?, last_touched = ? WHERE vw_user_id = ?',
-                                  (new_vw_email, time.time(), vw_user_id))
-        self.con.commit()
+        self._write('UPDATE Users SET vw_email = ?, vw_key = ?, last_touched = ? WHERE vw_user_id = ?',
+                    (new_vw_email, self.email_key.key(new_vw_email), time.time(), vw_user_id))
 
     def delete_user_by_id(self, vw_user_id: str):
-        self.con.cursor().execute('DELETE FROM Users WHERE vw_user_id = ?', (vw_user_id,))
-        self.con.commit()
+        self._write('DELETE FROM Users WHERE vw_user_id = ?', (vw_user_id,))
 
     def delete_user_by_email(self, vw_user_email: str):
-        self.con.cursor().execute('DELETE FROM Users WHERE vw_email = ?', (vw_user_email,))
-        self.con.commit()
+        """
+        Deletes the users whose Vaultwarden email has the same key as vw_user_email
+        """
+        self._write('DELETE FROM Users WHERE vw_key = ?', (self.email_key.key(vw_user_email),))
+
+    def _write(self, sql: str, params: tuple):
+        """
+        Execute and commit a single mutation, or buffer it if a batch is active
+        """
+        if self._pending is None:
+            self.con.cursor().execute(sql, params)
+            self.con.commit()
+        else:
+            self._pending.append((sql, params))
+            if self._flush_every and len(self._pending) >= self._flush_every:
+                self.flush()
+
+    @contextlib.contextmanager
+    def batch(self, flush_every: int = 0) -> Iterator["LocalStore"]:
+        """
+        Unit of work: Mutations (register_user, set_user_state, ...) inside the block are buffered and written with
+        executemany in a single transaction when the block completes. If the block raises, buffered mutations are
+        discarded. Note that reads inside the block do not see buffered mutations.
+
+        :param flush_every: Write out the buffer after this many mutations (0: only at the end). Use this if the
+                            mutations mirror calls with external side effects, which cannot be rolled back
+        """
+        if self._pending is not None:
+            # Nested batch, part of the outer unit of work
+            yield self
+            return
+        self._pending = []
+        self._flush_every = flush_every
+        try:
+            yield self
+            self.flush()
+        finally:
+            self._pending = None
+            self._flush_every = 0
+
+    def flush(self):
+        """
+        Write all buffered mutations in one transaction. Consecutive identical statements are grouped into one
+        executemany call. Rows violating a constraint are skipped with a warning (as register_user does).
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        runs: List[Tuple[str, List[tuple]]] = []
+        for sql, params in pending:
+            if runs and runs[-1][0] == sql:
+                runs[-1][1].append(params)
+            else:
+                runs.append((sql, [params]))
+        try:
+            if not self.con.in_transaction:
+                self.con.execute('BEGIN')
+            for sql, rows in runs:
+                self.con.execute('SAVEPOINT batch_run')
+                try:
+                    self.con.executemany(sql, rows)
+                except sqlite3.IntegrityError:
+                    self.con.execute('ROLLBACK TO batch_run')
+                    for row in rows:
+                        try:
+                            self.con.execute(sql, row)
+                        except sqlite3.IntegrityError as e:
+                            logging.warning('Could not write {}: {}'.format(row, e))
+                self.con.execute('RELEASE batch_run')
+            self.con.commit()
+        except Exception:
+            self.con.rollback()
+            raise
+
+    def get_users_version(self) -> int:
+        """
+        Cheap change detection: The returned number changes whenever a row of the Users table changes
+        :return: Change counter of the Users table
+        """
+        row = self.con.cursor().execute("SELECT value FROM SyncMeta WHERE key = 'users_version'").fetchone()
+        return int(row[0])
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.con.cursor().execute('SELECT value FROM SyncMeta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key: str, value: Optional[str]):
+        self._write('INSERT OR REPLACE INTO SyncMeta (key, value) VALUES (?,?)', (key, value))
+
+    def get_source_sync_state(self, source_name: str) -> Optional[SourceSyncState]:
+        """
+        Get the stored position of an incremental email source
+        :param source_name: Name of the email source
+        :return: The stored state or None if the source never completed a sync
+        """
+        row = self.con.cursor().execute(
+            'SELECT cookie, watermark, last_full_sync, server FROM SourceSyncState WHERE source_name = ?',
+            (source_name,)).fetchone()
+        if row is None:
+            return None
+        cookie, watermark, last_full_sync, server = row
+        return SourceSyncState(source_name=source_name, cookie=cookie, watermark=watermark,
+                               last_full_sync=last_full_sync, server=server)
+
+    def get_source_emails(self, source_name: str) -> List[str]:
+        """
+        Get the email addresses currently known for an incremental email source
+        :param source_name: Name of the email source
+        :return: A (possibly) empty list of email addresses
+        """
+        res = self.con.cursor().execute('SELECT email FROM SourceEntries WHERE source_name = ?', (source_name,))
+        return [email for email, in res.fetchall()]
+
+    def get_source_entry_ids(self, source_name: str) -> List[str]:
+        res = self.con.cursor().execute('SELECT entry_id FROM SourceEntries WHERE source_name = ?', (source_name,))
+        return [entry_id for entry_id, in res.fetchall()]
+
+    def apply_source_changes(self, sync_state: SourceSyncState, upserts: Dict[str, str],
+                             deletes: Iterable[str] = (), replace_all: bool = False):
+        """
+        Apply the changes of one incremental email source sync together with its new position in a single transaction,
+        so a restart always continues from a consistent state.
+        :param sync_state: New position of the source
+        :param upserts: Added or changed entries (entry_id -> email)
+        :param deletes: Entry IDs which vanished from the source
+        :param replace_all: If set, all entries not contained in upserts are removed (full resync)
+        :return: None
+        """
+        with self.con:
+            cursor = self.con.cursor()
+            if replace_all:
+                cursor.execute('DELETE FROM SourceEntries WHERE source_name = ?', (sync_state.source_name,))
+            else:
+                cursor.executemany('DELETE FROM SourceEntries WHERE source_name = ? AND entry_id = ?',
+                                   ((sync_state.source_name, entry_id) for entry_id in deletes))
+            cursor.executemany('INSERT OR REPLACE INTO SourceEntries (source_name, entry_id, email) VALUES (?,?,?)',
+                               ((sync_state.source_name, entry_id, email) for entry_id, email in upserts.items()))
+            cursor.execute('INSERT OR REPLACE INTO SourceSyncState (source_name, cookie, watermark, last_full_sync, '
+                           'server) VALUES (?,?,?,?,?)',
+                           (sync_state.source_name, sync_state.cookie, sync_state.watermark,
+                            sync_state.last_full_sync, sync_state.server))
+
+    def save_plan(self, plan_id: str, serialized_plan: str, created: float):
+        """
+        Stores a plan as the active one (keeping the progress of a FAILED plan retried), other active plans are
+        superseded (ABANDONED)
+        """
+        with self.con:
+            self.con.execute("UPDATE Plans SET state = 'ABANDONED' WHERE state = 'ACTIVE' AND plan_id != ?",
+                             (plan_id,))
+            self.con.execute("INSERT OR REPLACE INTO Plans (plan_id, plan, created, state) VALUES (?,?,?,'ACTIVE')",
+                             (plan_id, serialized_plan, created))
+            self.con.execute("DELETE FROM Plans WHERE state != 'ACTIVE' AND plan_id NOT IN "
+                             "(SELECT plan_id FROM Plans WHERE state != 'ACTIVE' ORDER BY created DESC LIMIT ?)",
+                             (KEEP_FINISHED_PLANS,))
+            self.con.execute('DELETE FROM PlanProgress WHERE plan_id NOT IN (SELECT plan_id FROM Plans)')
+
+    def get_plan_state(self, plan_id: str) -> Optional[str]:
+        """
+        :return: ACTIVE, DONE, FAILED, ABANDONED or None if the plan is unknown
+        """
+        row = self.con.cursor().execute('SELECT state FROM Plans WHERE plan_id = ?', (plan_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_plan_state(self, plan_id: str, state: Literal['ACTIVE', 'DONE', 'FAILED', 'ABANDONED']):
+        self._write('UPDATE Plans SET state = ? WHERE plan_id = ?', (state, plan_id))
+
+    def get_active_plan(self) -> Optional[Tuple[str, str, float]]:
+        """
+        :return: (plan_id, serialized plan, creation time) of the plan not applied completely, if any
+        """
+        return self.con.cursor().execute(
+            "SELECT plan_id, plan, created FROM Plans WHERE state = 'ACTIVE' ORDER BY created DESC").fetchone()
+
+    def get_plan_progress(self, plan_id: str) -> Dict[str, Optional[str]]:
+        """
+        :return: Step -> Vaultwarden user ID (invites only) of the applied steps of the plan
+        """
+        res = self.con.cursor().execute('SELECT step, user_id FROM PlanProgress WHERE plan_id = ?', (plan_id,))
+        return dict(res.fetchall())
+
+    def record_plan_step(self, plan_id: str, step: str, user_id: Optional[str] = None):
+        """
+        Marks a step of a plan as applied. Inside batch() it is committed together with the local state update of
+        the same step, so a step is either applied and recorded or neither.
+        """
+        self._write('INSERT OR REPLACE INTO PlanProgress (plan_id, step, user_id) VALUES (?,?,?)',
+                    (plan_id, step, user_id))
 
     def truncate(self):
         """
         Empty local database
         """
         self.con.cursor().execute('DELETE FROM Users;')
+        self.con.commit()
 
-    def __del__(self):
+    def get_rollout_bucket(self, action: str) -> Optional[Tuple[float, float]]:
+        """
+        :return: (tokens, Unix time of the last update) of the token bucket of an action, None if not used yet
+        """
+        return self.con.cursor().execute('SELECT tokens, updated FROM RolloutBuckets WHERE action = ?',
+                                         (action,)).fetchone()
+
+    def set_rollout_bucket(self, action: str, tokens: float, updated: float):
+        self._write('INSERT OR REPLACE INTO RolloutBuckets (action, tokens, updated) VALUES (?,?,?)',
+                    (action, tokens, updated))
+
+    def get_rollout_queue(self, action: str) -> Dict[str, Tuple[float, int]]:
+        """
+        :return: Target -> (Unix time it was first found pending, sequence number), of the changes of an action waiting
+                 to be applied. Sequence numbers grow in the order the targets were queued.
+        """
+        res = self.con.cursor().execute('SELECT target, first_seen, rowid FROM RolloutQueue WHERE action = ?',
+                                        (action,))
+        return {target: (first_seen, seq) for target, first_seen, seq in res.fetchall()}
+
+    def update_rollout_queue(self, action: str, targets: List[str], now: float) -> Dict[str, Tuple[float, int]]:
+        """
+        Makes the queue of an action match the currently pending targets: New ones are added as first seen now (in the
+        order given), targets no longer pending are removed
+
+        :return: The updated queue (see get_rollout_queue)
+        """
+        queue = self.get_rollout_queue(action)
+        pending = set(targets)
+        with self.con:
+            self.con.executemany('DELETE FROM RolloutQueue WHERE action = ? AND target = ?',
+                                 [(action, target) for target in queue.keys() - pending])
+            self.con.executemany('INSERT INTO RolloutQueue (action, target, first_seen) VALUES (?,?,?)',
+                                 [(action, target, now) for target in targets if target not in queue])
+        return self.get_rollout_queue(action)
+
+    def close(self):
+        """
+        Closes the database connection, on the thread that opened it
+        """
         self.con.close()
+        self.closed = True
+
+    def __del__(self):
+        # May run on any thread, a connection closed already must not be touched
+        if not self.closed:
+            self.con.close()
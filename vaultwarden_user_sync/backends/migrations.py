@@ -0,0 +1,206 @@
+import logging
+import sqlite3
+from typing import List
+
+# Triggers maintaining the change counter of the Users table (see LocalStore.get_users_version())
+_USERS_VERSION_TRIGGERS = ['''
+        create trigger if not exists Users_version_{0} after {0} on Users
+        begin
+            update SyncMeta set value = value + 1 where key = 'users_version';
+        end;
+        '''.format(operation) for operation in ['insert', 'update', 'delete']]
+
+# Schema migrations, MIGRATIONS[n] upgrades a database from user_version n to n + 1. Never change a released migration,
+# append a new one instead.
+MIGRATIONS: List[List[str]] = [
+    # 1: Initial schema. Databases created before migrations were introduced (user_version 0) already contain some of
+    #    these tables, hence "if not exists"
+    [
+        '''
+        create table if not exists Users
+        (
+            id           integer not null
+                constraint Users_pk
+                    primary key autoincrement,
+            invite_email TEXT    not null,
+            vw_email     TEXT    not null,
+            vw_user_id   TEXT    not null,
+            last_touched TEXT    not null,
+            state        TEXT    not null
+        );
+        ''',
+        '''
+        create table if not exists SourceEntries
+        (
+            source_name TEXT not null,
+            entry_id    TEXT not null,
+            email       TEXT not null,
+            constraint SourceEntries_pk
+                primary key (source_name, entry_id)
+        );
+        ''',
+        '''
+        create table if not exists SourceSyncState
+        (
+            source_name    TEXT not null
+                constraint SourceSyncState_pk
+                    primary key,
+            cookie         TEXT,
+            watermark      TEXT,
+            last_full_sync REAL not null
+        );
+        ''',
+        '''
+        create table if not exists SyncMeta
+        (
+            key   TEXT not null
+                constraint SyncMeta_pk
+                    primary key,
+            value TEXT
+        );
+        ''',
+        "INSERT OR IGNORE INTO SyncMeta (key, value) VALUES ('users_version', 0)",
+    ] + _USERS_VERSION_TRIGGERS,
+    # 2: Users: One row per Vaultwarden user (duplicates are removed, the most recent row wins), valid states only and
+    #    indexes for all lookup columns
+    [
+        '''
+        create table Users_new
+        (
+            id           integer not null
+                constraint Users_pk
+                    primary key autoincrement,
+            invite_email TEXT    not null,
+            vw_email     TEXT    not null,
+            vw_user_id   TEXT    not null
+                constraint Users_vw_user_id_uq
+                    unique,
+            last_touched TEXT    not null,
+            state        TEXT    not null
+                constraint Users_state_ck
+                    check (state in ('ENABLED', 'DISABLED', 'DELETED'))
+        );
+        ''',
+        '''
+        insert into Users_new (id, invite_email, vw_email, vw_user_id, last_touched, state)
+        select id, invite_email, vw_email, vw_user_id, last_touched, state
+        from Users
+        where id in (select max(id) from Users group by vw_user_id);
+        ''',
+        'drop table Users;',
+        'alter table Users_new rename to Users;',
+        'create index Users_vw_email_idx on Users (vw_email);',
+        'create index Users_invite_email_idx on Users (invite_email);',
+    ] + _USERS_VERSION_TRIGGERS,
+    # 3: SourceSyncState: Remember which LDAP server the position belongs to (NULL for existing rows: unknown)
+    [
+        'alter table SourceSyncState add column server TEXT;',
+    ],
+    # 4: Users: Canonical keys of both email columns (see email_key.py). They are filled by the LocalStore, which
+    #    recomputes them whenever the rules differ from the ones stored as email_key_rules (none yet)
+    [
+        'alter table Users add column invite_key TEXT;',
+        'alter table Users add column vw_key TEXT;',
+        'create index Users_invite_key_idx on Users (invite_key);',
+        'create index Users_vw_key_idx on Users (vw_key);',
+    ],
+    # 5: Change plans (see plan.py) and the steps of each plan already applied
+    [
+        '''
+        create table Plans
+        (
+            plan_id TEXT not null
+                constraint Plans_pk
+                    primary key,
+            plan    TEXT not null,
+            created REAL not null,
+            state   TEXT not null
+                constraint Plans_state_ck
+                    check (state in ('ACTIVE', 'DONE', 'ABANDONED'))
+        );
+        ''',
+        'create index Plans_state_idx on Plans (state);',
+        '''
+        create table PlanProgress
+        (
+            plan_id TEXT not null,
+            step    TEXT not null,
+            user_id TEXT,
+            constraint PlanProgress_pk
+                primary key (plan_id, step)
+        );
+        ''',
+    ],
+    # 6: Throttled rollout, token buckets and the pending changes waiting for them (see rollout.py)
+    [
+        '''
+        create table RolloutBuckets
+        (
+            action  TEXT not null
+                constraint RolloutBuckets_pk
+                    primary key,
+            tokens  REAL not null,
+            updated REAL not null
+        );
+        ''',
+        '''
+        create table RolloutQueue
+        (
+            action     TEXT not null,
+            target     TEXT not null,
+            first_seen REAL not null,
+            constraint RolloutQueue_pk
+                primary key (action, target)
+        );
+        ''',
+    ],
+    # 7: Plans with failed API calls are FAILED instead of DONE, so the failed calls are retried. SQLite cannot alter
+    #    a check constraint, the table is rebuilt
+    [
+        '''
+        create table Plans_new
+        (
+            plan_id TEXT not null
+                constraint Plans_pk
+                    primary key,
+            plan    TEXT not null,
+            created REAL not null,
+            state   TEXT not null
+                constraint Plans_state_ck
+                    check (state in ('ACTIVE', 'DONE', 'FAILED', 'ABANDONED'))
+        );
+        ''',
+        'insert into Plans_new (plan_id, plan, created, state) select plan_id, plan, created, state from Plans;',
+        'drop table Plans;',
+        'alter table Plans_new rename to Plans;',
+        'create index Plans_state_idx on Plans (state);',
+    ],
+]
+
+
+def get_schema_version(con: sqlite3.Connection) -> int:
+    return con.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(con: sqlite3.Connection):
+    """
+    Upgrades the database in place to the latest schema version, each migration runs in its own transaction
+
+    :param con: Connection to the database
+    """
+    version = get_schema_version(con)
+    if version > len(MIGRATIONS):
+        raise RuntimeError('Database schema version {} is newer than supported ({}), refusing to start'.format(
+            version, len(MIGRATIONS)))
+    for target_version in range(version + 1, len(MIGRATIONS) + 1):
+        logging.info('Migrating local state database to schema version {}'.format(target_version))
+        try:
+            if not con.in_transaction:
+                con.execute('BEGIN')
+            for statement in MIGRATIONS[target_version - 1]:
+                con.execute(statement)
+            con.execute('PRAGMA user_version = {}'.format(target_version))
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
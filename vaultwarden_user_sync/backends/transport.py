@@ -0,0 +1,175 @@
+import logging
+import random
+import threading
+import time
+from typing import Optional
+
+import requests
+from requests import Response
+
+# Status codes worth retrying: The request did not reach Vaultwarden or it was (temporarily) unable to handle it
+RETRY_STATUS_CODES = [429, 502, 503, 504]
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised instead of calling Vaultwarden while the circuit breaker is open
+    """
+
+
+class CircuitBreaker:
+    """
+    Fails fast after failure_threshold consecutive failures. After reset_timeout seconds a single trial call is let
+    through (half-open), its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        # How often the circuit opened and how many calls were rejected while it was open
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def is_closed(self) -> bool:
+        return self._opened_at is None
+
+    def before_call(self):
+        """
+        :raises CircuitOpenError: If the call must not be made
+        """
+        self._admit(claim_trial=True)
+
+    def check(self):
+        """
+        Same as before_call, but does not claim the trial call of the half-open state. For failing fast before work
+        leading to a call (which then passes before_call).
+
+        :raises CircuitOpenError: If a call would be rejected
+        """
+        self._admit(claim_trial=False)
+
+    def _admit(self, claim_trial: bool):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if not self._trial_in_flight and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._trial_in_flight = claim_trial
+                return
+            self.rejected += 1
+            raise CircuitOpenError('Circuit breaker open, Vaultwarden considered down (retry in {:.0f}s)'.format(
+                max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            trial_failed = self._trial_in_flight
+            if trial_failed or (self._opened_at is None and self._failures >= self.failure_threshold):
+                if not trial_failed:
+                    self.trips += 1
+                    logging.warning('Vaultwarden circuit breaker opened after {} failure(s)'.format(self._failures))
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+
+class Transport:
+    """
+    HTTP transport for the Vaultwarden connector: Enforces connect/read timeouts, retries idempotent calls with jittered
+    exponential backoff and guards all calls with a circuit breaker.
+    """
+
+    def __init__(self, client: requests.Session, connect_timeout: float = 5, read_timeout: float = 30,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 10,
+                 circuit_breaker: Optional[CircuitBreaker] = None):
+        """
+        :param client: Session to send requests with
+        :param max_retries: Retries after the first attempt, only for idempotent calls (or failed connects)
+        :param backoff_base: Upper bound of the first backoff delay in seconds, doubled on every retry
+        :param backoff_max: Upper bound of any backoff delay in seconds
+        """
+        self.client = client
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self._stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0}
+
+    def _count(self, key: str):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def get_stats(self) -> dict:
+        """
+        :return: Request, retry and failure counts plus circuit breaker trips and rejected (short-circuited) calls
+        """
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['circuit_trips'] = self.circuit_breaker.trips
+        stats['circuit_rejected'] = self.circuit_breaker.rejected
+        return stats
+
+    def backoff_delay(self, attempt: int) -> float:
+        """
+        Full jitter: uniformly distributed between 0 and the exponential backoff for this attempt
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def request(self, method: str, url: str, idempotent: bool = True, timeout: Optional[float] = None,
+                **kwargs) -> Response:
+        """
+        Send a request, passing **kwargs to requests.Session.request
+
+        :param idempotent: If the call may safely be repeated. Non-idempotent calls are only retried if the connection
+                           could not be established
+        :param timeout: Read timeout overriding the default
+        :return: The response, which might still carry an unexpected status code after all retries are exhausted
+        :raises CircuitOpenError: If the circuit breaker is open
+        :raises ConnectionError: If no response could be obtained
+        """
+        self.circuit_breaker.before_call()
+        attempt = 0
+        while True:
+            self._count('requests')
+            error = None
+            response = None
+            try:
+                response = self.client.request(method, url,
+                                               timeout=(self.connect_timeout, timeout or self.read_timeout), **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+
+            if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                self.circuit_breaker.record_success()
+                return response
+
+            self._count('failures')
+            self.circuit_breaker.record_failure()
+            # A request which failed to connect never reached Vaultwarden and can always be repeated
+            can_retry = idempotent or isinstance(error, requests.exceptions.ConnectTimeout)
+            if attempt >= self.max_retries or not can_retry or not self.circuit_breaker.is_closed:
+                if response is not None:
+                    return response
+                raise ConnectionError('{} {} failed: {}'.format(method, url, error)) from error
+
+            if response is not None:
+                # Hands the connection back to the pool, relevant for streamed responses
+                response.close()
+            delay = self.backoff_delay(attempt)
+            logging.debug('{} {} failed ({}), retry {}/{} in {:.2f}s'.format(
+                method, url, error or response.status_code, attempt + 1, self.max_retries, delay))
+            self._count('retries')
+            time.sleep(delay)
+            attempt += 1
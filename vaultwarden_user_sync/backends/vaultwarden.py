@@ -1,10 +1,16 @@
+import json
 import logging
 import os
-import http.cookiejar
-from typing import List, Dict
+import threading
+import time
+from typing import List, Dict, Optional, Tuple, Iterator
 
 import requests
 from requests import Response
+from requests.adapters import HTTPAdapter
+
+from vaultwarden_user_sync.backends.json_stream import iter_json_array
+from vaultwarden_user_sync.backends.transport import Transport, CircuitBreaker
 
 from dataclasses import dataclass
 
@@ -17,7 +23,119 @@ class VaultwardenUser:
 
 
 ADMIN_COOKIE_NAME = 'VW_ADMIN'
-COOKIE_JAR_NAME = '../vaultwarden_cookies.txt'
+# Bytes read from the network per step while decoding the user list
+USERS_CHUNK_SIZE = 64 * 1024
+
+
+def _get_field(item: dict, camel_case: str, pascal_case: str):
+    # Starting with v1.32.0, Vaultwarden starts using (proper) CamelCase fields
+    if camel_case in item:
+        return item[camel_case]
+    if pascal_case in item:
+        return item[pascal_case]
+    lower_case = camel_case.lower()
+    for key, value in item.items():
+        if key.lower() == lower_case:
+            return value
+    raise KeyError(camel_case)
+
+
+class AdminSession:
+    """
+    Keeps the Vaultwarden admin cookie in memory and renews it shortly before it expires.
+
+    Thread safe: If several threads get a 401 for the same cookie, only the first one logs in again, the others reuse
+    the new cookie. The cookie is only written to cookie_file (if set) when it changes.
+    """
+
+    def __init__(self, client: requests.Session, vaultwarden_url: str, admin_token: str,
+                 cookie_file: Optional[str] = None, session_lifetime: int = 1200, refresh_margin: int = 60,
+                 timeout: float = 5):
+        """
+        :param client: Session used for the login request
+        :param cookie_file: Where to persist the cookie across restarts, None keeps it in memory only
+        :param session_lifetime: Assumed cookie lifetime in seconds if Vaultwarden does not send an expiry
+        :param refresh_margin: Renew the cookie this many seconds before it expires
+        """
+        self.client = client
+        self.vaultwarden_url = vaultwarden_url
+        self.admin_token = admin_token
+        self.cookie_file = cookie_file
+        self.session_lifetime = session_lifetime
+        self.refresh_margin = refresh_margin
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._cookie: Optional[str] = None
+        self._expires_at = 0.0
+        # Incremented on every login, lets invalidate() detect whether someone else already renewed the cookie
+        self._generation = 0
+        self.login_count = 0
+        self._load()
+
+    def _load(self):
+        if not self.cookie_file or not os.path.exists(self.cookie_file):
+            return
+        try:
+            with open(self.cookie_file) as f:
+                stored = json.load(f)
+            self._cookie = stored['cookie']
+            self._expires_at = float(stored['expires_at'])
+            logging.debug('Admin cookie loaded from {}'.format(self.cookie_file))
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning('Could not load admin cookie from {}: {}'.format(self.cookie_file, e))
+
+    def _save(self):
+        if not self.cookie_file:
+            return
+        tmp_file = '{}.tmp'.format(self.cookie_file)
+        try:
+            with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump({'cookie': self._cookie, 'expires_at': self._expires_at}, f)
+            os.replace(tmp_file, self.cookie_file)
+        except OSError as e:
+            logging.warning('Could not store admin cookie in {}: {}'.format(self.cookie_file, e))
+
+    def _login(self):
+        auth_request = self.client.post('{}/admin'.format(self.vaultwarden_url), data={'token': self.admin_token},
+                                        timeout=(self.timeout, self.timeout))
+        admin_cookie = None
+        # Vaultwarden may answer with a redirect, the cookie is then set on the first response
+        for response in auth_request.history + [auth_request]:
+            for cookie in response.cookies:
+                if cookie.name == ADMIN_COOKIE_NAME:
+                    admin_cookie = cookie
+        # The cookie is passed explicitly per request, do not keep a second copy in the session
+        self.client.cookies.clear()
+        if auth_request.status_code != 200 or admin_cookie is None:
+            raise ConnectionError(
+                'Could not authenticate against {}/admin: {}'.format(self.vaultwarden_url, auth_request.reason))
+        self._cookie = admin_cookie.value
+        self._expires_at = admin_cookie.expires or time.time() + self.session_lifetime
+        self._generation += 1
+        self.login_count += 1
+        logging.debug('Authentication using token successful, cookie valid until {}'.format(
+            time.strftime('%Y-%m-%d:%H:%M:%S', time.localtime(self._expires_at))))
+        self._save()
+
+    def get_cookie(self) -> Tuple[str, int]:
+        """
+        Get a valid admin cookie, logs in if there is none or it is about to expire
+        :return: The cookie value and its generation (to be passed to invalidate())
+        """
+        with self._lock:
+            if self._cookie is None or time.time() >= self._expires_at - self.refresh_margin:
+                self._login()
+            return self._cookie, self._generation
+
+    def invalidate(self, generation: int):
+        """
+        Report a cookie as rejected by Vaultwarden (401). Logs in again unless another thread already did so.
+        :param generation: Generation returned by get_cookie() together with the rejected cookie
+        """
+        with self._lock:
+            if generation == self._generation:
+                logging.debug('Could not authenticate using cookie, trying token')
+                self._login()
 
 
 class VaultwardenConnector:
@@ -25,62 +143,85 @@ class VaultwardenConnector:
     def __init__(self):
         self.vaultwarden_url = os.getenv('VAULTWARDEN_URL')
         self.vaultwarden_admin_token = os.getenv('VAULTWARDEN_ADMIN_TOKEN')
-        self._auth_cookie = None
+        # Number of concurrent API calls (see ChangeExecutor), the connection pool is sized accordingly
+        self.max_workers = int(os.getenv('VAULTWARDEN_MAX_WORKERS', '4'))
         self.client = requests.Session()
-        self.client.cookies = http.cookiejar.MozillaCookieJar(COOKIE_JAR_NAME)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers, pool_block=True)
+        self.client.mount('http://', adapter)
+        self.client.mount('https://', adapter)
+        self.transport = Transport(
+            self.client,
+            connect_timeout=float(os.getenv('VAULTWARDEN_CONNECT_TIMEOUT', '5')),
+            read_timeout=float(os.getenv('VAULTWARDEN_READ_TIMEOUT', '30')),
+            max_retries=int(os.getenv('VAULTWARDEN_MAX_RETRIES', '3')),
+            circuit_breaker=CircuitBreaker(
+                failure_threshold=int(os.getenv('VAULTWARDEN_CIRCUIT_FAILURES', '5')),
+                reset_timeout=float(os.getenv('VAULTWARDEN_CIRCUIT_RESET_SECONDS', '60'))))
+        self.admin_session = AdminSession(self.client, self.vaultwarden_url, self.vaultwarden_admin_token,
+                                          cookie_file=os.getenv('VAULTWARDEN_COOKIE_FILE'),
+                                          session_lifetime=int(os.getenv('VAULTWARDEN_SESSION_LIFETIME', '1200')),
+                                          timeout=self.transport.connect_timeout)
 
     def make_authenticated_request(self, url: str, payload: dict = None, method='GET',
-                                   expected_return_code=200, timeout=5) -> Response:
+                                   expected_return_code=200, timeout: Optional[float] = None,
+                                   idempotent=True, stream=False) -> Response:
         """
-        Make an authenticated request against the vaultwarden admin API by either using the stored cookie or the VAULTWARDEN_ADMIN_TOKEN
+        Make an authenticated request against the vaultwarden admin API using the admin session cookie, which is
+        (re-)obtained using the VAULTWARDEN_ADMIN_TOKEN when needed
         :param url: Full request url
         :param payload: Json payload
         :param method: GET, POST
         :param expected_return_code: Expected return code, raises an exception if not matching
-        :param timeout: Request and connect timeout in seconds
+        :param timeout: Read timeout in seconds, defaults to VAULTWARDEN_READ_TIMEOUT
+        :param idempotent: If the call may be retried on transient errors (see Transport)
+        :param stream: Do not read the body in advance, the caller has to consume or close the response
         :return: On success, the Response object
         """
-        if os.path.exists(COOKIE_JAR_NAME):
-            self.client.cookies.load()
-            logging.debug('Cookie store found, loading')
-        req = self.client.request(method, url, json=payload, headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        })
+        # Fail fast before even trying to log in (the trial call of a half-open circuit is left to the transport)
+        self.transport.circuit_breaker.check()
+        cookie, generation = self.admin_session.get_cookie()
+        req = self._request(method, url, payload, cookie, timeout, idempotent, stream)
+        if req.status_code == 401:
+            # Cookie revoked or expired early, renew it (once) and try again
+            req.close()
+            self.admin_session.invalidate(generation)
+            cookie, _ = self.admin_session.get_cookie()
+            req = self._request(method, url, payload, cookie, timeout, idempotent, stream)
         if req.status_code == expected_return_code:
             return req
-        elif req.status_code == 401:
-            logging.debug('Could not authenticate using cookie, trying token')
-            auth_request = self.client.post('{}/admin'.format(self.vaultwarden_url),
-                                            data={'token': self.vaultwarden_admin_token}, timeout=(timeout, timeout))
-            if auth_request.status_code == 200:
-                self.client.cookies.save()
-                logging.debug('Authentication using token successful, storing cookie')
-                # Try again
-                return self.make_authenticated_request(url, payload, method, expected_return_code)
-            else:
-                raise ConnectionError(
-                    'Could not authenticate against {}/admin: {}'.format(self.vaultwarden_url, req.reason))
+        req.close()
+        if req.status_code == 401:
+            raise ConnectionError(
+                'Could not authenticate against {}/admin: {}'.format(self.vaultwarden_url, req.reason))
         else:
             raise ConnectionError(
                 'Request returned unexpected return code expected: {} actual: {}'.format(expected_return_code,
                                                                                          req.status_code))
 
-    def get_all_users(self) -> List[VaultwardenUser]:
-        result = self.make_authenticated_request('{}/admin/users'.format(self.vaultwarden_url),
-                                                 expected_return_code=200)
-        all_vw_users = []
-        for user_item in result.json():
-            # Starting with v1.32.0, Vaultwarden starts using (proper) CamelCase fields
-            normalized_user_item = {key.lower(): value for key, value in user_item.items()}
-            all_vw_users.append(
-                VaultwardenUser(
-                    user_id=normalized_user_item['id'],
-                    enabled=normalized_user_item['userenabled'],
-                    email=normalized_user_item['email']
+    def _request(self, method: str, url: str, payload: Optional[dict], cookie: str, timeout: Optional[float],
+                 idempotent: bool, stream: bool = False) -> Response:
+        return self.transport.request(method, url, idempotent=idempotent, timeout=timeout, json=payload,
+                                      stream=stream, cookies={ADMIN_COOKIE_NAME: cookie}, headers={
+                                          "Content-Type": "application/json",
+                                          "Accept": "application/json",
+                                      })
+
+    def iter_all_users(self) -> Iterator[VaultwardenUser]:
+        """
+        Streams the user list: The response is decoded while it arrives, one user at a time, and only the ID, email and
+        state of each user are kept
+        """
+        with self.make_authenticated_request('{}/admin/users'.format(self.vaultwarden_url),
+                                             expected_return_code=200, stream=True) as result:
+            for user_item in iter_json_array(result.iter_content(USERS_CHUNK_SIZE), result.encoding or 'utf-8'):
+                yield VaultwardenUser(
+                    user_id=_get_field(user_item, 'id', 'Id'),
+                    enabled=_get_field(user_item, 'userEnabled', 'UserEnabled'),
+                    email=_get_field(user_item, 'email', 'Email')
                 )
-            )
-        return all_vw_users
+
+    def get_all_users(self) -> List[VaultwardenUser]:
+        return list(self.iter_all_users())
 
     def disable_user(self, vw_user_id: str):
         self.make_authenticated_request('{}/admin/users/{}/disable'.format(self.vaultwarden_url, vw_user_id),
@@ -93,7 +234,7 @@ class VaultwardenConnector:
     def invite_user(self, user_email: str) -> str:
 
         result = self.make_authenticated_request('{}/admin/invite'.format(self.vaultwarden_url), method='POST',
-                                                 expected_return_code=200,
+                                                 expected_return_code=200, idempotent=False,
                                                  payload={'email': user_email})
         normalized_user_item = {key.lower(): value for key, value in result.json().items()}
         created_user_id = normalized_user_item['id']
@@ -107,6 +248,9 @@ class MockVaultwardenConnector(VaultwardenConnector):
     def get_all_users(self) -> List[VaultwardenUser]:
         return list(self._vw_user_by_id.values())
 
+    def iter_all_users(self) -> Iterator[VaultwardenUser]:
+        return iter(self.get_all_users())
+
     def disable_user(self, vw_user_id: str):
         if vw_user_id in self._vw_user_by_id:
             self._vw_user_by_id[vw_user_id].enabled = False
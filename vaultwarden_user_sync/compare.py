@@ -1,8 +1,9 @@
 from dataclasses import dataclass, field, fields
-from typing import Set, Dict, List, Optional
+from typing import Set, Dict, List, Optional, Iterable
 
 from vaultwarden_user_sync.backends.localstore import ManagedUser, LocalStore
 from vaultwarden_user_sync.backends.vaultwarden import VaultwardenUser, VaultwardenConnector
+from vaultwarden_user_sync.email_key import EmailKeyRules, DEFAULT_EMAIL_KEY
 
 
 @dataclass
@@ -22,10 +23,87 @@ class UserWithEmailChanged:
     new_email: str
 
 
+# Flags of UserIndex.email_flags: Where an email address (its key, see email_key.py) shows up
+EMAIL_SRC = 1
+EMAIL_VW = 2
+EMAIL_VW_DISABLED = 4
+# ... as invite email of a managed user (and the state of that user)
+EMAIL_MA_INV = 8
+EMAIL_MA_INV_ENABLED = 16
+EMAIL_MA_INV_DISABLED = 32
+# ... as (current) Vaultwarden email of a managed user
+EMAIL_MA_VW = 64
+
+# Flags of UserIndex.id_flags: Where a Vaultwarden user ID shows up
+ID_MA = 1
+ID_MA_ENABLED = 2
+ID_MA_DISABLED = 4
+ID_VW = 8
+ID_VW_ENABLED = 16
+ID_VW_DISABLED = 32
+
+
+@dataclass
+class UserIndex:
+    """
+    Single pass index over the users of all three sources (Vaultwarden, LocalStore and email source): Every email
+    key and every user ID is mapped to a bit mask of the EMAIL_*/ID_* flags describing where it appears.
+    """
+    email_flags: Dict[str, int] = field(default_factory=dict)
+    id_flags: Dict[str, int] = field(default_factory=dict)
+    vw_users_by_id: Dict[str, VaultwardenUser] = field(default_factory=dict)
+    vw_users_by_email: Dict[str, VaultwardenUser] = field(default_factory=dict)
+    ma_users_by_id: Dict[str, ManagedUser] = field(default_factory=dict)
+    ma_id_by_email: Dict[str, str] = field(default_factory=dict)
+    # Source address by key, only where the first address with this key differs from the key itself
+    source_email_by_key: Dict[str, str] = field(default_factory=dict)
+    # Position of the first source address with this key
+    source_position_by_key: Dict[str, int] = field(default_factory=dict)
+
+    @staticmethod
+    def build(vw_users: Iterable[VaultwardenUser], ma_users: Iterable[ManagedUser],
+              source_email_addresses: Iterable[str], email_key: EmailKeyRules = DEFAULT_EMAIL_KEY) -> "UserIndex":
+        index = UserIndex()
+        email_flags = index.email_flags
+        id_flags = index.id_flags
+
+        for ma_user in ma_users:
+            invite_key = ma_user.invite_key or email_key.key(ma_user.invite_email)
+            vw_key = ma_user.vw_key or email_key.key(ma_user.vw_email)
+            index.ma_users_by_id[ma_user.vw_user_id] = ma_user
+            index.ma_id_by_email[invite_key] = ma_user.vw_user_id
+            id_flags[ma_user.vw_user_id] = (id_flags.get(ma_user.vw_user_id, 0) | ID_MA |
+                                            (ID_MA_ENABLED if ma_user.enabled else ID_MA_DISABLED))
+            email_flags[invite_key] = (email_flags.get(invite_key, 0) | EMAIL_MA_INV |
+                                       (EMAIL_MA_INV_ENABLED if ma_user.enabled else EMAIL_MA_INV_DISABLED))
+            email_flags[vw_key] = email_flags.get(vw_key, 0) | EMAIL_MA_VW
+
+        for vw_user in vw_users:
+            key = email_key.key(vw_user.email)
+            index.vw_users_by_id[vw_user.user_id] = vw_user
+            index.vw_users_by_email[key] = vw_user
+            id_flags[vw_user.user_id] = (id_flags.get(vw_user.user_id, 0) | ID_VW |
+                                         (ID_VW_ENABLED if vw_user.enabled else ID_VW_DISABLED))
+            email_flags[key] = (email_flags.get(key, 0) | EMAIL_VW |
+                                (0 if vw_user.enabled else EMAIL_VW_DISABLED))
+
+        for position, email in enumerate(source_email_addresses):
+            key = email_key.key(email)
+            flags = email_flags.get(key, 0)
+            if not flags & EMAIL_SRC:
+                index.source_position_by_key[key] = position
+                if key != email:
+                    index.source_email_by_key[key] = email
+            email_flags[key] = flags | EMAIL_SRC
+
+        return index
+
+
 @dataclass
 class SyncResult:
     _vw_users_by_id: Dict[str, VaultwardenUser] = field(default_factory=dict)
     _ma_users_by_id: Dict[str, ManagedUser] = field(default_factory=dict)
+    _email_key: EmailKeyRules = DEFAULT_EMAIL_KEY
 
     # UserIDs ENABLED in Vaultwarden since the last sync (compared to local state)
     user_ids_enabled_in_vw: Set[str] = field(default_factory=set)
@@ -36,7 +114,7 @@ class SyncResult:
     # UserIDs  addresses disappeared in Vaultwarden
     user_ids_vanished_in_vw: Set[str] = field(default_factory=set)
 
-    # Email addresses disappeared from email source
+    # Email addresses (keys) disappeared from email source
     email_vanished_in_src: Set[str] = field(default_factory=set)
     email_vanished_in_both: Set[str] = field(default_factory=set)
 
@@ -45,6 +123,8 @@ class SyncResult:
     adoption_candidates: List[VaultwardenUser] = field(default_factory=list)
 
     pending_changes: ChangeSet = field(default_factory=ChangeSet)
+    # Position in the email source of each address in pending_changes.invite_emails
+    invite_positions: Dict[str, int] = field(default_factory=dict)
 
     @staticmethod
     def factory(vwc: VaultwardenConnector, ls: LocalStore, source_email_addresses: List[str]) -> "SyncResult":
@@ -56,132 +136,110 @@ class SyncResult:
         :param source_email_addresses: List of source email addresses (invite candidates)
         :return: Populated SyncResult object
         """
+        return SyncResult.from_inputs(vwc.get_all_users(), ls.get_all_managed_users(), source_email_addresses,
+                                      ls.email_key)
 
-        vw_users = vwc.get_all_users()
-        ma_users = ls.get_all_managed_users()
-
-        # prepare sets (Local state)
-        # user_id
-        ma_user_ids_all = set()
-        ma_user_ids_disabled = set()
-        ma_user_ids_enabled = set()
-        ma_users_by_id = {}
-        ma_id_by_email = {}
-
-        # user_email
-        ma_user_emails_all_vw = set()
-        ma_user_emails_enabled = set()
-        ma_user_emails_disabled = set()
-        ma_users_emails_all_inv = set()
-        ma_users_emails_all_vw = set()
-        for ma_user in ma_users:
-            # user ids
-            ma_user_ids_all.add(ma_user.vw_user_id)
-            ma_users_by_id[ma_user.vw_user_id] = ma_user
-            ma_id_by_email[ma_user.invite_email] = ma_user.vw_user_id
-            if ma_user.enabled:
-                ma_user_ids_enabled.add(ma_user.vw_user_id)
-            else:
-                ma_user_ids_disabled.add(ma_user.vw_user_id)
-
-            # emails
-            ma_user_emails_all_vw.add(ma_user.vw_email)
-            ma_users_emails_all_vw.add(ma_user.vw_email)
-            ma_users_emails_all_inv.add(ma_user.invite_email)
-            if ma_user.enabled:
-                ma_user_emails_enabled.add(ma_user.invite_email)
-            else:
-                ma_user_emails_disabled.add(ma_user.invite_email)
-
-        # prepare sets (Vaultwarden)
-        vw_user_emails = set()
-        vw_user_ids_all = set()
-        vw_user_ids_disabled = set()
-        vw_user_ids_enabled = set()
-        vw_users_by_id = {}
-        vw_users_by_email = {}
-
-        # user_emails
-        vw_user_emails_all = set()
-        vw_user_emails_disabled = set()
-        for vw_user in vw_users:
-            # userIds
-            vw_user_ids_all.add(vw_user.user_id)
-            vw_users_by_id[vw_user.user_id] = vw_user
-            vw_users_by_email[vw_user.email] = vw_user
-            if vw_user.enabled:
-                vw_user_ids_enabled.add(vw_user.user_id)
-            else:
-                vw_user_ids_disabled.add(vw_user.user_id)
-
-            # emails
-            vw_user_emails.add(vw_user.email)
-            if not vw_user.enabled:
-                vw_user_emails_disabled.add(vw_user.email)
-            vw_user_emails_all.add(vw_user.email)
-
-        sync_result = SyncResult(_ma_users_by_id=ma_users_by_id, _vw_users_by_id=vw_users_by_id)
-        # find users who aren't present in the email source and Vaultwarden (but our local state)
-        sync_result.email_vanished_in_src = ma_user_emails_all_vw.difference(vw_user_emails.union(source_email_addresses))
-
-        # find deleted in Vaultwarden
-        sync_result.user_ids_vanished_in_vw = ma_user_ids_all.difference(vw_user_ids_all)
+    @staticmethod
+    def from_inputs(vw_users: List[VaultwardenUser], ma_users: List[ManagedUser],
+                    source_email_addresses: List[str], email_key: EmailKeyRules = DEFAULT_EMAIL_KEY) -> "SyncResult":
+        """
+        Same as factory() but operating on already fetched inputs
 
-        # find disabled users in Vaultwarden
-        sync_result.user_ids_disabled_in_vw = vw_user_ids_disabled.intersection(ma_user_ids_enabled)
+        :param vw_users: All Vaultwarden users
+        :param ma_users: All managed users from the LocalStore
+        :param source_email_addresses: List of source email addresses (invite candidates)
+        :param email_key: Rules deciding which addresses are the same (must match the ones of the LocalStore)
+        :return: Populated SyncResult object
+        """
+        index = UserIndex.build(vw_users, ma_users, source_email_addresses, email_key)
+        sync_result = SyncResult(_ma_users_by_id=index.ma_users_by_id, _vw_users_by_id=index.vw_users_by_id,
+                                 _email_key=email_key)
+        for user_id, flags in index.id_flags.items():
+            sync_result.add_user_id(user_id, flags, index.ma_users_by_id.get(user_id),
+                                    index.vw_users_by_id.get(user_id))
+        for key, flags in index.email_flags.items():
+            sync_result.add_email(key, flags, index.vw_users_by_email.get(key), index.ma_id_by_email.get(key),
+                                  index.source_email_by_key.get(key), index.source_position_by_key.get(key))
+        sync_result.email_vanished_in_src = set(sync_result.email_vanished_in_both)
+        return sync_result
 
-        # find enabled users in Vaultwarden
-        sync_result.user_ids_enabled_in_vw = vw_user_ids_enabled.intersection(ma_user_ids_disabled)
+    def add_user_id(self, user_id: str, flags: int, ma_user: Optional[ManagedUser],
+                    vw_user: Optional[VaultwardenUser]) -> bool:
+        """
+        Classifies one Vaultwarden user ID
 
-        # find users who changed their email address (in Vaultwarden)
-        users_with_email_changes = []
-        for user_id in ma_user_ids_all.intersection(vw_user_ids_all):
-            if ma_users_by_id[user_id].vw_email != vw_users_by_id[user_id].email:
-                users_with_email_changes.append(UserWithEmailChanged(
+        :param flags: ID_* flags of the user ID
+        :param ma_user: Managed user with this ID (if any)
+        :param vw_user: Vaultwarden user with this ID (if any)
+        :return: True if the ID was added to at least one category
+        """
+        found = False
+        if flags & ID_MA:
+            # find deleted in Vaultwarden
+            if not flags & ID_VW:
+                self.user_ids_vanished_in_vw.add(user_id)
+                found = True
+            # find users who changed their email address (in Vaultwarden), a different spelling is no change
+            elif (ma_user.vw_key or self._email_key.key(ma_user.vw_email)) != self._email_key.key(vw_user.email):
+                self.users_with_changed_email.append(UserWithEmailChanged(
                     user_id=user_id,
-                    old_email=ma_users_by_id[user_id].vw_email,
-                    new_email=vw_users_by_id[user_id].email
+                    old_email=ma_user.vw_email,
+                    new_email=vw_user.email
                 ))
-        sync_result.users_with_changed_email = users_with_email_changes
-
-        # find users who aren't present in email source and Vaultwarden (but our local state)
-        sync_result.email_vanished_in_both = ma_user_emails_all_vw.difference(
-            vw_user_emails.union(set(source_email_addresses)))
-
-        # find adoption candidates: Users present in email source + Vaultwarden but not in our local state
-        sync_result.adoption_candidates = [vw_users_by_email[em] for em in
-                                           (set(source_email_addresses).intersection(vw_user_emails)).difference(
-                                               ma_users_emails_all_inv)]
-
-        # And figure out pending changes
-        change_set = ChangeSet()
-
-        # We want to invite users who are:
-        # Present in email source but not preset in Vaultwarden AND NOT present in LocalStore
-        known_user_emails = (set(vw_user_emails_all)
-                             .union(set(ma_users_emails_all_inv))
-                             .union(set(ma_users_emails_all_vw)))
-        change_set.invite_emails = set(source_email_addresses).difference(known_user_emails)
-
-        # We want to disable users who are:
-        # Present in our LocalStore (state=ENABLED) and NOT present in email source
-        disabled_emails = ma_user_emails_enabled.difference(set(source_email_addresses))
-
-        try:
-            change_set.disable_user_ids = {ma_id_by_email[ue] for ue in disabled_emails}
-        except KeyError as ke:
-            print("MA_BY", ma_id_by_email)
-            print("SETS", ma_user_emails_enabled, set(source_email_addresses), disabled_emails)
-            raise KeyError(ke)
-
-        # We want to enable users who are currently disabled both in our local state and in Vaultwarden
-        # and appear in the source email list again
-        enabled_emails = (ma_user_emails_disabled.union(vw_user_emails_disabled)).intersection(
-            source_email_addresses)
-        change_set.enable_user_ids = {ma_id_by_email[ue] for ue in enabled_emails}
-
-        sync_result.pending_changes = change_set
-        return sync_result
+                found = True
+        # find disabled users in Vaultwarden
+        if flags & ID_VW_DISABLED and flags & ID_MA_ENABLED:
+            self.user_ids_disabled_in_vw.add(user_id)
+            found = True
+        # find enabled users in Vaultwarden
+        if flags & ID_VW_ENABLED and flags & ID_MA_DISABLED:
+            self.user_ids_enabled_in_vw.add(user_id)
+            found = True
+        return found
+
+    def add_email(self, email: str, flags: int, vw_user: Optional[VaultwardenUser], ma_user_id: Optional[str],
+                  source_email: Optional[str] = None, source_position: Optional[int] = None) -> bool:
+        """
+        Classifies one email address
+
+        :param email: Key of the address
+        :param flags: EMAIL_* flags of the address
+        :param vw_user: Vaultwarden user with this address (if any)
+        :param ma_user_id: ID of the managed user invited with this address (if any)
+        :param source_email: Address as returned by the email source, if different from the key (used for invites)
+        :param source_position: Position of the address in the email source (used for invites)
+        :return: True if the address (or the managed user) was added to at least one category
+        """
+        change_set = self.pending_changes
+        found = False
+        if flags & EMAIL_SRC:
+            if not flags & (EMAIL_VW | EMAIL_MA_INV | EMAIL_MA_VW):
+                # We want to invite users who are:
+                # Present in email source but not preset in Vaultwarden AND NOT present in LocalStore
+                change_set.invite_emails.add(source_email or email)
+                if source_position is not None:
+                    self.invite_positions[source_email or email] = source_position
+                found = True
+            elif flags & EMAIL_VW and not flags & EMAIL_MA_INV:
+                # find adoption candidates: Users present in email source + Vaultwarden but not in our local state
+                self.adoption_candidates.append(vw_user)
+                found = True
+            # We want to enable users who are currently disabled both in our local state and in Vaultwarden
+            # and appear in the source email list again
+            if flags & (EMAIL_MA_INV_DISABLED | EMAIL_VW_DISABLED) and flags & EMAIL_MA_INV:
+                change_set.enable_user_ids.add(ma_user_id)
+                found = True
+        else:
+            # We want to disable users who are:
+            # Present in our LocalStore (state=ENABLED) and NOT present in email source
+            if flags & EMAIL_MA_INV_ENABLED:
+                change_set.disable_user_ids.add(ma_user_id)
+                found = True
+            # find users who aren't present in email source and Vaultwarden (but our local state)
+            if flags & EMAIL_MA_VW and not flags & EMAIL_VW:
+                self.email_vanished_in_both.add(email)
+                found = True
+        return found
 
     def get_vw_user_by_id(self, user_id: str) -> Optional[VaultwardenUser]:
         return self._vw_users_by_id.get(user_id)
@@ -194,6 +252,7 @@ class SyncResult:
         for field in filter(lambda f: f.name not in [
             "_vw_users_by_id",
             "_ma_users_by_id",
+            "_email_key",
             "pending_changes"
         ], fields(self)):
             summary += f" * {field.name}: {len(self.__getattribute__(field.name))} \n"
@@ -0,0 +1,585 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Dict, Optional, List
+
+from vaultwarden_user_sync.backends.localstore import LocalStore
+from vaultwarden_user_sync.backends.vaultwarden import VaultwardenConnector
+from vaultwarden_user_sync.compare import SyncResult
+from vaultwarden_user_sync.email_sources import EmailSource
+from vaultwarden_user_sync.executor import ChangeExecutor, ChangeResult, ACTION_INVITE, ACTION_DISABLE, ACTION_ENABLE
+from vaultwarden_user_sync.fingerprint import CycleFingerprint
+from vaultwarden_user_sync.plan import (ChangePlan, PlannedChange, local_state_updates, pending_changes, plan_step,
+                                        LOCAL_STATE_STEP)
+from vaultwarden_user_sync.rollout import RolloutPolicy, throttle, refund
+from vaultwarden_user_sync.streaming_diff import DiffSpill
+
+# SyncMeta key of the fingerprint of the last completed cycle
+FINGERPRINT_META_KEY = 'cycle_fingerprint'
+# Number of applied changes after which the local state is committed
+APPLY_FLUSH_EVERY = 100
+
+
+@dataclass
+class CycleOptions:
+    """
+    Settings of a sync cycle
+    """
+    dry_run: bool = False
+    # Maximum number of users to invite/enable/disable at once (MAX_USERS_AT_ONCE)
+    safe_guard: int = 20
+    adopt: bool = False
+    cleanup_vanished_users: bool = False
+    untie_re_enabled_users: bool = False
+    # Diff via sorted merge of spilled inputs (bounded memory) instead of in memory indexes (DIFF_MODE=streaming)
+    streaming_diff: bool = False
+    # Directory of the temporary database used by the streaming diff, defaults to the system temp directory
+    spill_dir: Optional[str] = None
+    # Seconds after which the plan of an interrupted run is abandoned instead of resumed (PLAN_RESUME_MAX_AGE_SECONDS)
+    plan_max_age: float = 3600
+    # Apply large change sets piecewise (ROLLOUT_MODE=throttled), None applies all or nothing (see safe_guard)
+    rollout: Optional[RolloutPolicy] = None
+
+    @staticmethod
+    def from_env(dry_run: bool, safe_guard: int, adopt: bool) -> "CycleOptions":
+        rollout_mode = os.getenv('ROLLOUT_MODE', 'all_or_nothing')
+        if rollout_mode not in ['all_or_nothing', 'throttled']:
+            raise ValueError('Invalid ROLLOUT_MODE. Must be one of: all_or_nothing, throttled')
+        rollout = None
+        if rollout_mode == 'throttled':
+            rollout = RolloutPolicy(max_per_cycle=safe_guard,
+                                    max_per_hour=float(os.getenv('ROLLOUT_MAX_PER_HOUR', '0')),
+                                    abort_threshold=int(os.getenv('ROLLOUT_ABORT_THRESHOLD', '500')),
+                                    order=os.getenv('ROLLOUT_ORDER', 'oldest'))
+        return CycleOptions(dry_run=dry_run, safe_guard=safe_guard, adopt=adopt,
+                            cleanup_vanished_users=os.getenv('CLEANUP_VANISHED_USERS') == '1',
+                            untie_re_enabled_users=os.getenv('UNTIE_RE-ENABLED_USERS') == '1',
+                            streaming_diff=os.getenv('DIFF_MODE', 'memory') == 'streaming',
+                            spill_dir=os.getenv('DIFF_SPILL_DIR') or None,
+                            plan_max_age=float(os.getenv('PLAN_RESUME_MAX_AGE_SECONDS', '3600')),
+                            rollout=rollout)
+
+    @property
+    def log_prefix(self) -> str:
+        return "[DRYRUN] " if self.dry_run else ""
+
+    def fingerprint_settings(self) -> str:
+        """
+        :return: The settings influencing the outcome of a cycle, part of the cycle fingerprint
+        """
+        return (f"cleanup={self.cleanup_vanished_users};untie={self.untie_re_enabled_users};"
+                f"safe_guard={self.safe_guard};rollout={self.rollout.summary() if self.rollout else None}")
+
+
+@dataclass
+class CycleReport:
+    """
+    Outcome of a single sync cycle
+    """
+    # None if the cycle was skipped
+    sync_result: Optional[SyncResult] = None
+    # Inputs unchanged since the last cycle, nothing to do
+    skipped: bool = False
+    safe_guard_exceeded: bool = False
+    # Pending changes per action left for later cycles by the throttled rollout
+    deferred_changes: Dict[str, int] = field(default_factory=dict)
+    # Wall time per phase in seconds
+    phase_durations: Dict[str, float] = field(default_factory=dict)
+    # Peak memory allocated during each phase in bytes, only recorded while tracemalloc is tracing
+    phase_peak_memory: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def found_changes(self) -> bool:
+        """
+        True if the cycle found users to invite, enable or disable
+        """
+        if self.sync_result is None:
+            return False
+        pending_changes = self.sync_result.pending_changes
+        return bool(pending_changes.invite_emails or pending_changes.enable_user_ids or
+                    pending_changes.disable_user_ids)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            memory_before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_durations[name] = self.phase_durations.get(name, 0.0) + time.perf_counter() - start
+            if tracing:
+                self.phase_peak_memory[name] = max(self.phase_peak_memory.get(name, 0),
+                                                   tracemalloc.get_traced_memory()[1] - memory_before)
+
+
+def update_local_state(sync_result: SyncResult, ls: LocalStore, options: CycleOptions):
+    """
+    Reflects changes made in Vaultwarden (and the email source) in the local state
+    """
+    if options.adopt and len(sync_result.adoption_candidates) == 0:
+        logging.info("Nothing to adopt")
+    for update in local_state_updates(sync_result, options.adopt, options.cleanup_vanished_users,
+                                      options.untie_re_enabled_users):
+        if not options.dry_run:
+            update.apply(ls)
+        logging.log(update.level, f'{options.log_prefix} {update.message}')
+
+
+def exceeds_safe_guard(sync_result: SyncResult, safe_guard: int) -> bool:
+    return (len(sync_result.pending_changes.enable_user_ids) > safe_guard or
+            len(sync_result.pending_changes.disable_user_ids) > safe_guard or
+            len(sync_result.pending_changes.invite_emails) > safe_guard)
+
+
+def _log_planned_changes(sync_result: SyncResult, options: CycleOptions):
+    log_prefix = options.log_prefix
+    pending_changes = sync_result.pending_changes
+    for user_email in pending_changes.invite_emails:
+        logging.info(f'{log_prefix} Invite user {user_email}')
+    for user_id in pending_changes.disable_user_ids:
+        logging.info(
+            f'{log_prefix} User {sync_result.get_ma_user_by_id(user_id).vw_email} DISABLED in Vaultwarden')
+    for user_id in pending_changes.enable_user_ids:
+        logging.info(
+            f'{log_prefix} User {sync_result.get_ma_user_by_id(user_id).vw_email} ENABLED in Vaultwarden')
+
+
+def _record_result(result: ChangeResult, label: str, ls: LocalStore, options: CycleOptions, plan_id: str) -> bool:
+    """
+    Records a completed API call in the local state and in the progress of its plan
+
+    :return: False if the call failed
+    """
+    log_prefix = options.log_prefix
+    if not result.ok:
+        logging.error(f'{log_prefix} Could not {result.action} user {label}: {result.error}')
+        return False
+    if result.action == ACTION_INVITE:
+        ls.register_user(result.target, result.user_id)
+        logging.info(f'{log_prefix} Invite user {label}')
+    elif result.action == ACTION_DISABLE:
+        ls.set_user_state(result.target, 'DISABLED')
+        logging.info(f'{log_prefix} User {label} DISABLED in Vaultwarden')
+    else:
+        ls.set_user_state(result.target, 'ENABLED')
+        logging.info(f'{log_prefix} User {label} ENABLED in Vaultwarden')
+    ls.record_plan_step(plan_id, plan_step(result.action, result.target), result.user_id)
+    return True
+
+
+def _skip_applied_calls(plan: ChangePlan, changes: List[PlannedChange], vwc: VaultwardenConnector, ls: LocalStore,
+                        options: CycleOptions) -> List[PlannedChange]:
+    """
+    The last steps of an interrupted plan may have reached Vaultwarden without being recorded. Such calls are
+    recognized by the current Vaultwarden state and only recorded, so no call is made twice.
+
+    :return: The changes still to be made
+    """
+    vw_users = vwc.get_all_users()
+    vw_users_by_id = {vw_user.user_id: vw_user for vw_user in vw_users}
+    vw_users_by_key = {ls.email_key.key(vw_user.email): vw_user for vw_user in vw_users}
+    remaining = []
+    with ls.batch():
+        for change in changes:
+            if change.action == ACTION_INVITE:
+                vw_user = vw_users_by_key.get(ls.email_key.key(change.target))
+                if vw_user is not None:
+                    ls.register_user(change.target, vw_user.user_id)
+                    ls.record_plan_step(plan.plan_id, plan_step(change.action, change.target), vw_user.user_id)
+                    logging.info(f'{options.log_prefix} User {change.label} was already invited')
+                    continue
+            else:
+                vw_user = vw_users_by_id.get(change.target)
+                if vw_user is not None and vw_user.enabled == (change.action == ACTION_ENABLE):
+                    ls.set_user_state(change.target, 'ENABLED' if vw_user.enabled else 'DISABLED')
+                    ls.record_plan_step(plan.plan_id, plan_step(change.action, change.target))
+                    logging.info(f'{options.log_prefix} User {change.label} was already {change.action}d')
+                    continue
+            remaining.append(change)
+    return remaining
+
+
+def _start_plan(plan: ChangePlan, vwc: VaultwardenConnector, ls: LocalStore,
+                options: CycleOptions) -> List[PlannedChange]:
+    """
+    Registers the plan (or picks up its progress) and applies its local state updates
+
+    :return: The API calls still to be made
+    """
+    state = ls.get_plan_state(plan.plan_id)
+    if state == 'DONE':
+        logging.info(f'Plan {plan.plan_id} was already applied')
+        return []
+    # Computed again with unchanged inputs after some of its calls failed: The calls not recorded are retried
+    resuming = state in ['ACTIVE', 'FAILED']
+    if state != 'ACTIVE':
+        ls.save_plan(plan.plan_id, plan.to_json(), plan.created_at)
+    done = ls.get_plan_progress(plan.plan_id)
+    if LOCAL_STATE_STEP not in done:
+        with ls.batch():
+            for update in plan.local_state_updates:
+                update.apply(ls)
+                logging.log(update.level, f'{options.log_prefix} {update.message}')
+            ls.record_plan_step(plan.plan_id, LOCAL_STATE_STEP)
+    changes = pending_changes(plan, done)
+    if resuming:
+        logging.info(f'{"Retrying" if state == "FAILED" else "Resuming"} plan {plan.plan_id}: '
+                     f'{len(plan.changes) - len(changes)} of {len(plan.changes)} call(s) already made')
+        if changes:
+            changes = _skip_applied_calls(plan, changes, vwc, ls, options)
+    return changes
+
+
+def _finish_plan(plan: ChangePlan, ls: LocalStore, failures: int):
+    # A FAILED plan is not resumed at the start of the next cycle. If that cycle computes the same plan (nothing else
+    # changed), its failed calls are retried, otherwise the new plan contains them
+    ls.set_plan_state(plan.plan_id, 'FAILED' if failures else 'DONE')
+    if failures:
+        raise ConnectionError(f'{failures} Vaultwarden API call(s) failed')
+
+
+def apply_plan(plan: ChangePlan, executor: ChangeExecutor, vwc: VaultwardenConnector, ls: LocalStore,
+               options: CycleOptions, throttled: bool = False):
+    """
+    Applies a plan (or the rest of it): Local state updates first, then the Vaultwarden API calls (concurrently).
+    Each completed call is recorded in the local state together with its plan step.
+
+    :param throttled: The changes were admitted by the throttled rollout, the tokens of failed calls are given back
+    :raises ConnectionError: If at least one of the API calls failed, after all others have been processed
+    """
+    changes = _start_plan(plan, vwc, ls, options)
+    labels = {(change.action, change.target): change.label for change in changes}
+    failures: Dict[str, int] = {}
+    # LocalStore writes happen here (in the main thread) in the order the calls complete. They are flushed in chunks,
+    # the Vaultwarden calls cannot be rolled back anyway
+    with ls.batch(flush_every=APPLY_FLUSH_EVERY):
+        try:
+            for result in executor.run_calls([(change.action, change.target) for change in changes]):
+                if not _record_result(result, labels[(result.action, result.target)], ls, options, plan.plan_id):
+                    failures[result.action] = failures.get(result.action, 0) + 1
+        finally:
+            if throttled:
+                refund(ls, options.rollout, failures)
+            # Keep the record of calls already made, even if this loop aborts
+            ls.flush()
+    _finish_plan(plan, ls, sum(failures.values()))
+
+
+async def apply_plan_async(plan: ChangePlan, executor: ChangeExecutor, vwc: VaultwardenConnector, ls: LocalStore,
+                           options: CycleOptions, throttled: bool = False):
+    """
+    Same as apply_plan, the local state is written from the event loop thread
+    """
+    changes = _start_plan(plan, vwc, ls, options)
+    labels = {(change.action, change.target): change.label for change in changes}
+    failures: Dict[str, int] = {}
+    with ls.batch(flush_every=APPLY_FLUSH_EVERY):
+        try:
+            async for result in executor.run_calls_async([(change.action, change.target) for change in changes]):
+                if not _record_result(result, labels[(result.action, result.target)], ls, options, plan.plan_id):
+                    failures[result.action] = failures.get(result.action, 0) + 1
+        finally:
+            if throttled:
+                refund(ls, options.rollout, failures)
+            ls.flush()
+    _finish_plan(plan, ls, sum(failures.values()))
+
+
+def _plan_for(sync_result: SyncResult, fingerprint: str, ls: LocalStore) -> Optional[ChangePlan]:
+    """
+    :return: Plan of the pending changes (the local state is already updated), None if there is nothing to do
+    """
+    plan = ChangePlan.from_sync_result(sync_result, fingerprint, ls.get_users_version(), include_local_state=False)
+    return plan if plan.changes else None
+
+
+def apply_pending_changes(sync_result: SyncResult, fingerprint: str, executor: ChangeExecutor,
+                          vwc: VaultwardenConnector, ls: LocalStore, options: CycleOptions):
+    """
+    Applies the pending changes to Vaultwarden as a plan, so an interrupted run can be resumed
+
+    :raises ConnectionError: If at least one of the API calls failed, after all others have been processed
+    """
+    if options.dry_run:
+        _log_planned_changes(sync_result, options)
+        return
+    plan = _plan_for(sync_result, fingerprint, ls)
+    if plan is not None:
+        apply_plan(plan, executor, vwc, ls, options, throttled=options.rollout is not None)
+
+
+async def apply_pending_changes_async(sync_result: SyncResult, fingerprint: str, executor: ChangeExecutor,
+                                      vwc: VaultwardenConnector, ls: LocalStore, options: CycleOptions):
+    """
+    Same as apply_pending_changes, the local state is written from the event loop thread
+    """
+    if options.dry_run:
+        _log_planned_changes(sync_result, options)
+        return
+    plan = _plan_for(sync_result, fingerprint, ls)
+    if plan is not None:
+        await apply_plan_async(plan, executor, vwc, ls, options, throttled=options.rollout is not None)
+
+
+def resume_interrupted_plan(executor: ChangeExecutor, vwc: VaultwardenConnector, ls: LocalStore,
+                            options: CycleOptions) -> bool:
+    """
+    Finishes the plan of a run that was interrupted (e.g. the process was killed) while applying it. Plans older than
+    options.plan_max_age are abandoned instead, their inputs are likely outdated.
+
+    :return: True if a plan was resumed
+    """
+    if options.dry_run:
+        return False
+    active = ls.get_active_plan()
+    if active is None:
+        return False
+    plan_id, serialized_plan, created = active
+    if time.time() - created > options.plan_max_age:
+        logging.warning(f'Abandoning interrupted plan {plan_id}, it is older than {options.plan_max_age}s')
+        ls.set_plan_state(plan_id, 'ABANDONED')
+        return False
+    apply_plan(ChangePlan.from_json(serialized_plan), executor, vwc, ls, options)
+    return True
+
+
+def _record_source_durations(report: CycleReport, ems: EmailSource):
+    for name, seconds in ems.get_fetch_durations().items():
+        report.phase_durations['source_fetch.{}'.format(name)] = seconds
+
+
+def _check_unchanged(report: CycleReport, fingerprint: CycleFingerprint, ls: LocalStore,
+                     options: CycleOptions) -> str:
+    """
+    Marks the report as skipped if the inputs did not change since the last completed cycle
+
+    :return: Serialized fingerprint
+    """
+    # The email key rules decide which inputs match, a result computed with other rules cannot be reused
+    serialized = '{}|{}'.format(fingerprint.serialize(), ls.email_key.spec)
+    report.skipped = not options.adopt and serialized == ls.get_meta(FINGERPRINT_META_KEY)
+    if report.skipped:
+        logging.debug('Email source, Vaultwarden and local state unchanged since the last cycle, nothing to do')
+    return serialized
+
+
+def _reconcile(report: CycleReport, sync_result: SyncResult, ls: LocalStore,
+               options: CycleOptions) -> Optional[SyncResult]:
+    """
+    Updates the local state according to the differences found
+
+    :return: The sync result with the pending changes to apply now (all, or a part of them with the throttled
+             rollout), None if the safe guard forbids applying anything
+    """
+    report.sync_result = sync_result
+    logging.debug(sync_result.summary())
+
+    with report.phase('update_local_state'):
+        # All local state updates of a cycle are committed at once (or not at all)
+        with ls.batch():
+            update_local_state(sync_result, ls, options)
+
+    if options.rollout is not None:
+        if exceeds_safe_guard(sync_result, options.rollout.abort_threshold):
+            report.safe_guard_exceeded = True
+            logging.warning(
+                f"{options.log_prefix} Users to disable/invite/enable exceed the abort threshold "
+                f"{options.rollout.abort_threshold}, nothing applied. If you are sure increase ROLLOUT_ABORT_THRESHOLD")
+            return None
+        with report.phase('throttle'):
+            sync_result, report.deferred_changes = throttle(sync_result, ls, options.rollout,
+                                                            persist=not options.dry_run)
+        return sync_result
+    if exceeds_safe_guard(sync_result, options.safe_guard):
+        report.safe_guard_exceeded = True
+        logging.warning(
+            f"{options.log_prefix} Users to disable/invite/enable exceed the safe guard limit {options.safe_guard} if you are sure increase the MAX_USERS_AT_ONCE env var")
+        return None
+    return sync_result
+
+
+def _complete(report: CycleReport, fingerprint: str, ls: LocalStore, options: CycleOptions):
+    """
+    Remembers the fingerprint of a completed cycle, the next cycle with identical inputs has nothing to do. Not if
+    changes were deferred: They are due in the next cycles even if nothing changes.
+    """
+    if not options.dry_run and not any(report.deferred_changes.values()):
+        ls.set_meta(FINGERPRINT_META_KEY, fingerprint)
+
+
+def _resume(report: CycleReport, executor: ChangeExecutor, vwc: VaultwardenConnector, ls: LocalStore,
+            options: CycleOptions):
+    if not options.dry_run and ls.get_active_plan() is not None:
+        with report.phase('resume'):
+            resume_interrupted_plan(executor, vwc, ls, options)
+
+
+def _run_streaming_cycle(ems: EmailSource, vwc: VaultwardenConnector, ls: LocalStore, executor: ChangeExecutor,
+                         options: CycleOptions) -> CycleReport:
+    report = CycleReport()
+    _resume(report, executor, vwc, ls, options)
+    with DiffSpill(options.spill_dir, ls.email_key) as spill:
+        with report.phase('source_fetch'):
+            source_hash = spill.add_source_emails(ems.iter_email_list())
+        _record_source_durations(report, ems)
+        with report.phase('vaultwarden_fetch'):
+            vw_hash = spill.add_vw_users(vwc.iter_all_users())
+        with report.phase('fingerprint'):
+            fingerprint = _check_unchanged(report, CycleFingerprint(
+                source=source_hash, vaultwarden=vw_hash, local_store=str(ls.get_users_version()),
+                settings=options.fingerprint_settings()), ls, options)
+        if report.skipped:
+            return report
+        with report.phase('diff'):
+            sync_result = spill.diff(ls)
+
+    to_apply = _reconcile(report, sync_result, ls, options)
+    if to_apply is not None:
+        with report.phase('apply'):
+            apply_pending_changes(to_apply, fingerprint, executor, vwc, ls, options)
+        _complete(report, fingerprint, ls, options)
+    return report
+
+
+def run_cycle(ems: EmailSource, vwc: VaultwardenConnector, ls: LocalStore, executor: ChangeExecutor,
+              options: CycleOptions) -> CycleReport:
+    """
+    Runs one sync cycle: Finish an interrupted plan (if any), fetch inputs, find differences, update the local state
+    and apply pending changes
+
+    :return: Report of the cycle
+    """
+    if options.streaming_diff:
+        return _run_streaming_cycle(ems, vwc, ls, executor, options)
+
+    report = CycleReport()
+    _resume(report, executor, vwc, ls, options)
+    with report.phase('source_fetch'):
+        source_emails = ems.get_email_list()
+    _record_source_durations(report, ems)
+    with report.phase('vaultwarden_fetch'):
+        vw_users = vwc.get_all_users()
+    with report.phase('fingerprint'):
+        fingerprint = _check_unchanged(report, CycleFingerprint.compute(
+            source_emails, vw_users, ls.get_users_version(), options.fingerprint_settings()), ls, options)
+    if report.skipped:
+        return report
+
+    with report.phase('localstore_read'):
+        ma_users = ls.get_all_managed_users()
+    with report.phase('diff'):
+        sync_result = SyncResult.from_inputs(vw_users, ma_users, source_emails, ls.email_key)
+    to_apply = _reconcile(report, sync_result, ls, options)
+    if to_apply is not None:
+        with report.phase('apply'):
+            apply_pending_changes(to_apply, fingerprint, executor, vwc, ls, options)
+        _complete(report, fingerprint, ls, options)
+    return report
+
+
+async def run_cycle_async(ems: EmailSource, vwc: VaultwardenConnector, ls: LocalStore, executor: ChangeExecutor,
+                          options: CycleOptions) -> CycleReport:
+    """
+    Same as run_cycle, but the email source and Vaultwarden are fetched concurrently (in worker threads) while the
+    local state is read. The LocalStore is only used from the event loop thread, since its SQLite connection is bound
+    to the thread that opened it. Changes are applied with at most executor.max_workers calls in flight.
+
+    :return: Report of the cycle, the fetch phase is the wall time of the overlapped inputs
+    """
+    if options.streaming_diff:
+        # The spill database is filled while fetching, one input after another
+        return run_cycle(ems, vwc, ls, executor, options)
+
+    report = CycleReport()
+    _resume(report, executor, vwc, ls, options)
+
+    async def fetch(name: str, get):
+        start = time.perf_counter()
+        try:
+            return await asyncio.to_thread(get)
+        finally:
+            report.phase_durations[name] = time.perf_counter() - start
+
+    with report.phase('fetch'):
+        tasks = [asyncio.ensure_future(fetch('vaultwarden_fetch', vwc.get_all_users))]
+        if ems.thread_safe:
+            tasks.append(asyncio.ensure_future(fetch('source_fetch', ems.get_email_list)))
+        # Let the fetch tasks hand their work to the worker threads before blocking this thread
+        await asyncio.sleep(0)
+        try:
+            if not ems.thread_safe:
+                with report.phase('source_fetch'):
+                    source_emails = ems.get_email_list()
+            with report.phase('localstore_read'):
+                ma_users = ls.get_all_managed_users()
+        finally:
+            # Wait for the fetches even if a local step failed, no worker thread outlives the cycle
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        vw_users = results[0]
+        if ems.thread_safe:
+            source_emails = results[1]
+    _record_source_durations(report, ems)
+
+    with report.phase('fingerprint'):
+        fingerprint = _check_unchanged(report, CycleFingerprint.compute(
+            source_emails, vw_users, ls.get_users_version(), options.fingerprint_settings()), ls, options)
+    if report.skipped:
+        return report
+
+    with report.phase('diff'):
+        sync_result = SyncResult.from_inputs(vw_users, ma_users, source_emails, ls.email_key)
+    to_apply = _reconcile(report, sync_result, ls, options)
+    if to_apply is not None:
+        with report.phase('apply'):
+            await apply_pending_changes_async(to_apply, fingerprint, executor, vwc, ls, options)
+        _complete(report, fingerprint, ls, options)
+    return report
+
+
+def compute_plan(ems: EmailSource, vwc: VaultwardenConnector, ls: LocalStore, options: CycleOptions) -> ChangePlan:
+    """
+    Fetches the inputs and computes the plan of a full cycle (local state updates and API calls) without changing
+    anything
+    """
+    source_emails = ems.get_email_list()
+    vw_users = vwc.get_all_users()
+    users_version = ls.get_users_version()
+    fingerprint = CycleFingerprint.compute(source_emails, vw_users, users_version, options.fingerprint_settings())
+    sync_result = SyncResult.from_inputs(vw_users, ls.get_all_managed_users(), source_emails, ls.email_key)
+    logging.debug(sync_result.summary())
+    return ChangePlan.from_sync_result(sync_result, fingerprint.serialize(), users_version, adopt=options.adopt,
+                                       cleanup_vanished_users=options.cleanup_vanished_users,
+                                       untie_re_enabled_users=options.untie_re_enabled_users)
+
+
+def apply_saved_plan(plan: ChangePlan, executor: ChangeExecutor, vwc: VaultwardenConnector, ls: LocalStore,
+                     options: CycleOptions):
+    """
+    Applies a plan computed by compute_plan(), or continues applying it if a previous run was interrupted or failed
+
+    :raises ValueError: If the local state changed since the plan was computed or the plan exceeds the safe guard
+    """
+    if ls.get_plan_state(plan.plan_id) not in ['ACTIVE', 'DONE', 'FAILED']:
+        if plan.users_version != ls.get_users_version():
+            raise ValueError(f'The local state changed since plan {plan.plan_id} was computed, compute a new plan')
+        if plan.exceeds_safe_guard(options.safe_guard):
+            raise ValueError(f'Plan {plan.plan_id} exceeds the safe guard limit {options.safe_guard}, if you are sure '
+                             f'increase the MAX_USERS_AT_ONCE env var')
+    logging.info(plan.summary())
+    if options.dry_run:
+        for update in plan.local_state_updates:
+            logging.log(update.level, f'{options.log_prefix} {update.message}')
+        for change in plan.changes:
+            logging.info(f'{options.log_prefix} {change.action.capitalize()} user {change.label}')
+        return
+    apply_plan(plan, executor, vwc, ls, options)
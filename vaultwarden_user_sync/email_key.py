@@ -0,0 +1,116 @@
+"""
+Canonical form of email addresses used to match the email source, Vaultwarden and the LocalStore. Addresses are
+compared by their key instead of verbatim, so "John.Doe@Example.com " in LDAP and "john.doe@example.com" in Vaultwarden
+are the same user.
+
+Every key is trimmed and lower cased. On top of that, per domain rules can be configured (EMAIL_KEY_RULES):
+
+    gmail.com=plus,dots;googlemail.com=alias:gmail.com;*=plus
+
+Rules are applied in the order given, rules of "*" apply to every domain after the domain specific ones. If an alias
+rule changes the domain, the rules of the new domain are applied as well. Further rules can be added with
+register_rule().
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+
+# (local part, domain, argument) -> (local part, domain)
+EmailKeyRule = Callable[[str, str, Optional[str]], Tuple[str, str]]
+
+
+def _strip_plus(local: str, domain: str, argument: Optional[str]) -> Tuple[str, str]:
+    # Sub-addressing: john+vault@example.com is delivered to john@example.com. Another separator can be given as
+    # argument (e.g. plus:- for john-vault@example.com)
+    return local.split(argument or '+', 1)[0], domain
+
+
+def _strip_dots(local: str, domain: str, argument: Optional[str]) -> Tuple[str, str]:
+    return local.replace('.', ''), domain
+
+
+def _alias_domain(local: str, domain: str, argument: Optional[str]) -> Tuple[str, str]:
+    if not argument:
+        raise ValueError('The alias rule requires the target domain as argument (alias:example.com)')
+    return local, argument.strip().lower()
+
+
+RULES: Dict[str, EmailKeyRule] = {
+    'plus': _strip_plus,
+    'dots': _strip_dots,
+    'alias': _alias_domain,
+}
+
+
+def register_rule(name: str, rule: EmailKeyRule):
+    """
+    Makes a rule available to EMAIL_KEY_RULES
+
+    :param name: Name used in the rule specification
+    :param rule: Function mapping (local part, domain, argument) to the normalized (local part, domain)
+    """
+    RULES[name] = rule
+
+
+class EmailKeyRules:
+    """
+    Computes the key of an email address according to the configured per domain rules
+    """
+
+    def __init__(self, domain_rules: Optional[Dict[str, List[Tuple[str, Optional[str]]]]] = None):
+        """
+        :param domain_rules: Domain (lower case, or * for all) -> list of (rule name, argument)
+        """
+        self.domain_rules = domain_rules or {}
+        for rules in self.domain_rules.values():
+            for name, _ in rules:
+                if name not in RULES:
+                    raise ValueError('Unknown email key rule: {}. Available: {}'.format(name, ', '.join(RULES)))
+
+    @staticmethod
+    def from_spec(spec: Optional[str]) -> "EmailKeyRules":
+        """
+        :param spec: Rule specification as described in the module documentation, empty for no rules
+        """
+        domain_rules = {}
+        for domain_spec in (spec or '').split(';'):
+            if not domain_spec.strip():
+                continue
+            domain, _, rules = domain_spec.partition('=')
+            domain_rules.setdefault(domain.strip().lower(), []).extend(
+                (name.strip(), argument.strip() or None)
+                for name, _, argument in (rule.partition(':') for rule in rules.split(',') if rule.strip()))
+        return EmailKeyRules(domain_rules)
+
+    @property
+    def spec(self) -> str:
+        """
+        Normalized rule specification, changes whenever the keys of stored addresses may change
+        """
+        return ';'.join('{}={}'.format(domain, ','.join(name if argument is None else '{}:{}'.format(name, argument)
+                                                        for name, argument in rules))
+                        for domain, rules in sorted(self.domain_rules.items()))
+
+    def _apply(self, local: str, domain: str, rules: List[Tuple[str, Optional[str]]]) -> Tuple[str, str]:
+        for name, argument in rules:
+            local, domain = RULES[name](local, domain, argument)
+        return local, domain
+
+    def key(self, email: str) -> str:
+        """
+        :param email: Email address as found in one of the inputs
+        :return: Its canonical key
+        """
+        email = email.strip().lower()
+        if not self.domain_rules:
+            return email
+        local, at, domain = email.rpartition('@')
+        if not at:
+            return email
+        local, new_domain = self._apply(local, domain, self.domain_rules.get(domain, []))
+        if new_domain != domain:
+            local, new_domain = self._apply(local, new_domain, self.domain_rules.get(new_domain, []))
+        local, new_domain = self._apply(local, new_domain, self.domain_rules.get('*', []))
+        return '{}@{}'.format(local, new_domain)
+
+
+# No domain rules: Trimmed and lower cased only
+DEFAULT_EMAIL_KEY = EmailKeyRules()
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Iterator, Dict
 
 
 class EmailSource(ABC):
@@ -7,6 +7,8 @@ class EmailSource(ABC):
     Generic Email source base class
     """
     source_name: str
+    # False if get_email_list must run on the thread owning the LocalStore (e.g. because it writes to it)
+    thread_safe: bool = True
 
     def __init__(self, source_name: str):
         self.source_name = source_name
@@ -18,3 +20,40 @@ class EmailSource(ABC):
         :return: A (possibly) empty list of email addresses
         """
         ...
+
+    def iter_email_list(self) -> Iterator[str]:
+        """
+        Streaming variant of get_email_list(), sources able to deliver addresses piecewise override this
+        """
+        return iter(self.get_email_list())
+
+    def config_key(self) -> str:
+        """
+        :return: Identifies the configuration of this source, a snapshot taken under another key is not reused (see
+                 CachedEmailSource)
+        """
+        return self.source_name
+
+    def describe(self) -> List[str]:
+        """
+        :return: Lines describing this source (and the ones it combines) for the startup log
+        """
+        return [self.source_name]
+
+    def get_fetch_durations(self) -> Dict[str, float]:
+        """
+        :return: Seconds the last fetch took per underlying source, for sources combining others
+        """
+        return {}
+
+    def get_server_stats(self) -> Dict[str, Dict[str, dict]]:
+        """
+        :return: Health of the servers behind this source: source_name -> server -> stats (see ServerPool.get_stats)
+        """
+        return {}
+
+    def close(self):
+        """
+        Releases connections kept open between fetches
+        """
+        pass
@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import List, Dict, Optional
+
+from vaultwarden_user_sync.email_sources import EmailSource
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+class CachedEmailSource(EmailSource):
+    """
+    Serves the addresses of another source from a snapshot file, so a restart (or a --runonce run) within ttl seconds
+    of the last fetch does not wait for the directory. Only the first call after loading the snapshot is served from
+    it, a fetch then runs in the background to renew the snapshot for the next start. All later calls fetch in the
+    foreground, a running process never works with the result of an earlier cycle.
+
+    A snapshot older than ttl is never served, the fetch then runs in the foreground (failing the cycle if the source
+    fails). A failing background fetch keeps the snapshot file as it is.
+    """
+
+    def __init__(self, source: EmailSource, snapshot_file: str, ttl: float, force_refresh: bool = False):
+        """
+        :param source: Source to cache, must be thread_safe since it is also fetched in the background
+        :param snapshot_file: Where the last result is kept across restarts
+        :param ttl: Maximum age of a served snapshot in seconds
+        :param force_refresh: Ignore an existing snapshot, the first call fetches in the foreground
+        """
+        super().__init__(source.source_name)
+        if not source.thread_safe:
+            raise ValueError('Email source {} cannot be fetched in the background'.format(source.source_name))
+        self.source = source
+        self.snapshot_file = snapshot_file
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._emails: Optional[List[str]] = None
+        # Unix time of the fetch the snapshot results from (not monotonic, it outlives the process)
+        self._fetched_at = 0.0
+        self._refresh_thread: Optional[threading.Thread] = None
+        # Whether the loaded snapshot had its (single) chance to be served
+        self._snapshot_used = False
+        # snapshot: calls served from the snapshot, fetched: foreground fetches, refreshed/refresh_errors: background
+        self.stats = {'snapshot': 0, 'fetched': 0, 'refreshed': 0, 'refresh_errors': 0}
+        if force_refresh:
+            logging.info('Refresh of email source {} forced, not using the snapshot'.format(self.source_name))
+        else:
+            self._load()
+
+    def _load(self):
+        if not os.path.exists(self.snapshot_file):
+            return
+        try:
+            with open(self.snapshot_file) as f:
+                stored = json.load(f)
+            if stored.get('version') != SNAPSHOT_FORMAT_VERSION or stored.get('config_key') != self.config_key():
+                logging.info('Email source snapshot {} was taken with another configuration, ignoring it'.format(
+                    self.snapshot_file))
+                return
+            self._emails = list(stored['emails'])
+            self._fetched_at = float(stored['fetched_at'])
+            logging.debug('Email source snapshot loaded from {}: {} addresses, {:.0f}s old'.format(
+                self.snapshot_file, len(self._emails), time.time() - self._fetched_at))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning('Could not load email source snapshot from {}: {}'.format(self.snapshot_file, e))
+
+    def _save(self, emails: List[str], fetched_at: float):
+        tmp_file = '{}.tmp'.format(self.snapshot_file)
+        try:
+            # Email addresses of the whole directory, readable by the owner only
+            with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump({'version': SNAPSHOT_FORMAT_VERSION, 'config_key': self.config_key(),
+                           'fetched_at': fetched_at, 'emails': emails}, f)
+            os.replace(tmp_file, self.snapshot_file)
+        except OSError as e:
+            logging.warning('Could not store email source snapshot in {}: {}'.format(self.snapshot_file, e))
+
+    def _fetch(self) -> List[str]:
+        fetched_at = time.time()
+        emails = self.source.get_email_list()
+        with self._lock:
+            # A slower fetch started earlier must not overwrite a newer result
+            if fetched_at >= self._fetched_at:
+                self._emails, self._fetched_at = emails, fetched_at
+                self._save(emails, fetched_at)
+        return emails
+
+    def _background_refresh(self):
+        try:
+            emails = self._fetch()
+        except Exception as e:
+            self.stats['refresh_errors'] += 1
+            logging.warning('Background refresh of email source {} failed, keeping the snapshot: {}'.format(
+                self.source_name, e))
+            return
+        self.stats['refreshed'] += 1
+        logging.debug('Email source {} refreshed in the background: {} addresses'.format(self.source_name,
+                                                                                         len(emails)))
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=self._background_refresh,
+                                                    name='refresh-{}'.format(self.source_name), daemon=True)
+            self._refresh_thread.start()
+
+    def wait_for_refresh(self, timeout: Optional[float] = None):
+        """
+        Waits for a running background refresh (if any) to complete
+        """
+        thread = self._refresh_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def snapshot_age(self) -> Optional[float]:
+        """
+        :return: Seconds since the fetch the current snapshot results from, None without snapshot
+        """
+        with self._lock:
+            return None if self._emails is None else time.time() - self._fetched_at
+
+    def force_refresh(self):
+        """
+        Drops the snapshot, the next call fetches in the foreground
+        """
+        with self._lock:
+            self._emails = None
+            self._fetched_at = 0.0
+
+    def get_email_list(self) -> List[str]:
+        with self._lock:
+            first_call, self._snapshot_used = not self._snapshot_used, True
+            emails = self._emails
+        age = self.snapshot_age()
+        if first_call and age is not None and age < self.ttl:
+            self.stats['snapshot'] += 1
+            logging.debug('Serving {} addresses of email source {} from the {:.0f}s old snapshot'.format(
+                len(emails), self.source_name, age))
+            self._refresh_in_background()
+            return list(emails)
+        # Not fetching the source twice at the same time
+        self.wait_for_refresh()
+        self.stats['fetched'] += 1
+        return list(self._fetch())
+
+    def config_key(self) -> str:
+        return self.source.config_key()
+
+    def describe(self) -> List[str]:
+        return self.source.describe() + ['Email source snapshot: {} (served for {:g}s)'.format(self.snapshot_file,
+                                                                                               self.ttl)]
+
+    def get_fetch_durations(self) -> Dict[str, float]:
+        return self.source.get_fetch_durations()
+
+    def get_server_stats(self) -> Dict[str, Dict[str, dict]]:
+        return self.source.get_server_stats()
+
+    def close(self):
+        """
+        Lets a running background refresh complete, so the next start finds a fresh snapshot
+        """
+        self.wait_for_refresh()
+        self.source.close()
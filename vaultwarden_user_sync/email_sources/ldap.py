@@ -1,13 +1,36 @@
 import os
-from typing import List
+import threading
+import time
+from typing import List, Iterator, Optional, Tuple, Callable, TypeVar, Dict, Collection
 
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
 from ldap.ldapobject import SimpleLDAPObject
+from ldap.syncrepl import SyncRequestControl, SyncStateControl, SyncDoneControl, SyncInfoMessage
 
 import ldap
 import logging
 import contextlib
 
+from vaultwarden_user_sync.backends.localstore import LocalStore, SourceSyncState
 from vaultwarden_user_sync.email_sources import EmailSource
+from vaultwarden_user_sync.email_sources.server_pool import ServerPool
+from vaultwarden_user_sync.email_sources.shared import LdapQuery
+
+# Sync Request Control (RFC 4533), advertised in the supportedControl attribute of the root DSE
+SYNC_REQUEST_CONTROL_OID = '1.3.6.1.4.1.4203.1.9.1.1'
+# Root DSE attribute only Active Directory exposes, AD tracks changes via uSNChanged instead of modifyTimestamp
+AD_ROOT_DSE_ATTR = 'highestCommittedUSN'
+# Errors meaning the server (not the request) is the problem, another server may do better
+FAILOVER_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.UNAVAILABLE, ldap.BUSY)
+
+T = TypeVar('T')
+
+
+class AllServersFailed(ldap.SERVER_DOWN):
+    """
+    None of the configured LDAP servers accepted a bind
+    """
 
 
 class LdapConnector(EmailSource):
@@ -17,27 +40,329 @@ class LdapConnector(EmailSource):
     Parameters are set through environment variables
     """
 
-    def __init__(self, source_name: str):
+    def __init__(self, source_name: str, env_prefix: str = 'LDAP_'):
+        """
+        :param env_prefix: Prefix of the environment variables of this source (e.g. LDAP_HR_ reads LDAP_HR_SERVER).
+                           Variables not set with this prefix fall back to the LDAP_ ones
+        """
         super().__init__(source_name)
-        self.ldap_server = os.getenv('LDAP_SERVER')
-        self.ldap_scheme = os.getenv('LDAP_SCHEME', 'ldaps')
-        self.ldap_tls = os.getenv('LDAP_TLS', 'true')
-        self.ldap_bind_dn = os.getenv('LDAP_BIND_DN')
-        self.ldap_bind_pw = os.getenv('LDAP_BIND_PW')
-        self.ldap_search_filter = os.getenv('LDAP_SEARCH_FILTER')
-        self.ldap_base_dn = os.getenv('LDAP_BASE_DN')
-        self.ldap_email_attr = os.getenv('LDAP_EMAIL_ATTR', 'email')
+        self.env_prefix = env_prefix
+        # Comma separated list of equivalent servers (e.g. the domain controllers of one domain)
+        self.ldap_servers = [server.strip() for server in (self._setting('SERVER') or '').split(',') if server.strip()]
+        if not self.ldap_servers:
+            raise ValueError('{}SERVER is not set'.format(env_prefix))
+        # Server of the current connection
+        self.ldap_server = self.ldap_servers[0]
+        self.server_pool = ServerPool(self.ldap_servers,
+                                      eject_after=int(self._setting('EJECT_AFTER_FAILURES', '2')),
+                                      eject_seconds=float(self._setting('EJECT_SECONDS', '30')),
+                                      max_eject_seconds=float(self._setting('MAX_EJECT_SECONDS', '600')))
+        self.ldap_scheme = self._setting('SCHEME', 'ldaps')
+        self.ldap_tls = self._setting('TLS', 'true')
+        self.ldap_bind_dn = self._setting('BIND_DN')
+        self.ldap_bind_pw = self._setting('BIND_PW')
+        self.ldap_search_filter = self._setting('SEARCH_FILTER')
+        self.ldap_base_dn = self._setting('BASE_DN')
+        self.ldap_email_attr = self._setting('EMAIL_ATTR', 'email')
+        # 0 disables the Simple Paged Results control (RFC 2696) and fetches everything in one response
+        self.ldap_page_size = int(self._setting('PAGE_SIZE', '500'))
+        # Keep the bound connection open between sync cycles
+        self.ldap_persistent = self._setting('PERSISTENT_CONNECTION', '1') == '1'
+        # Reconnect proactively if the connection was not used for this long (servers drop idle connections)
+        self.ldap_idle_timeout = int(self._setting('IDLE_TIMEOUT_SECONDS', '600'))
+        self.ldap_network_timeout = int(self._setting('NETWORK_TIMEOUT_SECONDS', '10'))
+        # Limit of each LDAP operation, so a hanging server cannot block the fetch (and its worker) indefinitely
+        self.ldap_timeout = float(self._setting('TIMEOUT_SECONDS', '300'))
+
+        # Persistent connection while not in use (see _checkout), and its server
+        self._conn: Optional[SimpleLDAPObject] = None
+        self._conn_server: Optional[str] = None
+        self._conn_last_used = 0.0
+        self._conn_lock = threading.Lock()
+        # opened: first bind, reused: existing bind used again, reopened: rebind after disconnect/idle timeout or to a
+        # faster server
+        self.bind_stats = {'opened': 0, 'reused': 0, 'reopened': 0}
+
+    def _setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        return os.getenv(self.env_prefix + key, os.getenv('LDAP_' + key, default))
+
+    @property
+    def query(self) -> LdapQuery:
+        return LdapQuery(self.ldap_base_dn, self.ldap_search_filter, self.ldap_email_attr)
+
+    def config_key(self) -> str:
+        return self.config_key_for(self.query)
+
+    def describe(self) -> List[str]:
+        return [f"LDAP server ({self.source_name}): {', '.join(self.ldap_servers)} {self.ldap_base_dn}"]
+
+    def config_key_for(self, query: LdapQuery) -> str:
+        """
+        :return: config_key() of a source running query on this connector
+        """
+        return '{}@{}|{}|{}|{}'.format(self.ldap_bind_dn, ','.join(self.ldap_servers), query.base_dn,
+                                       query.search_filter, query.email_attr)
+
+    def connection_key(self) -> tuple:
+        """
+        :return: The settings of the connection, connectors with equal keys can run each other's queries (see search)
+        """
+        return (tuple(self.ldap_servers), self.ldap_scheme, self.ldap_bind_dn, self.ldap_bind_pw, self.ldap_page_size,
+                self.ldap_persistent, self.ldap_network_timeout)
+
+    def _bind(self, server: str) -> SimpleLDAPObject:
+        conn = ldap.initialize('{}://{}'.format(self.ldap_scheme, server))
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.ldap_network_timeout)
+        conn.set_option(ldap.OPT_TIMEOUT, self.ldap_timeout)
+        # if self.ldap_tls:
+        #     conn.start_tls_s()
+        conn.simple_bind_s(who=self.ldap_bind_dn, cred=self.ldap_bind_pw)
+        return conn
+
+    def _open_connection(self, avoid: Collection[str] = ()) -> Tuple[SimpleLDAPObject, str]:
+        """
+        Binds to the fastest healthy server (see ServerPool), moving on to the next one if a server is unreachable
+
+        :param avoid: Servers to try last
+        :return: The bound connection and its server
+        """
+        errors = []
+        for server in self.server_pool.candidates(avoid):
+            start = time.perf_counter()
+            try:
+                conn = self._bind(server)
+            except FAILOVER_ERRORS as e:
+                self.server_pool.record_failure(server, e)
+                logging.warning('LDAP bind to {} failed ({}), trying the next server'.format(server, e))
+                errors.append('{}: {}'.format(server, e))
+                continue
+            self.server_pool.record_success(server, time.perf_counter() - start)
+            logging.debug('LDAP server health: {}'.format(self.server_pool.get_stats()))
+            if server != self.ldap_server:
+                logging.info('LDAP source {} now uses server {}'.format(self.source_name, server))
+            self.ldap_server = server
+            return conn, server
+        raise AllServersFailed({'desc': 'No LDAP server available', 'info': '; '.join(errors)})
+
+    @staticmethod
+    def _unbind(conn: SimpleLDAPObject):
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _is_alive(self, conn: SimpleLDAPObject, server: str) -> bool:
+        """
+        Cheap liveness probe: Reads the root DSE without requesting any attributes
+        """
+        start = time.perf_counter()
+        try:
+            conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)', attrlist=['1.1'])
+        except ldap.LDAPError as e:
+            logging.info('LDAP connection to {} lost ({}), rebinding'.format(server, e))
+            return False
+        self.server_pool.record_success(server, time.perf_counter() - start)
+        return True
+
+    def _is_outranked(self, server: str) -> bool:
+        if not self.server_pool.is_outranked(server):
+            return False
+        logging.info('LDAP server {} fell behind a faster one, rebinding'.format(server))
+        return True
+
+    def _count_bind(self, kind: str):
+        with self._conn_lock:
+            self.bind_stats[kind] += 1
+        logging.debug('LDAP bind stats: {}'.format(self.bind_stats))
+
+    def _checkout(self, avoid: Collection[str] = ()) -> Tuple[SimpleLDAPObject, str]:
+        """
+        Takes the persistent connection (rebinding it if it went stale), or binds a new one if there is none or it is
+        in use. The lock is only held while taking the connection, not while it is used.
+
+        :param avoid: Servers to use only if no other one is available (the persistent connection is not used if it
+                      is bound to one of them)
+        :return: The bound connection and its server
+        """
+        conn = None
+        if self.ldap_persistent:
+            with self._conn_lock:
+                conn, server, last_used = self._conn, self._conn_server, self._conn_last_used
+                self._conn = None
+        if conn is None:
+            conn, server = self._open_connection(avoid)
+            self._count_bind('opened')
+        elif (server in avoid or time.monotonic() - last_used > self.ldap_idle_timeout or self._is_outranked(server)
+              or not self._is_alive(conn, server)):
+            self._unbind(conn)
+            conn, server = self._open_connection(avoid)
+            self._count_bind('reopened')
+        else:
+            self._count_bind('reused')
+        self.ldap_server = server
+        return conn, server
+
+    def _checkin(self, conn: SimpleLDAPObject, server: str, error: Optional[Exception] = None):
+        """
+        Hands a connection taken by _checkout() back. It becomes the persistent connection if that slot is free,
+        otherwise (or if the connection failed) it is closed.
+        """
+        if error is not None:
+            self.server_pool.record_failure(server, error)
+        elif self.ldap_persistent:
+            with self._conn_lock:
+                if self._conn is None:
+                    self._conn, self._conn_server, self._conn_last_used = conn, server, time.monotonic()
+                    return
+        # Not persistent, not needed, or in unknown state after a failure (the next call binds again)
+        self._unbind(conn)
 
     @contextlib.contextmanager
-    def connect(self) -> SimpleLDAPObject:
-        conn = ldap.initialize('{}://{}'.format(self.ldap_scheme, self.ldap_server))
+    def connect(self) -> Iterator[SimpleLDAPObject]:
+        """
+        Bound connection for the duration of the context. Concurrent users (e.g. tenants sharing this connector) each
+        get a connection of their own, so a slow or abandoned consumer does not block the others.
+        """
+        conn, server = self._checkout()
+        error = None
         try:
-            # if self.ldap_tls:
-            #     conn.start_tls_s()
-            conn.simple_bind_s(who=self.ldap_bind_dn, cred=self.ldap_bind_pw)
             yield conn
+        except FAILOVER_ERRORS as e:
+            error = e
+            raise
         finally:
-            conn.unbind_s()
+            self._checkin(conn, server, error)
+
+    def _run_with_failover(self, search: Callable[[SimpleLDAPObject, str], T]) -> T:
+        """
+        Runs search on a bound connection. If the server goes away during the search, it is repeated on the next
+        server within the same cycle, at most once per configured server.
+
+        :param search: Does the actual work given the connection and its server, must not have side effects before it
+                       completes
+        :return: Result of search
+        """
+        # Servers that failed during this call, not ejected yet after a single failure they would still rank first
+        failed_servers = []
+        for attempt in range(1, len(self.ldap_servers) + 1):
+            conn, server = self._checkout(avoid=failed_servers)
+            error = None
+            try:
+                return search(conn, server)
+            except FAILOVER_ERRORS as e:
+                error = e
+                failed_servers.append(server)
+                if attempt == len(self.ldap_servers):
+                    raise
+                logging.warning('LDAP search on {} failed ({}), failing over'.format(server, e))
+            finally:
+                self._checkin(conn, server, error)
+
+    def get_server_stats(self) -> Dict[str, Dict[str, dict]]:
+        return {self.source_name: self.server_pool.get_stats()}
+
+    def close(self):
+        """
+        Closes the persistent connection (if any)
+        """
+        with self._conn_lock:
+            conn, self._conn = self._conn, None
+        if conn is not None:
+            self._unbind(conn)
+
+    def _iter_result_pages(self, conn: SimpleLDAPObject, search_filter: Optional[str] = None,
+                           attrlist: Optional[List[str]] = None, base_dn: Optional[str] = None,
+                           server: Optional[str] = None) -> Iterator[List[Tuple[Optional[str], dict]]]:
+        """
+        Runs the search and yields the result page by page. Only LDAP_EMAIL_ATTR is requested from the server.
+
+        :param conn: Bound connection
+        :param search_filter: Filter to use instead of LDAP_SEARCH_FILTER
+        :param attrlist: Attributes to request instead of LDAP_EMAIL_ATTR
+        :param base_dn: Base DN to use instead of LDAP_BASE_DN
+        :param server: Server conn is bound to, the time it takes for each page is recorded as its latency
+        :return: Iterator over lists of (dn, attributes) tuples
+        """
+        search_filter = search_filter or self.ldap_search_filter
+        attrlist = attrlist or [self.ldap_email_attr]
+        base_dn = base_dn or self.ldap_base_dn
+        if self.ldap_page_size <= 0:
+            start = time.perf_counter()
+            result_data = conn.search_s(base_dn, ldap.SCOPE_SUBTREE, search_filter, attrlist=attrlist)
+            if server is not None:
+                self.server_pool.record_success(server, time.perf_counter() - start)
+            yield result_data
+            return
+
+        # Non-critical: Servers without paging support just return the full result in one go
+        page_control = SimplePagedResultsControl(criticality=False, size=self.ldap_page_size, cookie='')
+        while True:
+            start = time.perf_counter()
+            msg_id = conn.search_ext(base_dn, ldap.SCOPE_SUBTREE, search_filter,
+                                     attrlist=attrlist, serverctrls=[page_control])
+            _, result_data, _, response_controls = conn.result3(msg_id)
+            if server is not None:
+                self.server_pool.record_success(server, time.perf_counter() - start)
+            yield result_data
+            cookie = None
+            for control in response_controls:
+                if control.controlType == SimplePagedResultsControl.controlType:
+                    cookie = control.cookie
+            if not cookie:
+                return
+            page_control.cookie = cookie
+
+    def _extract_email(self, entry: Tuple[Optional[str], dict], email_attr: Optional[str] = None) -> Optional[str]:
+        """
+        Extracts the content of LDAP_EMAIL_ATTR from a single search result entry
+
+        :param entry: (dn, attributes) tuple as returned by python-ldap
+        :param email_attr: Attribute to use instead of LDAP_EMAIL_ATTR
+        :return: The email address or None if the entry is not usable
+        """
+        try:
+            return entry[1][email_attr or self.ldap_email_attr][0].decode()
+        except KeyError:
+            logging.warning('One of returned objects missing your LDAP_EMAIL_ATTR')
+            logging.debug('LDAP request object returned following keys: {}'.format(entry[1].keys()))
+        except IndexError:
+            logging.warning('LDAP request object returned badly formatted response')
+            logging.debug('Response: {}'.format(entry))
+        except Exception as err:
+            logging.warning('Oops, something went wrong')
+            logging.debug('Exception was: {}'.format(err))
+        return None
+
+    def _iter_emails(self, conn: SimpleLDAPObject, query: Optional[LdapQuery] = None,
+                     server: Optional[str] = None) -> Iterator[str]:
+        query = query or self.query
+        try:
+            for page in self._iter_result_pages(conn, query.search_filter, [query.email_attr], query.base_dn, server):
+                for entry in page:
+                    email = self._extract_email(entry, query.email_attr)
+                    if email is not None:
+                        yield email
+        except ldap.NO_SUCH_OBJECT:
+            logging.warning('Ldap search returned no results')
+            return
+
+    def iter_email_list(self) -> Iterator[str]:
+        """
+        Streaming variant of get_email_list(): Yields email addresses page by page (see LDAP_PAGE_SIZE), so only one
+        page of results is held in memory at a time. Addresses already handed out cannot be taken back, so a server
+        failing during the search is only failed over in the next cycle.
+
+        :return: Iterator over email addresses (or technically speaking the content of the LDAP_EMAIL_ATTR field)
+        """
+        conn, server = self._checkout()
+        error = None
+        try:
+            yield from self._iter_emails(conn, server=server)
+        except FAILOVER_ERRORS as e:
+            error = e
+            raise
+        finally:
+            self._checkin(conn, server, error)
 
     def get_email_list(self) -> List[str]:
         """
@@ -45,26 +370,196 @@ class LdapConnector(EmailSource):
 
         :return: A (possibly) empty list of email addresses (or technically speaking the content of the LDAP_EMAIL_ATTR field)
         """
-        with self.connect() as ldap_server:
-            try:
-                results = ldap_server.search_s(self.ldap_base_dn, ldap.SCOPE_SUBTREE, self.ldap_search_filter)
-            except ldap.NO_SUCH_OBJECT:
-                logging.warning('Ldap search returned no results')
-                return []
-        ldap_email_list = []
-        for e in results:
+        return self.search(self.query)
+
+    def search(self, query: LdapQuery) -> List[str]:
+        """
+        Variant of get_email_list() with another base DN, filter or email attribute on the same connection, used by
+        tenants sharing this connector (see SharedSearchSource)
+        """
+        return self._run_with_failover(lambda conn, server: list(self._iter_emails(conn, query, server)))
+
+
+class IncrementalLdapConnector(LdapConnector):
+    """
+    LDAP email source which only transfers entries that were added, changed or deleted since the last sync.
+
+    Uses the RFC 4533 content synchronization (syncrepl, refreshOnly) cookie if the server supports it and a
+    modifyTimestamp/uSNChanged high-water mark otherwise. The known entries and the cookie/watermark are kept in the
+    LocalStore, so a restart continues from the last position. Every LDAP_FULL_RESYNC_SECONDS a full resync is done
+    to catch drift. In watermark mode this is also the only way to notice deleted entries (or entries no longer
+    matching LDAP_SEARCH_FILTER), since they carry no timestamp anymore.
+    """
+    thread_safe = False
+
+    def __init__(self, source_name: str, local_store: LocalStore, env_prefix: str = 'LDAP_'):
+        super().__init__(source_name, env_prefix)
+        self.local_store = local_store
+        # One of auto, syncrepl or watermark
+        self.incremental_mode = self._setting('INCREMENTAL_MODE', 'auto')
+        # Defaults to uSNChanged on Active Directory and modifyTimestamp otherwise
+        self.watermark_attr = self._setting('WATERMARK_ATTR')
+        self.full_resync_interval = int(self._setting('FULL_RESYNC_SECONDS', '86400'))
+        if self.incremental_mode not in ['auto', 'syncrepl', 'watermark']:
+            raise ValueError('Invalid LDAP_INCREMENTAL_MODE. Must be one of: auto, syncrepl, watermark')
+
+    def _resolve_mode(self, conn: SimpleLDAPObject):
+        if self.incremental_mode != 'auto' and (self.incremental_mode == 'syncrepl' or self.watermark_attr):
+            return
+        root_dse = conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)',
+                                 attrlist=['supportedControl', AD_ROOT_DSE_ATTR])
+        root_attrs = root_dse[0][1] if root_dse else {}
+        if self.incremental_mode == 'auto':
+            supported_controls = [c.decode() for c in root_attrs.get('supportedControl', [])]
+            self.incremental_mode = 'syncrepl' if SYNC_REQUEST_CONTROL_OID in supported_controls else 'watermark'
+        if self.incremental_mode == 'watermark' and not self.watermark_attr:
+            self.watermark_attr = 'uSNChanged' if AD_ROOT_DSE_ATTR in root_attrs else 'modifyTimestamp'
+        logging.info('Incremental LDAP sync mode: {} {}'.format(self.incremental_mode, self.watermark_attr or ''))
+
+    @staticmethod
+    def _watermark_key(watermark: str):
+        # uSNChanged is numeric, GeneralizedTime (modifyTimestamp) sorts lexicographically
+        return (0, int(watermark), '') if watermark.isdigit() else (1, 0, watermark)
+
+    def _syncrepl_refresh(self, conn: SimpleLDAPObject, state: Optional[SourceSyncState]) -> SourceSyncState:
+        """
+        Runs one refreshOnly content synchronization, starting from the cookie in state (or from scratch)
+        """
+        cookie = state.cookie if state else None
+        request = SyncRequestControl(criticality=True, cookie=cookie, mode='refreshOnly')
+        msg_id = conn.search_ext(self.ldap_base_dn, ldap.SCOPE_SUBTREE, self.ldap_search_filter,
+                                 attrlist=[self.ldap_email_attr], serverctrls=[request])
+        upserts = {}
+        deletes = set()
+        present = set()
+        refresh_deletes = False
+        while True:
+            result_type, result_data, _, result_controls, _, _ = conn.result4(msg_id, all=0, add_ctrls=1,
+                                                                               add_intermediates=1)
+            if result_type == ldap.RES_SEARCH_ENTRY:
+                for dn, attrs, entry_controls in result_data:
+                    for control in entry_controls:
+                        if not isinstance(control, SyncStateControl):
+                            continue
+                        cookie = control.cookie or cookie
+                        if control.state == 'delete':
+                            deletes.add(control.entryUUID)
+                        elif control.state == 'present':
+                            present.add(control.entryUUID)
+                        else:
+                            email = self._extract_email((dn, attrs))
+                            if email is None:
+                                deletes.add(control.entryUUID)
+                            else:
+                                upserts[control.entryUUID] = email
+            elif result_type == ldap.RES_INTERMEDIATE:
+                for response_name, response_value, _ in result_data:
+                    if response_name != SyncInfoMessage.responseName:
+                        continue
+                    info = SyncInfoMessage(response_value)
+                    cookie = info.newcookie or cookie
+                    for phase in [info.refreshDelete, info.refreshPresent]:
+                        if phase is not None:
+                            cookie = phase.get('cookie') or cookie
+                    if info.syncIdSet is not None:
+                        cookie = info.syncIdSet.get('cookie') or cookie
+                        if info.syncIdSet['refreshDeletes']:
+                            deletes.update(info.syncIdSet['syncUUIDs'])
+                        else:
+                            present.update(info.syncIdSet['syncUUIDs'])
+            elif result_type == ldap.RES_SEARCH_RESULT:
+                for control in result_controls:
+                    if isinstance(control, SyncDoneControl):
+                        cookie = control.cookie or cookie
+                        refresh_deletes = control.refreshDeletes
+                break
+
+        replace_all = state is None or state.cookie is None
+        if not refresh_deletes and not replace_all:
+            # Present phase: Everything the server did not mention is gone
+            deletes = set(self.local_store.get_source_entry_ids(self.source_name)) - present - upserts.keys()
+        new_state = SourceSyncState(source_name=self.source_name, cookie=cookie, watermark=None,
+                                    last_full_sync=time.time() if replace_all else state.last_full_sync,
+                                    server=self.ldap_server)
+        self.local_store.apply_source_changes(new_state, upserts, deletes, replace_all=replace_all)
+        logging.info('LDAP content sync: {} added/changed, {} deleted'.format(len(upserts), len(deletes)))
+        return new_state
+
+    def _watermark_refresh(self, conn: SimpleLDAPObject, state: Optional[SourceSyncState]) -> SourceSyncState:
+        """
+        Fetches all entries changed since the watermark in state, or all entries if state is None (full resync)
+        """
+        search_filter = self.ldap_search_filter
+        if not search_filter.startswith('('):
+            search_filter = '({})'.format(search_filter)
+        if state is not None:
+            search_filter = '(&{}({}>={}))'.format(search_filter, self.watermark_attr,
+                                                  escape_filter_chars(state.watermark))
+        upserts = {}
+        deletes = set()
+        watermark = state.watermark if state else None
+        for page in self._iter_result_pages(conn, search_filter, [self.ldap_email_attr, self.watermark_attr],
+                                            server=self.ldap_server):
+            for entry in page:
+                dn, attrs = entry
+                if dn is None:
+                    # Search continuation reference
+                    continue
+                email = self._extract_email(entry)
+                if email is None:
+                    deletes.add(dn)
+                else:
+                    upserts[dn] = email
+                for value in attrs.get(self.watermark_attr, []):
+                    value = value.decode()
+                    if watermark is None or self._watermark_key(value) > self._watermark_key(watermark):
+                        watermark = value
+
+        new_state = SourceSyncState(source_name=self.source_name, cookie=None, watermark=watermark,
+                                    last_full_sync=time.time() if state is None else state.last_full_sync,
+                                    server=self.ldap_server)
+        self.local_store.apply_source_changes(new_state, upserts, deletes, replace_all=state is None)
+        logging.info('LDAP {} sync: {} added/changed, {} deleted, watermark {}'.format(
+            'full' if state is None else 'incremental', len(upserts), len(deletes), watermark))
+        return new_state
+
+    def iter_email_list(self) -> Iterator[str]:
+        # The inherited one would run a full search, the known entries are the result here
+        return iter(self.get_email_list())
+
+    def get_email_list(self) -> List[str]:
+        """
+        Brings the entries stored for this source up to date and returns their email addresses
+
+        :return: A (possibly) empty list of email addresses (or technically speaking the content of the LDAP_EMAIL_ATTR field)
+        """
+        state = self.local_store.get_source_sync_state(self.source_name)
+        if state is not None and time.time() - state.last_full_sync >= self.full_resync_interval:
+            logging.info('Last full LDAP sync is older than {}s, doing a full resync'.format(self.full_resync_interval))
+            state = None
+        self._run_with_failover(lambda conn, server: self._refresh(conn, state))
+        return self.local_store.get_source_emails(self.source_name)
+
+    def _refresh(self, conn: SimpleLDAPObject, state: Optional[SourceSyncState]):
+        if state is not None and state.server is not None and state.server != self.ldap_server:
+            # uSNChanged and whenChanged (modifyTimestamp on AD) are local to each server and a cookie may reference a
+            # replication state the new server does not share, so neither position can be carried over
+            logging.info('LDAP server changed from {} to {}, doing a full resync'.format(state.server,
+                                                                                          self.ldap_server))
+            state = None
+        self._resolve_mode(conn)
+        if self.incremental_mode == 'syncrepl':
             try:
-                ldap_email_list.append(e[1][self.ldap_email_attr][0].decode())
-            except KeyError:
-                logging.warning('One of returned objects missing your LDAP_EMAIL_ATTR')
-                logging.debug('LDAP request object returned following keys: {}'.format(e[1].keys()))
-                continue
-            except IndexError:
-                logging.warning('LDAP request object returned badly formatted response')
-                logging.debug('Response: {}'.format(e))
-                continue
-            except Exception as err:
-                logging.warning('Oops, something went wrong')
-                logging.debug('Exception was: {}'.format(err))
-                continue
-        return ldap_email_list
+                self._syncrepl_refresh(conn, state)
+            except FAILOVER_ERRORS:
+                raise
+            except ldap.LDAPError as e:
+                if state is None or state.cookie is None:
+                    raise
+                # e.g. e-syncRefreshRequired: The server can no longer serve changes for our cookie
+                logging.warning('LDAP content sync using stored cookie failed ({}), doing a full resync'.format(e))
+                self._syncrepl_refresh(conn, None)
+        else:
+            if state is not None and state.watermark is None:
+                state = None
+            self._watermark_refresh(conn, state)
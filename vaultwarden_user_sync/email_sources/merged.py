@@ -0,0 +1,104 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, Future
+from typing import List, Dict, Optional
+
+from vaultwarden_user_sync.email_sources import EmailSource
+
+
+class MergedEmailSource(EmailSource):
+    """
+    Union of several email sources. The sources are fetched concurrently, so the slowest one determines the latency,
+    and the addresses are de-duplicated (first occurrence wins the position).
+
+    A failing or timed out source fails the whole fetch: Leaving it out would look as if all of its users vanished.
+    """
+
+    def __init__(self, source_name: str, sources: List[EmailSource], timeouts: Optional[Dict[str, float]] = None):
+        """
+        :param sources: Sources to merge, their source_name must be unique
+        :param timeouts: Seconds to wait for each source (by source_name) from the start of its fetch, no limit if
+                         missing. Sources that are not thread_safe run on the calling thread and cannot be timed out
+        """
+        super().__init__(source_name)
+        if len({source.source_name for source in sources}) != len(sources):
+            raise ValueError('Source names must be unique')
+        self.sources = sources
+        self.timeouts = timeouts or {}
+        # Sources bound to the LocalStore are fetched on the calling thread
+        self.thread_safe = all(source.thread_safe for source in sources)
+        self._durations: Dict[str, float] = {}
+        # Monotonic time each source started fetching
+        self._started: Dict[str, float] = {}
+        # Fetch of each source submitted last, a timed out one keeps its worker busy until the source returns
+        self._fetches: Dict[str, Future] = {}
+        self._pool = ThreadPoolExecutor(max_workers=max(1, len(sources)), thread_name_prefix='email-source')
+
+    def _fetch(self, source: EmailSource) -> List[str]:
+        start = self._started[source.source_name] = time.monotonic()
+        try:
+            return source.get_email_list()
+        finally:
+            self._durations[source.source_name] = time.monotonic() - start
+
+    def get_email_list(self) -> List[str]:
+        self._durations = {}
+        self._started = {}
+        busy = [name for name, future in self._fetches.items() if not future.done()]
+        if busy:
+            # Submitting them again would pile up fetches on the same stuck source and use up the workers
+            raise TimeoutError('Email source(s) {} still busy with a timed out fetch'.format(', '.join(busy)))
+        futures: Dict[str, Future] = {source.source_name: self._pool.submit(self._fetch, source)
+                                      for source in self.sources if source.thread_safe}
+        self._fetches = futures
+        results: Dict[str, List[str]] = {}
+        try:
+            for source in self.sources:
+                if not source.thread_safe:
+                    results[source.source_name] = self._fetch(source)
+            for name, future in futures.items():
+                timeout = self.timeouts.get(name)
+                try:
+                    if timeout is None:
+                        results[name] = future.result()
+                    else:
+                        # The deadline runs from the start of this source's fetch: The sources fetched on the calling
+                        # thread meanwhile neither shorten it nor let a late result through
+                        started = self._started.get(name, time.monotonic())
+                        results[name] = future.result(timeout=max(0.0, started + timeout - time.monotonic()))
+                        if self._durations[name] > timeout:
+                            raise FutureTimeoutError()
+                except FutureTimeoutError:
+                    raise TimeoutError('Email source {} did not respond within {}s'.format(name, timeout)) from None
+        except Exception:
+            # The worker threads cannot be interrupted, but nobody waits for them anymore
+            for future in futures.values():
+                future.cancel()
+            raise
+
+        merged = dict.fromkeys(email for source in self.sources for email in results[source.source_name])
+        logging.debug('Email sources: {}, {} distinct addresses'.format(
+            ', '.join('{} {} in {:.2f}s'.format(source.source_name, len(results[source.source_name]),
+                                                  self._durations.get(source.source_name, 0.0))
+                      for source in self.sources), len(merged)))
+        return list(merged)
+
+    def config_key(self) -> str:
+        return ';'.join(source.config_key() for source in self.sources)
+
+    def describe(self) -> List[str]:
+        return [line for source in self.sources for line in source.describe()]
+
+    def get_fetch_durations(self) -> Dict[str, float]:
+        return dict(self._durations)
+
+    def get_server_stats(self) -> Dict[str, Dict[str, dict]]:
+        stats = {}
+        for source in self.sources:
+            stats.update(source.get_server_stats())
+        return stats
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+        self._pool.shutdown(wait=False, cancel_futures=True)
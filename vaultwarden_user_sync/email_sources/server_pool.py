@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Dict, Optional, Collection
+
+
+@dataclass
+class ServerHealth:
+    server: str
+    # Exponentially weighted moving average of the bind/search latency, None until the first success
+    latency: Optional[float] = None
+    consecutive_failures: int = 0
+    # Monotonic time until which the server is not tried (unless all servers are ejected)
+    ejected_until: float = 0.0
+    successes: int = 0
+    failures: int = 0
+    ejections: int = 0
+
+
+class ServerPool:
+    """
+    Picks the server to use out of a list of equivalent ones (e.g. the domain controllers of one domain).
+
+    Servers are tried in order of their measured latency (EWMA of bind and search times, unmeasured servers first so
+    they get a measurement). A connection kept open is given up once another server is faster by switch_margin (see
+    is_outranked), so a server binding fast but searching slowly does not stay in use. A server failing eject_after
+    times in a row is skipped for eject_seconds, doubling with every further failure up to max_eject_seconds. Once the
+    ejection expires it is tried again like any other server. If all servers are ejected, they are tried anyway (the
+    one ejected for the shortest time first) rather than failing without a single attempt.
+    """
+
+    def __init__(self, servers: List[str], ewma_alpha: float = 0.3, eject_after: int = 2, eject_seconds: float = 30,
+                 max_eject_seconds: float = 600, switch_margin: float = 0.2):
+        """
+        :param servers: Server addresses in order of preference (used as tie-breaker)
+        :param ewma_alpha: Weight of the newest latency sample
+        :param eject_after: Consecutive failures after which a server is ejected
+        :param eject_seconds: Duration of the first ejection
+        :param max_eject_seconds: Upper bound of the ejection duration
+        :param switch_margin: Share by which another server must be faster before a server in use is given up for it
+        """
+        if not servers:
+            raise ValueError('At least one server is required')
+        self.servers = [ServerHealth(server) for server in servers]
+        self.ewma_alpha = ewma_alpha
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.switch_margin = switch_margin
+        self._health: Dict[str, ServerHealth] = {health.server: health for health in self.servers}
+        self._lock = threading.Lock()
+
+    def candidates(self, avoid: Collection[str] = ()) -> List[str]:
+        """
+        :param avoid: Servers to try last whatever their health, e.g. the ones that already failed the current request
+        :return: All servers in the order they should be tried
+        """
+        now = time.monotonic()
+        with self._lock:
+            order = {health.server: position for position, health in enumerate(self.servers)}
+            available = [health for health in self.servers if health.ejected_until <= now]
+            ejected = [health for health in self.servers if health.ejected_until > now]
+            available.sort(key=lambda h: (h.latency is not None, h.latency or 0.0, order[h.server]))
+            ejected.sort(key=lambda h: h.ejected_until)
+            ranked = [health.server for health in available + ejected]
+        return [server for server in ranked if server not in avoid] + [server for server in ranked if server in avoid]
+
+    def is_outranked(self, server: str) -> bool:
+        """
+        :param server: Server a connection is bound to
+        :return: If another available server is faster by more than switch_margin, so it is worth rebinding. Servers
+                 without measurement do not count, they are measured on the next bind.
+        """
+        now = time.monotonic()
+        with self._lock:
+            current = self._health[server].latency
+            if current is None:
+                return False
+            return any(health.latency is not None and health.latency < current * (1 - self.switch_margin)
+                       for health in self.servers if health.server != server and health.ejected_until <= now)
+
+    def record_success(self, server: str, latency: float):
+        with self._lock:
+            health = self._health[server]
+            health.successes += 1
+            health.consecutive_failures = 0
+            health.ejected_until = 0.0
+            if health.latency is None:
+                health.latency = latency
+            else:
+                health.latency = self.ewma_alpha * latency + (1 - self.ewma_alpha) * health.latency
+
+    def record_failure(self, server: str, error: Optional[Exception] = None):
+        with self._lock:
+            health = self._health[server]
+            health.failures += 1
+            health.consecutive_failures += 1
+            if health.consecutive_failures < self.eject_after:
+                return
+            duration = min(self.max_eject_seconds,
+                           self.eject_seconds * 2 ** (health.consecutive_failures - self.eject_after))
+            health.ejected_until = time.monotonic() + duration
+            health.ejections += 1
+        logging.warning('LDAP server {} failed {} times in a row ({}), ejecting it for {:.0f}s'.format(
+            server, health.consecutive_failures, error, duration))
+
+    def get_stats(self) -> Dict[str, dict]:
+        """
+        :return: Per server: latency (EWMA seconds or None), ejected (bool) and the success/failure/ejection counters
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {health.server: {'latency': health.latency, 'ejected': health.ejected_until > now,
+                                    'successes': health.successes, 'failures': health.failures,
+                                    'ejections': health.ejections}
+                    for health in self.servers}
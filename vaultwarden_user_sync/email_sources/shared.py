@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Dict, Optional, Callable, Hashable
+
+from vaultwarden_user_sync.email_sources import EmailSource
+
+
+@dataclass(frozen=True)
+class LdapQuery:
+    """
+    What to search for: Everything of an LDAP source which is not about the connection
+    """
+    base_dn: Optional[str]
+    search_filter: Optional[str]
+    email_attr: str
+
+
+class _Fetch:
+    """
+    A search in progress, callers asking for the same result wait for it instead of searching again
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.emails: Optional[List[str]] = None
+        self.error: Optional[Exception] = None
+
+
+class SearchCache:
+    """
+    Thread safe cache of search results shared by the tenants of one process (see tenants.py). A result is reused for
+    ttl seconds, concurrent requests for a result not cached yet are served by a single search. Failed searches are
+    not cached.
+    """
+
+    def __init__(self, ttl: float):
+        """
+        :param ttl: Seconds a result is reused, 0 only merges concurrent searches
+        """
+        self.ttl = ttl
+        # key -> (monotonic time of the fetch, emails)
+        self._results: Dict[Hashable, tuple] = {}
+        self._fetches: Dict[Hashable, _Fetch] = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get(self, key: Hashable, fetch: Callable[[], List[str]]) -> List[str]:
+        """
+        :param key: Identifies the search, e.g. (connector, query)
+        :param fetch: Runs the search if the result is neither cached nor being fetched
+        :return: The result, shared with other callers: must not be modified
+        """
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and time.monotonic() - cached[0] < self.ttl:
+                self.stats['hits'] += 1
+                return cached[1]
+            in_progress = self._fetches.get(key)
+            if in_progress is None:
+                in_progress = self._fetches[key] = _Fetch()
+                self.stats['misses'] += 1
+                owner = True
+            else:
+                self.stats['hits'] += 1
+                owner = False
+
+        if not owner:
+            in_progress.done.wait()
+            if in_progress.error is not None:
+                raise in_progress.error
+            return in_progress.emails
+
+        try:
+            in_progress.emails = fetch()
+        except Exception as e:
+            in_progress.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._fetches[key]
+                if in_progress.error is None:
+                    self._results[key] = (time.monotonic(), in_progress.emails)
+            in_progress.done.set()
+        return in_progress.emails
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats)
+
+
+class SharedSearchSource(EmailSource):
+    """
+    Email source of one tenant: Runs its query on a connector shared with other tenants, so tenants pointing at the same
+    directory share one bind and, through the SearchCache, identical searches
+    """
+
+    def __init__(self, source_name: str, connector: EmailSource, query: LdapQuery, cache: SearchCache):
+        """
+        :param connector: LdapConnector (or any source with search(query)) shared by the tenants
+        :param query: What this tenant searches for
+        """
+        super().__init__(source_name)
+        self.connector = connector
+        self.query = query
+        self.cache = cache
+
+    def get_email_list(self) -> List[str]:
+        emails = self.cache.get((self.connector, self.query), lambda: self.connector.search(self.query))
+        logging.debug('{} addresses for {} from {}'.format(len(emails), self.source_name,
+                                                          self.connector.source_name))
+        return list(emails)
+
+    def config_key(self) -> str:
+        return self.connector.config_key_for(self.query)
+
+    def get_server_stats(self) -> Dict[str, Dict[str, dict]]:
+        return self.connector.get_server_stats()
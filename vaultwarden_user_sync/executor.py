@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Optional, Iterator, List, Tuple, AsyncIterator
+
+from vaultwarden_user_sync.backends.vaultwarden import VaultwardenConnector
+from vaultwarden_user_sync.compare import ChangeSet
+
+ACTION_INVITE = 'invite'
+ACTION_ENABLE = 'enable'
+ACTION_DISABLE = 'disable'
+
+
+@dataclass
+class ChangeResult:
+    """
+    Outcome of a single Vaultwarden API call
+    """
+    action: str
+    # Email address for invites, Vaultwarden user ID otherwise
+    target: str
+    # User ID returned by Vaultwarden (invites only)
+    user_id: Optional[str] = None
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class RateLimiter:
+    """
+    Thread safe limiter spacing calls evenly to at most max_per_second (0 disables the limit)
+    """
+
+    def __init__(self, max_per_second: float):
+        self.interval = 1.0 / max_per_second if max_per_second > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ChangeExecutor:
+    """
+    Applies a ChangeSet against Vaultwarden using a bounded thread pool over the (shared) session of the connector
+    """
+
+    def __init__(self, vwc: VaultwardenConnector, max_workers: Optional[int] = None, max_rps: float = 0.0):
+        """
+        :param vwc: Vaultwarden connector instance
+        :param max_workers: Number of concurrent calls, defaults to the connection pool size of the connector
+        :param max_rps: Maximum number of API calls per second, 0 means unlimited
+        """
+        self.vwc = vwc
+        self.max_workers = max_workers or vwc.max_workers
+        self.rate_limiter = RateLimiter(max_rps)
+
+    def _call(self, action: str, target: str) -> ChangeResult:
+        self.rate_limiter.acquire()
+        try:
+            if action == ACTION_INVITE:
+                return ChangeResult(action=action, target=target, user_id=self.vwc.invite_user(target))
+            elif action == ACTION_ENABLE:
+                self.vwc.enable_user(target)
+            elif action == ACTION_DISABLE:
+                self.vwc.disable_user(target)
+            else:
+                raise ValueError('Unknown action: {}'.format(action))
+            return ChangeResult(action=action, target=target)
+        except Exception as e:
+            logging.debug('{} {} failed: {}'.format(action, target, e))
+            return ChangeResult(action=action, target=target, error=e)
+
+    @staticmethod
+    def calls_for(change_set: ChangeSet) -> List[Tuple[str, str]]:
+        return ([(ACTION_INVITE, email) for email in sorted(change_set.invite_emails)] +
+                [(ACTION_DISABLE, user_id) for user_id in sorted(change_set.disable_user_ids)] +
+                [(ACTION_ENABLE, user_id) for user_id in sorted(change_set.enable_user_ids)])
+
+    def run(self, change_set: ChangeSet) -> Iterator[ChangeResult]:
+        """
+        Executes all pending changes. Failures do not stop the remaining calls.
+
+        :param change_set: Pending changes
+        :return: Iterator over the results in the order the calls complete
+        """
+        return self.run_calls(self.calls_for(change_set))
+
+    def run_calls(self, calls: List[Tuple[str, str]]) -> Iterator[ChangeResult]:
+        """
+        Same as run, for an explicit list of (action, target) calls. If the consumer stops early (closes the
+        iterator or raises), the calls not started yet are dropped, only the ones in flight are waited for.
+        """
+        if not calls:
+            return
+        pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='vw-apply')
+        try:
+            futures = [pool.submit(self._call, action, target) for action, target in calls]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def run_async(self, change_set: ChangeSet) -> AsyncIterator[ChangeResult]:
+        """
+        Same as run, for use inside an event loop. At most max_workers calls are in flight at once, each one runs in a
+        worker thread (the connector is blocking)
+
+        :param change_set: Pending changes
+        :return: Async iterator over the results in the order the calls complete
+        """
+        return self.run_calls_async(self.calls_for(change_set))
+
+    async def run_calls_async(self, calls: List[Tuple[str, str]]) -> AsyncIterator[ChangeResult]:
+        """
+        Same as run_async, for an explicit list of (action, target) calls. Stopping early drops the calls not started
+        yet, as in run_calls.
+        """
+        if not calls:
+            return
+        loop = asyncio.get_running_loop()
+        pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='vw-apply')
+        try:
+            futures = [loop.run_in_executor(pool, self._call, action, target) for action, target in calls]
+            for next_result in asyncio.as_completed(futures):
+                yield await next_result
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
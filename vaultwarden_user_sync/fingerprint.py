@@ -0,0 +1,76 @@
+import hashlib
+from dataclasses import dataclass
+from typing import Iterable, List
+
+from vaultwarden_user_sync.backends.vaultwarden import VaultwardenUser
+
+_MODULUS = 2 ** 128
+
+
+class MultisetHash:
+    """
+    Incremental form of multiset_hash(), for inputs that are streamed instead of collected
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def update(self, item: str):
+        self.total += int.from_bytes(hashlib.blake2b(item.encode(), digest_size=16).digest(), 'big')
+        self.count += 1
+
+    def hexdigest(self) -> str:
+        return '{:032x}-{}'.format(self.total % _MODULUS, self.count)
+
+
+def multiset_hash(items: Iterable[str]) -> str:
+    """
+    Order independent hash over a collection of strings (duplicates count): Sum of the per item digests
+
+    :param items: Strings to hash
+    :return: Hex digest
+    """
+    digest = MultisetHash()
+    for item in items:
+        digest.update(item)
+    return digest.hexdigest()
+
+
+def vw_user_key(vw_user: VaultwardenUser) -> str:
+    """
+    :return: The string representing a Vaultwarden user in the fingerprint
+    """
+    return '{}\0{}\0{}'.format(vw_user.user_id, vw_user.email, vw_user.enabled)
+
+
+@dataclass
+class CycleFingerprint:
+    """
+    Fingerprint of the inputs of one sync cycle. If it matches the one of the last completed cycle, diffing and
+    applying can be skipped since they would not yield any changes.
+    """
+    source: str
+    vaultwarden: str
+    local_store: str
+    # Settings influencing the outcome of a cycle (e.g. CLEANUP_VANISHED_USERS)
+    settings: str = ''
+
+    @staticmethod
+    def compute(source_email_addresses: List[str], vw_users: List[VaultwardenUser], users_version: int,
+                settings: str = '') -> "CycleFingerprint":
+        """
+        :param source_email_addresses: Email addresses returned by the email source
+        :param vw_users: All Vaultwarden users
+        :param users_version: Change counter of the LocalStore (see LocalStore.get_users_version())
+        :param settings: String representation of the settings influencing the outcome
+        """
+        return CycleFingerprint(
+            source=multiset_hash(source_email_addresses),
+            vaultwarden=multiset_hash(vw_user_key(u) for u in vw_users),
+            local_store=str(users_version),
+            settings=settings
+        )
+
+    def serialize(self) -> str:
+        return '|'.join([self.source, self.vaultwarden, self.local_store, self.settings])
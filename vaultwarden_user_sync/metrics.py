@@ -0,0 +1,324 @@
+"""
+Prometheus text exposition of the sync daemon state, plus liveness (/healthz) and readiness (/readyz) probes.
+Served by a small threaded HTTP server next to the main loop, see METRICS_PORT.
+"""
+import threading
+import time
+from dataclasses import dataclass, fields
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Optional, Callable, List, Tuple, Union
+
+from vaultwarden_user_sync.compare import SyncResult
+from vaultwarden_user_sync.cycle import CycleReport
+
+METRIC_PREFIX = 'vus'
+CYCLE_SUCCESS = 'success'
+CYCLE_SKIPPED = 'skipped'
+CYCLE_SAFE_GUARD = 'safe_guard_exceeded'
+CYCLE_ERROR = 'error'
+# SyncResult fields exported as vus_sync_result_users{category=...}
+SYNC_RESULT_CATEGORIES = [f.name for f in fields(SyncResult) if not f.name.startswith('_') and
+                          f.name != 'pending_changes']
+
+
+def _labels(**labels: str) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in sorted(labels.items())) + '}'
+
+
+@dataclass
+class MetricFamily:
+    # Without METRIC_PREFIX
+    name: str
+    metric_type: str
+    help_text: str
+    # (suffix of the sample name, e.g. _sum of a summary, labels, value)
+    samples: List[Tuple[str, Dict[str, str], float]]
+
+
+def render_families(families: List[MetricFamily]) -> str:
+    """
+    :return: The families in the Prometheus text exposition format
+    """
+    lines: List[str] = []
+    for family in families:
+        name = '{}_{}'.format(METRIC_PREFIX, family.name)
+        lines.append('# HELP {} {}'.format(name, family.help_text))
+        lines.append('# TYPE {} {}'.format(name, family.metric_type))
+        for suffix, labels, value in family.samples:
+            lines.append('{}{}{} {}'.format(name, suffix, _labels(**labels),
+                                            repr(float(value)) if isinstance(value, float) else value))
+    return '\n'.join(lines) + '\n'
+
+
+def server_families(server_stats: Dict[str, Dict[str, dict]], **labels: str) -> List[MetricFamily]:
+    """
+    :param server_stats: LDAP server health per source (see EmailSource.get_server_stats)
+    """
+    servers = [(dict(labels, source=source, server=server), stats)
+               for source, source_servers in sorted(server_stats.items())
+               for server, stats in source_servers.items()]
+    return [
+        MetricFamily('ldap_server_latency_seconds', 'gauge', 'Moving average of the LDAP bind/probe latency',
+                     [('', server, stats['latency']) for server, stats in servers if stats['latency'] is not None]),
+        MetricFamily('ldap_server_ejected', 'gauge', '1 while the LDAP server is skipped after repeated failures',
+                     [('', server, int(stats['ejected'])) for server, stats in servers]),
+        MetricFamily('ldap_server_failures_total', 'counter', 'Failed binds/searches per LDAP server',
+                     [('', server, stats['failures']) for server, stats in servers]),
+        MetricFamily('ldap_server_ejections_total', 'counter', 'Times the LDAP server was ejected',
+                     [('', server, stats['ejections']) for server, stats in servers]),
+    ]
+
+
+class SyncMetrics:
+    """
+    Thread safe collector of cycle outcomes. The main loop reports each cycle, the HTTP server renders snapshots.
+    """
+
+    def __init__(self, max_age: float, transport_stats: Optional[Callable[[], dict]] = None,
+                 server_stats: Optional[Callable[[], Dict[str, Dict[str, dict]]]] = None):
+        """
+        :param max_age: Seconds without a successful cycle after which the daemon is reported unhealthy
+        :param transport_stats: Returns the Vaultwarden API call counters (see Transport.get_stats)
+        :param server_stats: Returns the LDAP server health per source (see EmailSource.get_server_stats)
+        """
+        self.max_age = max_age
+        self.transport_stats = transport_stats
+        self.server_stats = server_stats
+        self.started_at = time.time()
+        self.last_success: Optional[float] = None
+        self.last_cycle: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.cycles: Dict[str, int] = {CYCLE_SUCCESS: 0, CYCLE_SKIPPED: 0, CYCLE_SAFE_GUARD: 0, CYCLE_ERROR: 0}
+        self.last_phase_durations: Dict[str, float] = {}
+        self.phase_duration_sum: Dict[str, float] = {}
+        self.phase_duration_count: Dict[str, int] = {}
+        self.sync_result_counts: Dict[str, int] = {}
+        self.pending_change_counts: Dict[str, int] = {}
+        self.deferred_change_counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def observe_cycle(self, report: CycleReport):
+        now = time.time()
+        with self._lock:
+            self.last_cycle = now
+            if report.skipped:
+                outcome = CYCLE_SKIPPED
+            elif report.safe_guard_exceeded:
+                outcome = CYCLE_SAFE_GUARD
+            else:
+                outcome = CYCLE_SUCCESS
+            # Nothing gets applied while the safe guard stops the cycles, the daemon must not look healthy
+            if outcome != CYCLE_SAFE_GUARD:
+                self.last_success = now
+            self.cycles[outcome] += 1
+            self.last_phase_durations = dict(report.phase_durations)
+            for phase, seconds in report.phase_durations.items():
+                self.phase_duration_sum[phase] = self.phase_duration_sum.get(phase, 0.0) + seconds
+                self.phase_duration_count[phase] = self.phase_duration_count.get(phase, 0) + 1
+            sync_result = report.sync_result
+            if sync_result is not None:
+                self.sync_result_counts = {category: len(getattr(sync_result, category))
+                                           for category in SYNC_RESULT_CATEGORIES}
+                pending_changes = sync_result.pending_changes
+                self.pending_change_counts = {'invite': len(pending_changes.invite_emails),
+                                              'enable': len(pending_changes.enable_user_ids),
+                                              'disable': len(pending_changes.disable_user_ids)}
+                self.deferred_change_counts = dict(report.deferred_changes)
+            elif report.skipped:
+                # Inputs unchanged, so is the difference: nothing pending
+                self.pending_change_counts = {action: 0 for action in self.pending_change_counts}
+                self.deferred_change_counts = {action: 0 for action in self.deferred_change_counts}
+
+    def observe_error(self, error: Exception):
+        with self._lock:
+            self.last_cycle = time.time()
+            self.last_error = '{}: {}'.format(type(error).__name__, error)
+            self.cycles[CYCLE_ERROR] += 1
+
+    @property
+    def last_cycle_succeeded(self) -> bool:
+        """
+        True if the last cycle completed without error and without being stopped by the safe guard
+        """
+        with self._lock:
+            return self.last_success is not None and self.last_success == self.last_cycle
+
+    def is_live(self) -> bool:
+        """
+        Live while a cycle succeeded within max_age (or the daemon started less than max_age ago)
+        """
+        with self._lock:
+            reference = self.last_success if self.last_success is not None else self.started_at
+        return time.time() - reference < self.max_age
+
+    def is_ready(self) -> bool:
+        """
+        Ready once the first cycle succeeded
+        """
+        with self._lock:
+            return self.last_success is not None
+
+    def families(self, **labels: str) -> List[MetricFamily]:
+        """
+        :param labels: Added to every sample (e.g. tenant)
+        """
+        families: List[MetricFamily] = []
+
+        def metric(name: str, metric_type: str, help_text: str, samples: Dict[Tuple, float]):
+            families.append(MetricFamily(name, metric_type, help_text,
+                                         [('', dict(key, **labels), value) for key, value in samples.items()]))
+
+        with self._lock:
+            metric('up', 'gauge', 'Sync daemon running', {(): 1})
+            metric('cycles_total', 'counter', 'Sync cycles by outcome',
+                   {(('outcome', outcome),): count for outcome, count in self.cycles.items()})
+            metric('last_success_timestamp_seconds', 'gauge', 'Unix time of the last successful cycle',
+                   {(): self.last_success or 0})
+            metric('last_cycle_timestamp_seconds', 'gauge', 'Unix time of the last cycle (successful or not)',
+                   {(): self.last_cycle or 0})
+            metric('last_cycle_phase_duration_seconds', 'gauge', 'Wall time of each phase of the last cycle',
+                   {(('phase', phase),): seconds for phase, seconds in self.last_phase_durations.items()})
+            summary = MetricFamily('phase_duration_seconds', 'summary', 'Wall time of the cycle phases', [])
+            for phase in sorted(self.phase_duration_sum):
+                summary.samples.append(('_sum', dict(labels, phase=phase), self.phase_duration_sum[phase]))
+                summary.samples.append(('_count', dict(labels, phase=phase), self.phase_duration_count[phase]))
+            families.append(summary)
+            metric('sync_result_users', 'gauge', 'Users per category of the last computed difference',
+                   {(('category', category),): count for category, count in self.sync_result_counts.items()})
+            metric('pending_changes', 'gauge', 'Changes pending after the last computed difference',
+                   {(('action', action),): count for action, count in self.pending_change_counts.items()})
+            metric('rollout_deferred_changes', 'gauge',
+                   'Pending changes left for later cycles by the throttled rollout',
+                   {(('action', action),): count for action, count in self.deferred_change_counts.items()})
+        if self.transport_stats is not None:
+            stats = self.transport_stats()
+            metric('vaultwarden_requests_total', 'counter', 'Vaultwarden API requests (including retries)',
+                   {(): stats['requests']})
+            metric('vaultwarden_retries_total', 'counter', 'Retried Vaultwarden API requests', {(): stats['retries']})
+            metric('vaultwarden_failures_total', 'counter',
+                   'Failed Vaultwarden API request attempts (including retried ones)', {(): stats['failures']})
+            metric('vaultwarden_circuit_trips_total', 'counter', 'Times the circuit breaker opened',
+                   {(): stats['circuit_trips']})
+            metric('vaultwarden_circuit_rejected_total', 'counter', 'Calls rejected while the circuit was open',
+                   {(): stats['circuit_rejected']})
+        if self.server_stats is not None:
+            families.extend(server_families(self.server_stats(), **labels))
+        return families
+
+    def render(self) -> str:
+        return render_families(self.families())
+
+
+class TenantMetrics:
+    """
+    Metrics of all tenants of a multi-tenant process (see tenants.py), each sample labelled with its tenant. The
+    process is live while any tenant completes cycles: A tenant failing on its own (e.g. a broken admin token) does not
+    get better by restarting all of them, its vus_last_success_timestamp_seconds tells.
+    """
+
+    def __init__(self, tenants: Dict[str, SyncMetrics],
+                 server_stats: Optional[Callable[[], Dict[str, Dict[str, dict]]]] = None,
+                 cache_stats: Optional[Callable[[], Dict[str, int]]] = None):
+        """
+        :param tenants: Tenant name -> its metrics
+        :param server_stats: Health of the LDAP servers shared by the tenants
+        :param cache_stats: Hit/miss counters of the shared search cache (see SearchCache.get_stats)
+        """
+        self.tenants = tenants
+        self.server_stats = server_stats
+        self.cache_stats = cache_stats
+
+    @property
+    def max_age(self) -> float:
+        return max(metrics.max_age for metrics in self.tenants.values())
+
+    @property
+    def last_error(self) -> Optional[str]:
+        errors = ['{}: {}'.format(name, metrics.last_error) for name, metrics in sorted(self.tenants.items())
+                  if metrics.last_error]
+        return '; '.join(errors) or None
+
+    def is_live(self) -> bool:
+        return any(metrics.is_live() for metrics in self.tenants.values())
+
+    def is_ready(self) -> bool:
+        return any(metrics.is_ready() for metrics in self.tenants.values())
+
+    def render(self) -> str:
+        families: Dict[str, MetricFamily] = {}
+        for name, metrics in sorted(self.tenants.items()):
+            for family in metrics.families(tenant=name):
+                if family.name in families:
+                    families[family.name].samples.extend(family.samples)
+                else:
+                    families[family.name] = family
+        shared = []
+        if self.server_stats is not None:
+            shared.extend(server_families(self.server_stats()))
+        if self.cache_stats is not None:
+            stats = self.cache_stats()
+            shared.append(MetricFamily('ldap_search_cache_hits_total', 'counter',
+                                       'LDAP searches served from the cache shared by the tenants',
+                                       [('', {}, stats['hits'])]))
+            shared.append(MetricFamily('ldap_search_cache_misses_total', 'counter',
+                                       'LDAP searches run on behalf of the tenants', [('', {}, stats['misses'])]))
+        return render_families(list(families.values()) + shared)
+
+
+def _make_handler(metrics: Union[SyncMetrics, TenantMetrics]):
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status: int, body: str, content_type: str = 'text/plain; charset=utf-8'):
+            payload = body.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send(200, metrics.render(), 'text/plain; version=0.0.4; charset=utf-8')
+            elif self.path == '/healthz':
+                if metrics.is_live():
+                    self._send(200, 'ok\n')
+                else:
+                    self._send(503, 'no successful cycle within {}s, last error: {}\n'.format(
+                        metrics.max_age, metrics.last_error))
+            elif self.path == '/readyz':
+                if metrics.is_ready():
+                    self._send(200, 'ok\n')
+                else:
+                    self._send(503, 'waiting for the first successful cycle\n')
+            else:
+                self._send(404, 'not found\n')
+
+    return MetricsHandler
+
+
+class MetricsServer:
+    """
+    Serves /metrics, /healthz and /readyz from a daemon thread
+    """
+
+    def __init__(self, metrics: Union[SyncMetrics, TenantMetrics], host: str = '0.0.0.0', port: int = 9464):
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(metrics))
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def start(self) -> "MetricsServer":
+        threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,187 @@
+"""
+Serialized change plan: The local state updates and Vaultwarden API calls derived from one SyncResult, together with
+the fingerprint of the inputs they were computed from. A plan can be written to a file (--plan), reviewed and applied
+later (--apply). The progress of applying a plan is checkpointed in the LocalStore, so an interrupted run continues
+with the calls not made yet instead of starting over.
+"""
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, Dict
+
+from vaultwarden_user_sync.backends.localstore import LocalStore
+from vaultwarden_user_sync.compare import SyncResult
+from vaultwarden_user_sync.executor import ChangeExecutor, ACTION_INVITE, ACTION_ENABLE, ACTION_DISABLE
+
+PLAN_FORMAT_VERSION = 1
+# LocalStore methods a plan may call
+LOCAL_STATE_METHODS = ['register_user', 'delete_user_by_email', 'set_user_state', 'update_vw_email',
+                       'delete_user_by_id']
+# Plan progress step of the local state updates (applied in a single transaction)
+LOCAL_STATE_STEP = 'local_state'
+
+
+def plan_step(action: str, target: str) -> str:
+    """
+    :return: Key of an API call in the plan progress
+    """
+    return '{}:{}'.format(action, target)
+
+
+@dataclass
+class LocalStateUpdate:
+    """
+    One call of a LocalStore method reflecting a change found in Vaultwarden (or the email source)
+    """
+    method: str
+    args: List[str]
+    message: str
+    level: int = logging.INFO
+
+    def apply(self, ls: LocalStore):
+        if self.method not in LOCAL_STATE_METHODS:
+            raise ValueError('Invalid local state update: {}'.format(self.method))
+        getattr(ls, self.method)(*self.args)
+
+
+@dataclass
+class PlannedChange:
+    """
+    One Vaultwarden API call
+    """
+    # One of the executor ACTION_* constants
+    action: str
+    # Email address for invites, Vaultwarden user ID otherwise
+    target: str
+    # Email address for log messages
+    label: str
+
+
+def local_state_updates(sync_result: SyncResult, adopt: bool, cleanup_vanished_users: bool,
+                        untie_re_enabled_users: bool) -> List[LocalStateUpdate]:
+    """
+    :return: The local state updates for the differences found, in the order they have to be applied
+    """
+    updates = []
+    if adopt:
+        for vw_user in sync_result.adoption_candidates:
+            state = 'ENABLED' if vw_user.enabled else 'DISABLED'
+            updates.append(LocalStateUpdate('register_user', [vw_user.email, vw_user.user_id, state],
+                                            f'Adopted {vw_user.email}'))
+    if cleanup_vanished_users:
+        for user_email in sorted(sync_result.email_vanished_in_both):
+            updates.append(LocalStateUpdate('delete_user_by_email', [user_email],
+                                            f'Cleanup vanished user: {user_email}'))
+    for state, user_ids in [('DELETED', sync_result.user_ids_vanished_in_vw),
+                            ('DISABLED', sync_result.user_ids_disabled_in_vw)]:
+        for user_id in sorted(user_ids):
+            updates.append(LocalStateUpdate('set_user_state', [user_id, state],
+                                            f'Set state to {state} for: '
+                                            f'{sync_result.get_ma_user_by_id(user_id).invite_email}'))
+    for changed_user in sync_result.users_with_changed_email:
+        updates.append(LocalStateUpdate('update_vw_email', [changed_user.user_id, changed_user.new_email],
+                                        f'Changed email from {changed_user.old_email} to {changed_user.new_email}'))
+    if untie_re_enabled_users:
+        for user_id in sorted(sync_result.user_ids_enabled_in_vw):
+            updates.append(LocalStateUpdate(
+                'delete_user_by_id', [user_id],
+                f'User {sync_result.get_ma_user_by_id(user_id).invite_email} forcefully enabled by Admin. '
+                f'Permanently untie this user from automatic management', logging.WARNING))
+    return updates
+
+
+def planned_changes(sync_result: SyncResult) -> List[PlannedChange]:
+    """
+    :return: The Vaultwarden API calls for the pending changes, in the order the executor issues them
+    """
+    changes = []
+    for action, target in ChangeExecutor.calls_for(sync_result.pending_changes):
+        label = target if action == ACTION_INVITE else sync_result.get_ma_user_by_id(target).vw_email
+        changes.append(PlannedChange(action, target, label))
+    return changes
+
+
+@dataclass
+class ChangePlan:
+    # Serialized CycleFingerprint of the inputs
+    fingerprint: str
+    # LocalStore.get_users_version() when the plan was computed, the plan is stale once the local state changed
+    users_version: int
+    local_state_updates: List[LocalStateUpdate] = field(default_factory=list)
+    changes: List[PlannedChange] = field(default_factory=list)
+    created_at: float = field(default_factory=time.time)
+
+    @staticmethod
+    def from_sync_result(sync_result: SyncResult, fingerprint: str, users_version: int, adopt: bool = False,
+                         cleanup_vanished_users: bool = False, untie_re_enabled_users: bool = False,
+                         include_local_state: bool = True) -> "ChangePlan":
+        """
+        :param include_local_state: False if the local state updates were already applied (only the API calls remain)
+        """
+        updates = local_state_updates(sync_result, adopt, cleanup_vanished_users,
+                                      untie_re_enabled_users) if include_local_state else []
+        return ChangePlan(fingerprint=fingerprint, users_version=users_version, local_state_updates=updates,
+                          changes=planned_changes(sync_result))
+
+    def _content(self) -> dict:
+        return {
+            'fingerprint': self.fingerprint,
+            'users_version': self.users_version,
+            'local_state_updates': [[u.method, u.args, u.message, u.level] for u in self.local_state_updates],
+            'changes': [[c.action, c.target, c.label] for c in self.changes],
+        }
+
+    @property
+    def plan_id(self) -> str:
+        """
+        Derived from the content (not the creation time): The same changes computed twice are the same plan
+        """
+        return hashlib.sha256(json.dumps(self._content(), sort_keys=True).encode()).hexdigest()[:16]
+
+    def count(self, action: str) -> int:
+        return sum(1 for change in self.changes if change.action == action)
+
+    def exceeds_safe_guard(self, safe_guard: int) -> bool:
+        return any(self.count(action) > safe_guard for action in [ACTION_INVITE, ACTION_ENABLE, ACTION_DISABLE])
+
+    def summary(self) -> str:
+        return (f'Plan {self.plan_id}: {len(self.local_state_updates)} local state update(s), '
+                f'invite {self.count(ACTION_INVITE)}, enable {self.count(ACTION_ENABLE)}, '
+                f'disable {self.count(ACTION_DISABLE)}')
+
+    def to_json(self) -> str:
+        content = self._content()
+        content.update(version=PLAN_FORMAT_VERSION, plan_id=self.plan_id, created_at=self.created_at)
+        return json.dumps(content, separators=(',', ':'))
+
+    @staticmethod
+    def from_json(serialized: str) -> "ChangePlan":
+        content = json.loads(serialized)
+        if content.get('version') != PLAN_FORMAT_VERSION:
+            raise ValueError('Unsupported plan format version: {}'.format(content.get('version')))
+        plan = ChangePlan(fingerprint=content['fingerprint'], users_version=content['users_version'],
+                          local_state_updates=[LocalStateUpdate(*u) for u in content['local_state_updates']],
+                          changes=[PlannedChange(*c) for c in content['changes']],
+                          created_at=content['created_at'])
+        if plan.plan_id != content['plan_id']:
+            raise ValueError('Plan content does not match its ID, the file was modified')
+        return plan
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+    @staticmethod
+    def load(path: str) -> "ChangePlan":
+        with open(path) as f:
+            return ChangePlan.from_json(f.read())
+
+
+def pending_changes(plan: ChangePlan, done: Dict[str, Optional[str]]) -> List[PlannedChange]:
+    """
+    :param done: Progress of the plan (see LocalStore.get_plan_progress)
+    :return: The changes of the plan not applied yet
+    """
+    return [change for change in plan.changes if plan_step(change.action, change.target) not in done]
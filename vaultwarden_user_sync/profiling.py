@@ -0,0 +1,218 @@
+"""
+Profiling of sync cycles without patching code: cProfile stats and tracemalloc snapshots of the next N cycles, and a
+low overhead sampling profiler (stacks of all threads, folded format) that can stay enabled in production.
+
+Summarize the collected files with: python3 -m vaultwarden_user_sync.profiling <directory> [--top 20]
+"""
+import argparse
+import contextlib
+import cProfile
+import glob
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, Optional
+
+# Frames kept per tracemalloc allocation, deeper costs more memory
+TRACEMALLOC_FRAMES = 25
+FOLDED_FILE = 'samples.folded'
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads (or one) every interval seconds while active, and counts identical stacks. Each
+    stack starts with the name of its thread, so the work of the Vaultwarden and email source worker threads shows up
+    next to the main thread. Unlike cProfile the profiled threads are not slowed down, the cost is one stack walk per
+    thread and sample in the sampling thread.
+    """
+
+    def __init__(self, interval: float = 0.01, thread_id: Optional[int] = None):
+        """
+        :param thread_id: Only sample this thread, None samples all threads (except the sampling one)
+        """
+        self.interval = interval
+        self.thread_id = thread_id
+        # folded stack (root first, ';' separated) -> number of samples
+        self.stacks: Dict[str, int] = {}
+        self.active = threading.Event()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _frame_label(frame) -> str:
+        code = frame.f_code
+        return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def sample(self):
+        frames = sys._current_frames()
+        if self.thread_id is not None:
+            frames = {self.thread_id: frames[self.thread_id]} if self.thread_id in frames else {}
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = []
+        for thread_id, frame in frames.items():
+            if thread_id == threading.get_ident():
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(self._frame_label(frame))
+                frame = frame.f_back
+            labels.append('thread {}'.format(names.get(thread_id, thread_id)))
+            stacks.append(';'.join(reversed(labels)))
+        with self._lock:
+            for stack in stacks:
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.active.wait()
+            if self._stopped.wait(self.interval):
+                break
+            if self.active.is_set():
+                self.sample()
+
+    def start(self) -> "SamplingProfiler":
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self.active.set()
+
+    def write_folded(self, path: str):
+        """
+        Writes the samples in the folded format understood by flamegraph.pl and speedscope
+        """
+        with self._lock:
+            lines = ['{} {}\n'.format(stack, count) for stack, count in self.stacks.items()]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, path)
+
+
+class CycleProfiler:
+    """
+    Wraps sync cycles and writes profiling data of the selected ones to output_dir
+    """
+
+    def __init__(self, output_dir: str, profile_cycles: int = 0, trace_memory_cycles: int = 0,
+                 sample_interval: float = 0.0):
+        """
+        :param profile_cycles: Capture cProfile stats of the next N cycles (main thread only)
+        :param trace_memory_cycles: Capture a tracemalloc snapshot at the end of the next N cycles
+        :param sample_interval: Seconds between stack samples of all threads during cycles, 0 disables sampling
+        """
+        self.output_dir = output_dir
+        self.profile_cycles = profile_cycles
+        self.trace_memory_cycles = trace_memory_cycles
+        self.sampler = SamplingProfiler(sample_interval).start() if sample_interval > 0 else None
+        self.cycle_number = 0
+        if self.enabled:
+            os.makedirs(output_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.profile_cycles or self.trace_memory_cycles or self.sampler)
+
+    def _path(self, extension: str) -> str:
+        return os.path.join(self.output_dir, 'cycle-{}-{:04d}.{}'.format(
+            time.strftime('%Y%m%d-%H%M%S'), self.cycle_number, extension))
+
+    @contextlib.contextmanager
+    def cycle(self):
+        """
+        Profiles the enclosed cycle if it is one of the selected ones
+        """
+        self.cycle_number += 1
+        profiler = None
+        if self.profile_cycles > 0:
+            self.profile_cycles -= 1
+            profiler = cProfile.Profile()
+        trace_memory = self.trace_memory_cycles > 0
+        if trace_memory:
+            self.trace_memory_cycles -= 1
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+        if self.sampler:
+            self.sampler.active.set()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+                path = self._path('prof')
+                profiler.dump_stats(path)
+                logging.info(f'Wrote cProfile stats to {path}')
+            if trace_memory:
+                path = self._path('tracemalloc')
+                tracemalloc.take_snapshot().dump(path)
+                logging.info(f'Wrote tracemalloc snapshot to {path}')
+                if self.trace_memory_cycles == 0:
+                    tracemalloc.stop()
+            if self.sampler:
+                self.sampler.active.clear()
+                self.sampler.write_folded(os.path.join(self.output_dir, FOLDED_FILE))
+
+
+def report(directory: str, top: int = 20, out=sys.stdout):
+    """
+    Prints the top entries of all profiling data found in directory
+    """
+    prof_files = sorted(glob.glob(os.path.join(directory, '*.prof')))
+    if prof_files:
+        print('== cProfile: {} cycle(s), top {} by cumulative time'.format(len(prof_files), top), file=out)
+        stats = pstats.Stats(*prof_files, stream=out)
+        stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+
+    snapshot_files = sorted(glob.glob(os.path.join(directory, '*.tracemalloc')))
+    if snapshot_files:
+        last = tracemalloc.Snapshot.load(snapshot_files[-1])
+        print('== tracemalloc: top {} allocation sites of {}'.format(top, os.path.basename(snapshot_files[-1])),
+              file=out)
+        for statistic in last.statistics('lineno')[:top]:
+            print(statistic, file=out)
+        if len(snapshot_files) > 1:
+            first = tracemalloc.Snapshot.load(snapshot_files[0])
+            print('== tracemalloc: top {} growth since {}'.format(top, os.path.basename(snapshot_files[0])),
+                  file=out)
+            for statistic in last.compare_to(first, 'lineno')[:top]:
+                print(statistic, file=out)
+
+    folded_file = os.path.join(directory, FOLDED_FILE)
+    if os.path.exists(folded_file):
+        self_samples: Dict[str, int] = {}
+        total_samples: Dict[str, int] = {}
+        total = 0
+        with open(folded_file) as f:
+            for line in f:
+                stack, count = line.rstrip('\n').rsplit(' ', 1)
+                count = int(count)
+                total += count
+                frames = stack.split(';')
+                self_samples[frames[-1]] = self_samples.get(frames[-1], 0) + count
+                for frame in set(frames):
+                    total_samples[frame] = total_samples.get(frame, 0) + count
+        print('== samples: {} total'.format(total), file=out)
+        for title, samples in [('self', self_samples), ('inclusive', total_samples)]:
+            print('-- top {} by {} samples'.format(top, title), file=out)
+            for frame, count in sorted(samples.items(), key=lambda item: -item[1])[:top]:
+                print('{:>8} {:>6.1%}  {}'.format(count, count / total, frame), file=out)
+
+    if not (prof_files or snapshot_files or os.path.exists(folded_file)):
+        print('No profiling data found in {}'.format(directory), file=out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize profiling data written by --profile/--trace-memory')
+    parser.add_argument('directory', type=str, help='Profiling output directory (PROFILE_DIR)')
+    parser.add_argument('--top', type=int, default=20, help='Number of entries per section')
+    args = parser.parse_args()
+    report(args.directory, args.top)
@@ -0,0 +1,151 @@
+"""
+Throttled rollout (ROLLOUT_MODE=throttled): Instead of applying nothing while a category of pending changes is larger
+than MAX_USERS_AT_ONCE, at most MAX_USERS_AT_ONCE changes per category are applied each cycle, and optionally at most
+ROLLOUT_MAX_PER_HOUR (token bucket, kept in the LocalStore across restarts). The rest waits for the next cycles in the
+order given by ROLLOUT_ORDER. Inputs exceeding ROLLOUT_ABORT_THRESHOLD in any category are considered broken (e.g. an
+empty directory result) and nothing is applied, as with the all-or-nothing safe guard.
+"""
+import logging
+import time
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional, Set, Tuple
+
+from vaultwarden_user_sync.backends.localstore import LocalStore
+from vaultwarden_user_sync.compare import SyncResult, ChangeSet
+from vaultwarden_user_sync.executor import ACTION_INVITE, ACTION_ENABLE, ACTION_DISABLE
+
+# oldest: Changes pending for the longest time first (new directory entries queue up in the order they appear, changes
+#         found in the same cycle in email source order, the others by email address)
+# newest: Most recently found changes first (same tie-breaker as oldest)
+# email: Alphabetically by email address
+ROLLOUT_ORDERS = ['oldest', 'newest', 'email']
+
+
+@dataclass
+class RolloutPolicy:
+    # Changes per category and cycle (MAX_USERS_AT_ONCE)
+    max_per_cycle: int
+    # Changes per category and hour, 0 for no hourly limit (ROLLOUT_MAX_PER_HOUR)
+    max_per_hour: float = 0
+    # Nothing is applied if a category has more pending changes than this (ROLLOUT_ABORT_THRESHOLD)
+    abort_threshold: int = 500
+    order: str = 'oldest'
+
+    def __post_init__(self):
+        if self.order not in ROLLOUT_ORDERS:
+            raise ValueError('Invalid ROLLOUT_ORDER. Must be one of: {}'.format(', '.join(ROLLOUT_ORDERS)))
+        if self.abort_threshold < self.max_per_cycle:
+            raise ValueError('ROLLOUT_ABORT_THRESHOLD must not be lower than MAX_USERS_AT_ONCE')
+
+    def summary(self) -> str:
+        hourly = ', {:g} per hour'.format(self.max_per_hour) if self.max_per_hour else ''
+        return 'throttled: {} per cycle{}, {} first, abort above {}'.format(self.max_per_cycle, hourly, self.order,
+                                                                            self.abort_threshold)
+
+
+class TokenBucket:
+    """
+    Holds up to capacity tokens, refilled continuously at capacity per hour. Each change takes one token.
+    """
+
+    def __init__(self, capacity: float, tokens: Optional[float] = None, updated: Optional[float] = None):
+        """
+        :param tokens: Tokens left at updated (Unix time), a new bucket starts full
+        """
+        self.capacity = capacity
+        self.tokens = capacity if tokens is None else min(tokens, capacity)
+        self.updated = updated
+
+    def take(self, wanted: int, now: float) -> int:
+        """
+        :return: Number of tokens granted, at most wanted
+        """
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.capacity / 3600)
+        self.updated = now
+        granted = min(wanted, int(self.tokens))
+        self.tokens -= granted
+        return granted
+
+    def give_back(self, count: int):
+        """
+        Returns the tokens of changes that were not made after all
+        """
+        self.tokens = min(self.capacity, self.tokens + count)
+
+
+def _arrival_order(action: str, targets: Set[str], sync_result: SyncResult, labels: Dict[str, str]) -> List[str]:
+    """
+    :return: The order new targets are queued in: Invites in email source order, the others by email address
+    """
+    if action == ACTION_INVITE:
+        positions = sync_result.invite_positions
+        return sorted(targets, key=lambda target: (target not in positions, positions.get(target, 0), target))
+    return sorted(targets, key=lambda target: (labels[target], target))
+
+
+def _ordered(targets: List[str], queue: Dict[str, Tuple[float, int]], labels: Dict[str, str],
+             order: str) -> List[str]:
+    if order == 'email':
+        return sorted(targets, key=lambda target: (labels[target], target))
+    if order == 'newest':
+        return sorted(targets, key=lambda target: (-queue[target][0], queue[target][1]))
+    return sorted(targets, key=lambda target: queue[target])
+
+
+def throttle(sync_result: SyncResult, ls: LocalStore, policy: RolloutPolicy, persist: bool = True,
+             now: Optional[float] = None) -> Tuple[SyncResult, Dict[str, int]]:
+    """
+    Selects the pending changes to apply in this cycle. The queue of waiting changes and the token buckets are
+    updated in the LocalStore (unless persist is False, e.g. in dry run mode).
+
+    :return: Copy of sync_result with only the selected pending changes, number of deferred changes per action
+    """
+    now = time.time() if now is None else now
+    pending = sync_result.pending_changes
+    admitted: Dict[str, List[str]] = {}
+    deferred: Dict[str, int] = {}
+    for action, targets in [(ACTION_INVITE, pending.invite_emails), (ACTION_DISABLE, pending.disable_user_ids),
+                            (ACTION_ENABLE, pending.enable_user_ids)]:
+        labels = {target: target if action == ACTION_INVITE else sync_result.get_ma_user_by_id(target).vw_email
+                  for target in targets}
+        arrival = _arrival_order(action, targets, sync_result, labels)
+        if persist:
+            queue = ls.update_rollout_queue(action, arrival, now)
+        else:
+            queue = ls.get_rollout_queue(action)
+            next_seq = max((seq for _, seq in queue.values()), default=0) + 1
+            new = [target for target in arrival if target not in queue]
+            queue.update({target: (now, next_seq + i) for i, target in enumerate(new)})
+        allowed = min(len(targets), policy.max_per_cycle)
+        if policy.max_per_hour and targets:
+            stored = ls.get_rollout_bucket(action)
+            bucket = TokenBucket(policy.max_per_hour, *(stored or (None, None)))
+            allowed = bucket.take(allowed, now)
+            if persist:
+                ls.set_rollout_bucket(action, bucket.tokens, bucket.updated)
+        admitted[action] = _ordered(arrival, queue, labels, policy.order)[:allowed]
+        deferred[action] = len(targets) - allowed
+        if deferred[action]:
+            logging.info('Rollout: {} of {} pending {} change(s) applied now, {} deferred'.format(
+                allowed, len(targets), action, deferred[action]))
+    return replace(sync_result, pending_changes=ChangeSet(invite_emails=set(admitted[ACTION_INVITE]),
+                                                          enable_user_ids=set(admitted[ACTION_ENABLE]),
+                                                          disable_user_ids=set(admitted[ACTION_DISABLE]))), deferred
+
+
+def refund(ls: LocalStore, policy: RolloutPolicy, failed: Dict[str, int]):
+    """
+    Gives the tokens of admitted changes whose API call failed back to the token buckets, the changes stay pending and
+    are retried in the next cycles without being counted twice against ROLLOUT_MAX_PER_HOUR
+
+    :param failed: Number of failed calls per action
+    """
+    if not policy.max_per_hour:
+        return
+    for action, count in failed.items():
+        stored = ls.get_rollout_bucket(action)
+        if count and stored is not None:
+            bucket = TokenBucket(policy.max_per_hour, *stored)
+            bucket.give_back(count)
+            ls.set_rollout_bucket(action, bucket.tokens, bucket.updated)
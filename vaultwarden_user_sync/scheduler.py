@@ -0,0 +1,232 @@
+"""
+Decides when the next sync cycle runs: Shorter intervals after cycles with changes, longer ones while nothing changes,
+exponential backoff on errors, jitter, immediate cycles on demand (SIGHUP, trigger file, Unix socket) and graceful
+shutdown (SIGTERM/SIGINT end the loop after the running cycle).
+"""
+import logging
+import math
+import os
+import random
+import signal
+import socket
+import threading
+import time
+from typing import Optional
+
+OUTCOME_CHANGED = 'changed'
+OUTCOME_UNCHANGED = 'unchanged'
+OUTCOME_ERROR = 'error'
+# Seconds between checks of the trigger file and the shutdown/trigger flags set by signal handlers
+POLL_INTERVAL = 1.0
+# Seconds allowed for a cycle itself on top of the expected delay before it is considered overdue
+HEALTH_MARGIN = 300.0
+
+
+class SyncScheduler:
+
+    def __init__(self, interval: float, min_interval: Optional[float] = None, max_interval: Optional[float] = None,
+                 error_max_interval: Optional[float] = None, jitter: float = 0.1, trigger_file: Optional[str] = None,
+                 trigger_socket: Optional[str] = None, health_max_age: Optional[float] = None):
+        """
+        :param interval: Starting interval in seconds
+        :param min_interval: Lower bound after cycles with changes, also the first delay after an error
+        :param max_interval: Upper bound while nothing changes
+        :param error_max_interval: Upper bound of the error backoff
+        :param jitter: Each delay is randomly stretched or shrunk by up to this share
+        :param trigger_file: Creating (touching) this file runs a cycle immediately, the file is removed
+        :param trigger_socket: Path of a Unix socket, each connection runs a cycle immediately
+        :param health_max_age: Fixed value of health_max_age, None derives it from the intervals
+        """
+        self.max_interval = max_interval if max_interval is not None else interval
+        self.min_interval = min(min_interval if min_interval is not None else max(1.0, interval / 10),
+                                self.max_interval)
+        self.error_max_interval = error_max_interval if error_max_interval is not None else 4 * self.max_interval
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        self.jitter = jitter
+        self.trigger_file = trigger_file
+        self.trigger_socket = trigger_socket
+        self.fixed_health_max_age = health_max_age
+        self.consecutive_errors = 0
+        # Plain flags, signal handlers must not take locks
+        self.stopping = False
+        self.triggered = False
+        # Set by the signal handler, logged by wait()
+        self.received_signal: Optional[int] = None
+        self.woken = False
+        # Triggers consumed by wait() so far
+        self.triggers = 0
+        self._wake = threading.Event()
+        self._socket: Optional[socket.socket] = None
+
+    @staticmethod
+    def from_env(interval: float) -> "SyncScheduler":
+        def optional_float(name: str) -> Optional[float]:
+            value = os.getenv(name)
+            return float(value) if value else None
+
+        return SyncScheduler(interval,
+                             min_interval=optional_float('SYNC_MIN_INTERVAL_SECONDS'),
+                             max_interval=optional_float('SYNC_MAX_INTERVAL_SECONDS'),
+                             error_max_interval=optional_float('SYNC_ERROR_MAX_INTERVAL_SECONDS'),
+                             jitter=float(os.getenv('SYNC_JITTER', '0.1')),
+                             trigger_file=os.getenv('SYNC_TRIGGER_FILE') or None,
+                             trigger_socket=os.getenv('SYNC_TRIGGER_SOCKET') or None,
+                             health_max_age=optional_float('HEALTH_MAX_AGE_SECONDS'))
+
+    def next_delay(self, outcome: str) -> float:
+        """
+        :param outcome: One of OUTCOME_CHANGED, OUTCOME_UNCHANGED or OUTCOME_ERROR
+        :return: Seconds until the next cycle
+        """
+        if outcome == OUTCOME_ERROR:
+            self.consecutive_errors += 1
+            delay = self._backoff_delay()
+        else:
+            self.consecutive_errors = 0
+            if outcome == OUTCOME_CHANGED:
+                # More changes are likely to follow (e.g. a batch of new hires), look again soon
+                self.interval = max(self.min_interval, self.interval / 2)
+            else:
+                self.interval = min(self.max_interval, self.interval * 1.5)
+            delay = self.interval
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _backoff_delay(self) -> float:
+        return min(self.error_max_interval, self.min_interval * 2 ** (self.consecutive_errors - 1))
+
+    @property
+    def health_max_age(self) -> float:
+        """
+        Longest gap between two successful cycles to expect: The maximum interval stretched by the jitter plus
+        HEALTH_MARGIN for the cycle itself. While the error backoff is active the delay it picked last is added, so a
+        single failed cycle does not fail the health check, but failures going on while the backoff grows do.
+        """
+        if self.fixed_health_max_age is not None:
+            return self.fixed_health_max_age
+        backoff = self._backoff_delay() if self.consecutive_errors else 0.0
+        return (self.max_interval + backoff) * (1 + self.jitter) + HEALTH_MARGIN
+
+    def trigger(self):
+        """
+        Ends the current wait, the next cycle runs immediately
+        """
+        self.triggered = True
+        self._wake.set()
+
+    def wake(self):
+        """
+        Ends the current wait without triggering a cycle (e.g. because one of several concurrent cycles completed)
+        """
+        self.woken = True
+        self._wake.set()
+
+    def shutdown(self):
+        self.stopping = True
+        self._wake.set()
+
+    def _check_trigger_file(self):
+        if self.trigger_file and os.path.exists(self.trigger_file):
+            try:
+                os.unlink(self.trigger_file)
+            except FileNotFoundError:
+                pass
+            logging.info(f'Trigger file {self.trigger_file} found, running a cycle now')
+            self.triggered = True
+
+    def wait(self, delay: float) -> bool:
+        """
+        Waits up to delay seconds, less if a cycle is triggered, wake() is called or a shutdown is requested
+
+        :return: False if the loop should end
+        """
+        deadline = time.monotonic() + delay
+        while not self.stopping:
+            self._log_received_signal()
+            self._check_trigger_file()
+            if self.triggered:
+                self._wake.clear()
+                self.triggered = False
+                self.triggers += 1
+                return True
+            if self.woken:
+                self._wake.clear()
+                self.woken = False
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            self._wake.wait(min(POLL_INTERVAL, remaining))
+        self._log_received_signal()
+        return False
+
+    def _log_received_signal(self):
+        signum, self.received_signal = self.received_signal, None
+        if signum == signal.SIGHUP:
+            logging.info('SIGHUP received, running a cycle now')
+        elif signum is not None:
+            logging.warning(f'{signal.Signals(signum).name} received, shutting down after the current cycle')
+
+    def _handle_signal(self, signum, frame):
+        # Plain assignments only: Logging or setting the wake event takes locks, which the interrupted code may hold.
+        # wait() notices the flags within POLL_INTERVAL and logs the signal
+        self.received_signal = signum
+        if signum == signal.SIGHUP:
+            self.triggered = True
+        else:
+            self.stopping = True
+
+    def install_signal_handlers(self):
+        """
+        SIGHUP triggers a cycle, SIGTERM and SIGINT end the loop once the running cycle completed
+        """
+        for signum in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]:
+            signal.signal(signum, self._handle_signal)
+
+    def _serve_socket(self, server: socket.socket):
+        while not self.stopping:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                break
+            with conn:
+                logging.info(f'Trigger socket {self.trigger_socket} connected, running a cycle now')
+                self.trigger()
+                try:
+                    conn.sendall(b'ok\n')
+                except OSError:
+                    pass
+
+    def start(self) -> "SyncScheduler":
+        """
+        Starts listening on the trigger socket (if configured)
+        """
+        if self.trigger_socket:
+            if os.path.exists(self.trigger_socket):
+                os.unlink(self.trigger_socket)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.bind(self.trigger_socket)
+            self._socket.listen()
+            threading.Thread(target=self._serve_socket, args=(self._socket,), name='trigger-socket',
+                             daemon=True).start()
+        return self
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                # Wakes up the accept() of the socket thread
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
+            self._socket = None
+            if os.path.exists(self.trigger_socket):
+                os.unlink(self.trigger_socket)
+
+
+def touch_heartbeat(heartbeat_file: str, max_age: float):
+    """
+    Marks a successful cycle for .docker/check_health.sh: The mtime is the time of the cycle, the content the number of
+    seconds after which the daemon is considered unhealthy without another one
+    """
+    with open(heartbeat_file, 'w') as f:
+        f.write('{}\n'.format(math.ceil(max_age)))
@@ -0,0 +1,226 @@
+"""
+Bounded memory variant of SyncResult.from_inputs(): The email source and the Vaultwarden users are spilled to a
+temporary SQLite database while they are fetched, then all inputs are read back sorted and merged in two passes
+(by user ID and by email key). Only the users ending up in a SyncResult category are kept in memory.
+
+Two passes because the categories are decided on two different keys: Vanished, disabled, enabled and renamed users
+compare a managed user with the Vaultwarden user of the same ID, invites, disables and adoption candidates compare the
+source, Vaultwarden and managed users with the same email key. A managed user and the Vaultwarden user sharing its ID
+usually do not share an email key after a rename, so no single sort order brings together all rows to compare. The
+first pass reads the Vaultwarden users sorted by ID, the second one reads them again sorted by email key together with
+the source. The managed users are read in index order from the LocalStore.
+
+The spill tables have no indexes (building one is a sort as well). SQLite sorts each ORDER BY with an external merge
+sort: Sorted runs of at most about the page cache size (SPILL_CACHE_KIB) are written to temporary files (temp_store =
+FILE) and merged, so the memory used by a sort does not grow with the number of users, the disk space does.
+"""
+import os
+import sqlite3
+import tempfile
+from itertools import groupby
+from typing import Iterable, Iterator, Optional, List, Tuple, Callable, Any
+
+from vaultwarden_user_sync.backends.localstore import LocalStore, ManagedUser
+from vaultwarden_user_sync.backends.vaultwarden import VaultwardenUser
+from vaultwarden_user_sync.compare import (SyncResult, ID_MA, ID_MA_ENABLED, ID_MA_DISABLED, ID_VW, ID_VW_ENABLED,
+                                           ID_VW_DISABLED, EMAIL_SRC, EMAIL_VW, EMAIL_VW_DISABLED, EMAIL_MA_INV,
+                                           EMAIL_MA_INV_ENABLED, EMAIL_MA_INV_DISABLED, EMAIL_MA_VW)
+from vaultwarden_user_sync.email_key import EmailKeyRules, DEFAULT_EMAIL_KEY
+from vaultwarden_user_sync.fingerprint import MultisetHash, vw_user_key
+
+# Rows per executemany() while spilling
+SPILL_CHUNK_SIZE = 5000
+# Page cache of the spill database, also bounds the in-memory runs of its sorts
+SPILL_CACHE_KIB = 2048
+
+
+def _chunks(items: Iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def merge_groups(*streams: Tuple[Iterable, Callable[[Any], str]]) -> Iterator[Tuple[str, List[list]]]:
+    """
+    Merges streams sorted by key
+
+    :param streams: (iterable, key function) pairs, each iterable sorted by its key
+    :return: Iterator over (key, [items of stream 1 with this key, items of stream 2 with this key, ...]) in key order
+    """
+    grouped = [groupby(items, key) for items, key in streams]
+
+    def advance(i: int) -> Optional[Tuple[str, list]]:
+        head = next(grouped[i], None)
+        return None if head is None else (head[0], list(head[1]))
+
+    heads = [advance(i) for i in range(len(grouped))]
+    while True:
+        keys = [head[0] for head in heads if head is not None]
+        if not keys:
+            return
+        key = min(keys)
+        groups = []
+        for i, head in enumerate(heads):
+            if head is not None and head[0] == key:
+                groups.append(head[1])
+                heads[i] = advance(i)
+            else:
+                groups.append([])
+        yield key, groups
+
+
+def diff_sorted(ma_by_id: Iterable[ManagedUser], vw_by_id: Iterable[VaultwardenUser],
+                source_emails: Iterable[Tuple[str, str, int]], vw_by_email: Iterable[Tuple[str, VaultwardenUser]],
+                ma_by_invite_key: Iterable[ManagedUser], ma_by_vw_key: Iterable[ManagedUser],
+                email_key: EmailKeyRules = DEFAULT_EMAIL_KEY) -> SyncResult:
+    """
+    Same result as SyncResult.from_inputs(), computed from sorted streams. If a key shows up more than once in a
+    stream, the last item wins (like the dictionaries of UserIndex).
+
+    :param ma_by_id: Managed users sorted by vw_user_id
+    :param vw_by_id: Vaultwarden users sorted by user_id
+    :param source_emails: (key, first source address with this key, its position in the source), sorted by key
+    :param vw_by_email: (email key, Vaultwarden user), sorted by key
+    :param ma_by_invite_key: Managed users sorted by invite_key
+    :param ma_by_vw_key: Managed users sorted by vw_key
+    :param email_key: Rules the keys were computed with
+    """
+    sync_result = SyncResult(_email_key=email_key)
+
+    for user_id, (ma_users, vw_users) in merge_groups((ma_by_id, lambda u: u.vw_user_id),
+                                                      (vw_by_id, lambda u: u.user_id)):
+        flags = 0
+        for ma_user in ma_users:
+            flags |= ID_MA | (ID_MA_ENABLED if ma_user.enabled else ID_MA_DISABLED)
+        for vw_user in vw_users:
+            flags |= ID_VW | (ID_VW_ENABLED if vw_user.enabled else ID_VW_DISABLED)
+        ma_user = ma_users[-1] if ma_users else None
+        vw_user = vw_users[-1] if vw_users else None
+        if sync_result.add_user_id(user_id, flags, ma_user, vw_user):
+            if ma_user is not None:
+                sync_result._ma_users_by_id[user_id] = ma_user
+            if vw_user is not None:
+                sync_result._vw_users_by_id[user_id] = vw_user
+
+    for key, (sources, vw_users, ma_users, ma_vw_users) in merge_groups(
+            (source_emails, lambda s: s[0]), (vw_by_email, lambda v: v[0]),
+            (ma_by_invite_key, lambda u: u.invite_key), (ma_by_vw_key, lambda u: u.vw_key)):
+        flags = EMAIL_SRC if sources else 0
+        vw_users = [vw_user for _, vw_user in vw_users]
+        for vw_user in vw_users:
+            flags |= EMAIL_VW | (0 if vw_user.enabled else EMAIL_VW_DISABLED)
+        for ma_user in ma_users:
+            flags |= EMAIL_MA_INV | (EMAIL_MA_INV_ENABLED if ma_user.enabled else EMAIL_MA_INV_DISABLED)
+        if ma_vw_users:
+            flags |= EMAIL_MA_VW
+        ma_user = ma_users[-1] if ma_users else None
+        _, source_email, source_position = sources[0] if sources else (None, None, None)
+        if sync_result.add_email(key, flags, vw_users[-1] if vw_users else None,
+                                 ma_user.vw_user_id if ma_user else None, source_email if source_email != key else None,
+                                 source_position) and ma_user is not None:
+            sync_result._ma_users_by_id.setdefault(ma_user.vw_user_id, ma_user)
+
+    sync_result.email_vanished_in_src = set(sync_result.email_vanished_in_both)
+    return sync_result
+
+
+class DiffSpill:
+    """
+    Temporary SQLite database holding the email source and Vaultwarden users of one cycle, deleted on close
+    """
+
+    def __init__(self, directory: Optional[str] = None, email_key: EmailKeyRules = DEFAULT_EMAIL_KEY):
+        """
+        :param directory: Where to create the database, defaults to the system temp directory
+        :param email_key: Rules computing the email keys, must match the ones of the LocalStore
+        """
+        self.email_key = email_key
+        fd, self.path = tempfile.mkstemp(prefix='vus_diff_', suffix='.sqlite', dir=directory)
+        os.close(fd)
+        self.con = sqlite3.connect(self.path)
+        # Throwaway data: No journal, no fsync, sort with temp files instead of memory
+        self.con.execute('PRAGMA journal_mode = OFF')
+        self.con.execute('PRAGMA synchronous = OFF')
+        self.con.execute('PRAGMA temp_store = FILE')
+        self.con.execute('PRAGMA cache_size = -{}'.format(SPILL_CACHE_KIB))
+        self.con.execute('CREATE TABLE Source (key TEXT NOT NULL, email TEXT NOT NULL)')
+        self.con.execute('CREATE TABLE VaultwardenUsers (user_id TEXT NOT NULL, email TEXT NOT NULL, '
+                         'email_key TEXT NOT NULL, enabled INTEGER NOT NULL)')
+
+    def add_source_emails(self, emails: Iterable[str]) -> str:
+        """
+        :return: Fingerprint (multiset hash) of the addresses
+        """
+        digest = MultisetHash()
+
+        def rows():
+            for email in emails:
+                digest.update(email)
+                yield self.email_key.key(email), email
+
+        for chunk in _chunks(rows(), SPILL_CHUNK_SIZE):
+            self.con.executemany('INSERT INTO Source (key, email) VALUES (?, ?)', chunk)
+        self.con.commit()
+        return digest.hexdigest()
+
+    def add_vw_users(self, vw_users: Iterable[VaultwardenUser]) -> str:
+        """
+        :return: Fingerprint (multiset hash) of the users
+        """
+        digest = MultisetHash()
+
+        def rows():
+            for vw_user in vw_users:
+                digest.update(vw_user_key(vw_user))
+                yield vw_user.user_id, vw_user.email, self.email_key.key(vw_user.email), int(vw_user.enabled)
+
+        for chunk in _chunks(rows(), SPILL_CHUNK_SIZE):
+            self.con.executemany('INSERT INTO VaultwardenUsers (user_id, email, email_key, enabled) '
+                                 'VALUES (?, ?, ?, ?)', chunk)
+        self.con.commit()
+        return digest.hexdigest()
+
+    def iter_source_emails(self) -> Iterator[Tuple[str, str, int]]:
+        """
+        :return: (key, first address with this key, its position in the source) sorted by key
+        """
+        # SQLite returns the other columns of the row holding min() for bare columns of an aggregate. Rows are only
+        # ever appended to the fresh table, so rowid - 1 is the position in the source
+        for key, email, rowid in self.con.cursor().execute(
+                'SELECT key, email, min(rowid) FROM Source GROUP BY key ORDER BY key'):
+            yield key, email, rowid - 1
+
+    def iter_vw_users(self, order_by: str) -> Iterator[Tuple[str, VaultwardenUser]]:
+        """
+        :param order_by: user_id or email_key (ties in insertion order)
+        :return: (email key, user) sorted as requested
+        """
+        if order_by not in ['user_id', 'email_key']:
+            raise ValueError('Invalid order_by: {}'.format(order_by))
+        res = self.con.cursor().execute(
+            'SELECT user_id, email, email_key, enabled FROM VaultwardenUsers ORDER BY {}, rowid'.format(order_by))
+        for user_id, email, email_key, enabled in res:
+            yield email_key, VaultwardenUser(user_id=user_id, email=email, enabled=bool(enabled))
+
+    def diff(self, ls: LocalStore) -> SyncResult:
+        """
+        Compares the spilled inputs with the managed users of the LocalStore
+        """
+        return diff_sorted(ls.iter_managed_users('vw_user_id'), (u for _, u in self.iter_vw_users('user_id')),
+                           self.iter_source_emails(), self.iter_vw_users('email_key'),
+                           ls.iter_managed_users('invite_key'), ls.iter_managed_users('vw_key'), self.email_key)
+
+    def close(self):
+        self.con.close()
+        os.unlink(self.path)
+
+    def __enter__(self) -> "DiffSpill":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
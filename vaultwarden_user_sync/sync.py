@@ -1,17 +1,30 @@
 import argparse
+import asyncio
 import os
-import time
 import traceback
+from typing import Dict
 
 from dotenv import load_dotenv
 
 from vaultwarden_user_sync.backends.vaultwarden import VaultwardenConnector
 from vaultwarden_user_sync.backends.localstore import LocalStore
+from vaultwarden_user_sync.email_key import EmailKeyRules
 import logging
 from logging.handlers import RotatingFileHandler
 
-from vaultwarden_user_sync.compare import SyncResult
-from vaultwarden_user_sync.email_sources.ldap import LdapConnector
+from vaultwarden_user_sync.cycle import CycleOptions, run_cycle, run_cycle_async, compute_plan, apply_saved_plan
+from vaultwarden_user_sync.plan import ChangePlan
+from vaultwarden_user_sync.executor import ChangeExecutor
+from vaultwarden_user_sync.metrics import SyncMetrics, MetricsServer, TenantMetrics
+from vaultwarden_user_sync.profiling import CycleProfiler
+from vaultwarden_user_sync.scheduler import SyncScheduler, OUTCOME_CHANGED, OUTCOME_UNCHANGED, OUTCOME_ERROR, \
+    touch_heartbeat
+from vaultwarden_user_sync.email_sources import EmailSource
+from vaultwarden_user_sync.email_sources.ldap import LdapConnector, IncrementalLdapConnector
+from vaultwarden_user_sync.email_sources.merged import MergedEmailSource
+from vaultwarden_user_sync.email_sources.shared import SearchCache, SharedSearchSource
+from vaultwarden_user_sync.email_sources.cached import CachedEmailSource
+from vaultwarden_user_sync.tenants import load_tenant_config, Tenant, TenantRunner
 
 load_dotenv()
 
@@ -35,7 +48,7 @@ def setup_cli_args():
                         help='Interval between sync attempts in seconds (SYNC_INTERVAL_SECONDS)',
                         default=10)
     parser.add_argument('--override_safe_guard', type=int,
-                        help='Override invite/disable safeguard number (MAX_USERS_AT_ONCE)',
+                        help='Override invite/disable safeguard number, with ROLLOUT_MODE=throttled the changes per category and cycle (MAX_USERS_AT_ONCE)',
                         default=20)
     parser.add_argument('--heartbeat_file', type=str,
                         help='If the main loop processed without any Exception, touch this status file',
@@ -46,11 +59,143 @@ def setup_cli_args():
     parser.add_argument('--adopt',
                         help='Adopt users who are present both in the email source and Vaultwarden. Exits after completion. (VUS_ADOPT)',
                         action="store_true", default=False)
+    parser.add_argument('--plan', type=str, metavar='FILE',
+                        help='Compute the changes of one cycle and write them to FILE (- for stdout) without applying anything. Exits after completion.',
+                        default=None)
+    parser.add_argument('--apply', type=str, metavar='FILE',
+                        help='Apply a plan written by --plan, resuming where an interrupted run stopped. Exits after completion.',
+                        default=None)
+    parser.add_argument('--refresh_source', action='store_true',
+                        help='Fetch the email source on the first cycle even if its snapshot is still valid (EMAIL_SOURCE_REFRESH)',
+                        default=False)
+    parser.add_argument('--tenants', type=str, metavar='FILE',
+                        help='Sync all Vaultwarden instances listed in FILE from this process (TENANTS_CONFIG)',
+                        default=None)
+    parser.add_argument('--engine', type=str, choices=['sync', 'async'],
+                        help='async fetches the email source, Vaultwarden and the local state concurrently (SYNC_ENGINE)',
+                        default='sync')
+    parser.add_argument('--profile', type=int,
+                        help='Write cProfile stats of the next N cycles to --profile_dir (PROFILE_CYCLES)', default=0)
+    parser.add_argument('--trace-memory', type=int, dest='trace_memory',
+                        help='Write tracemalloc snapshots of the next N cycles to --profile_dir (TRACE_MEMORY_CYCLES)',
+                        default=0)
+    parser.add_argument('--profile_sample_interval', type=float,
+                        help='Sample the stacks of all threads every N seconds during cycles, low overhead, 0 disables '
+                             '(PROFILE_SAMPLE_INTERVAL)',
+                        default=0.0)
+    parser.add_argument('--profile_dir', type=str,
+                        help='Output directory of the profiling data (PROFILE_DIR)', default='/tmp/ldap_sync_profile')
     return parser.parse_args()
 
 
-def setup_logging(logfile: str, loglevel: str):
-    logging.basicConfig(format='%(asctime)s %(levelname)-3s [%(filename)s] %(message)s',
+def setup_snapshot(ems: EmailSource, force_refresh: bool) -> EmailSource:
+    """
+    Serves the email source from EMAIL_SOURCE_SNAPSHOT_FILE while it is younger than EMAIL_SOURCE_SNAPSHOT_TTL_SECONDS
+    (see CachedEmailSource)
+    """
+    snapshot_file = os.getenv('EMAIL_SOURCE_SNAPSHOT_FILE')
+    if not snapshot_file:
+        return ems
+    if not ems.thread_safe:
+        logging.warning('Incremental email sources keep their own state in SQLITE_DB, EMAIL_SOURCE_SNAPSHOT_FILE is '
+                        'not used')
+        return ems
+    return CachedEmailSource(ems, snapshot_file, ttl=float(os.getenv('EMAIL_SOURCE_SNAPSHOT_TTL_SECONDS', '3600')),
+                             force_refresh=force_refresh or os.getenv('EMAIL_SOURCE_REFRESH', '0') == '1')
+
+
+def setup_email_source(ls: LocalStore, force_refresh: bool = False) -> EmailSource:
+    """
+    One LdapConnector per name in EMAIL_SOURCES (default: LDAP), configured through the <name>_* variables with
+    fallback to the LDAP_* ones. Several sources are fetched concurrently and merged.
+    """
+    sources = []
+    timeouts = {}
+    for name in [name.strip() for name in os.getenv('EMAIL_SOURCES', 'LDAP').split(',') if name.strip()]:
+        env_prefix = f'{name}_'
+        if os.getenv(f'{env_prefix}INCREMENTAL', os.getenv('LDAP_INCREMENTAL', '0')) == '1':
+            sources.append(IncrementalLdapConnector(source_name=name, local_store=ls, env_prefix=env_prefix))
+        else:
+            sources.append(LdapConnector(source_name=name, env_prefix=env_prefix))
+        timeouts[name] = float(os.getenv(f'{env_prefix}TIMEOUT_SECONDS', os.getenv('LDAP_TIMEOUT_SECONDS', '300')))
+    if len(sources) == 1:
+        return setup_snapshot(sources[0], force_refresh)
+    return setup_snapshot(MergedEmailSource('merged', sources, timeouts), force_refresh)
+
+
+def setup_tenant_email_source(connectors: Dict[tuple, LdapConnector], cache: SearchCache,
+                              force_refresh: bool = False) -> EmailSource:
+    """
+    Multi-tenant variant of setup_email_source(), called with the tenant settings in the environment. Tenants with the
+    same server and bind settings share one LdapConnector (connectors) and search results (cache). Incremental sources
+    keep their position in the LocalStore of a single tenant, so tenants always run full searches.
+    """
+    sources = []
+    timeouts = {}
+    for name in [name.strip() for name in os.getenv('EMAIL_SOURCES', 'LDAP').split(',') if name.strip()]:
+        env_prefix = f'{name}_'
+        if os.getenv(f'{env_prefix}INCREMENTAL', os.getenv('LDAP_INCREMENTAL', '0')) == '1':
+            logging.warning(f'{env_prefix}INCREMENTAL is not supported with multiple tenants, running full searches')
+        connector = LdapConnector(source_name=name, env_prefix=env_prefix)
+        shared = connectors.get(connector.connection_key())
+        if shared is None:
+            connector.source_name = f'ldap-{len(connectors) + 1}'
+            logging.info(f"LDAP connection {connector.source_name}: {', '.join(connector.ldap_servers)} "
+                         f"as {connector.ldap_bind_dn}")
+            shared = connectors[connector.connection_key()] = connector
+        sources.append(SharedSearchSource(name, shared, connector.query, cache))
+        timeouts[name] = float(os.getenv(f'{env_prefix}TIMEOUT_SECONDS', os.getenv('LDAP_TIMEOUT_SECONDS', '300')))
+    if len(sources) == 1:
+        return setup_snapshot(sources[0], force_refresh)
+    return setup_snapshot(MergedEmailSource('merged', sources, timeouts), force_refresh)
+
+
+def run_tenants(config_file: str, args):
+    """
+    Multi-tenant main loop (see tenants.py), returns on shutdown
+    """
+    if args.reset or args.adopt or args.plan or args.apply:
+        raise ValueError('--reset, --adopt, --plan and --apply work on a single tenant, run them without --tenants')
+    connectors: Dict[tuple, LdapConnector] = {}
+    cache = SearchCache(ttl=float(os.getenv('TENANT_LDAP_CACHE_SECONDS', '30')))
+    is_dry_run = os.getenv('DRYRUN', "0") == '1' or args.dryrun
+    tenants = [Tenant.from_config(config, lambda: setup_tenant_email_source(connectors, cache, args.refresh_source),
+                                  interval=float(os.getenv('SYNC_INTERVAL_SECONDS', args.interval)),
+                                  dry_run=is_dry_run,
+                                  safe_guard=int(os.getenv('MAX_USERS_AT_ONCE', args.override_safe_guard)),
+                                  engine=os.getenv('SYNC_ENGINE', args.engine))
+               for config in load_tenant_config(config_file)]
+    logging.info(f'Starting {len(tenants)} tenants from {config_file}...')
+    for tenant in tenants:
+        logging.info(f'Tenant {tenant.name}: {tenant.vwc.vaultwarden_url} (DRYRUN: {tenant.options.dry_run}, '
+                     f'engine: {tenant.engine})')
+
+    scheduler = SyncScheduler.from_env(args.interval)
+    scheduler.install_signal_handlers()
+    scheduler.start()
+    metrics = TenantMetrics({tenant.name: tenant.metrics for tenant in tenants},
+                            server_stats=lambda: {source_name: stats for connector in list(connectors.values())
+                                                  for source_name, stats in connector.get_server_stats().items()},
+                            cache_stats=cache.get_stats)
+    if os.getenv('METRICS_PORT'):
+        metrics_server = MetricsServer(metrics, host=os.getenv('METRICS_BIND', '0.0.0.0'),
+                                       port=int(os.getenv('METRICS_PORT'))).start()
+        logging.info(f'Serving /metrics, /healthz and /readyz on port {metrics_server.port}')
+
+    runner = TenantRunner(tenants, scheduler, workers=int(os.getenv('TENANT_WORKERS', '4')),
+                          heartbeat_file=args.heartbeat_file)
+    runner.run(once=args.runonce)
+    scheduler.close()
+    runner.close()
+    for connector in connectors.values():
+        connector.close()
+    logging.info('Shut down')
+
+
+def setup_logging(logfile: str, loglevel: str, thread_names: bool = False):
+    # With multiple tenants, the thread name tells which tenant a message is about (see Tenant.run_cycle)
+    logging.basicConfig(format='%(asctime)s %(levelname)-3s ' + ('[%(threadName)s] ' if thread_names else '') +
+                               '[%(filename)s] %(message)s',
                         datefmt='%Y-%m-%d:%H:%M:%S',
                         handlers=[
                             RotatingFileHandler(logfile, maxBytes=5 * 1024 * 1024, backupCount=5),
@@ -63,18 +208,30 @@ if __name__ == '__main__':
     args = setup_cli_args()
     log_level = os.getenv('LOGLEVEL', args.loglevel)
     log_file = os.getenv('LOGFILE', args.logfile)
-    setup_logging(log_file, log_level)
-    ls = LocalStore(os.getenv('SQLITE_DB'))
+    tenants_config = os.getenv('TENANTS_CONFIG', args.tenants)
+    setup_logging(log_file, log_level, thread_names=bool(tenants_config))
+    if tenants_config:
+        try:
+            run_tenants(tenants_config, args)
+        except ValueError as e:
+            logging.error(f'Invalid tenant configuration: {e}')
+            exit(1)
+        exit(0)
+    ls = LocalStore(os.getenv('SQLITE_DB'), email_key=EmailKeyRules.from_spec(os.getenv('EMAIL_KEY_RULES')))
     vwc = VaultwardenConnector()
-    ems = LdapConnector(source_name="LDAP")
+    executor = ChangeExecutor(vwc, max_rps=float(os.getenv('VAULTWARDEN_MAX_RPS', '10')))
+    ems = setup_email_source(ls, force_refresh=args.refresh_source)
     safe_guard = int(os.getenv('MAX_USERS_AT_ONCE', args.override_safe_guard))
     is_dry_run = os.getenv('DRYRUN', "0") == '1' or args.dryrun
     is_reset = os.getenv('VUS_RESET', "0") == '1' or args.reset
     should_adopt = os.getenv('VUS_ADOPT', "0") == '1' or args.adopt
+    engine = os.getenv('SYNC_ENGINE', args.engine)
 
     logging.info('Starting...')
     logging.info(f'DRYRUN: {is_dry_run}')
-    logging.info(f"LDAP server: {os.getenv('LDAP_SERVER')}")
+    logging.info(f'Engine: {engine}')
+    for line in ems.describe():
+        logging.info(line)
     logging.info(f"Vaultwarden URL: {os.getenv('VAULTWARDEN_URL')}")
 
     log_prefix = ""
@@ -91,90 +248,85 @@ if __name__ == '__main__':
         args.runonce = True
         logging.warning(f"{log_prefix} Running in adaption mode. Will terminate after this attempt")
 
-    while True:
+    options = CycleOptions.from_env(dry_run=is_dry_run, safe_guard=safe_guard, adopt=should_adopt)
+    if options.rollout is not None:
+        logging.info(f'Rollout: {options.rollout.summary()}')
+    if options.streaming_diff and engine == 'async':
+        logging.warning('DIFF_MODE=streaming fetches the inputs one after another, SYNC_ENGINE=async has no effect')
+
+    if args.plan:
+        plan = compute_plan(ems, vwc, ls, options)
+        if args.plan == '-':
+            print(plan.to_json())
+        else:
+            plan.save(args.plan)
+            logging.info(f'Plan written to {args.plan}')
+        logging.info(plan.summary())
+        if plan.exceeds_safe_guard(safe_guard):
+            logging.warning(f"Plan exceeds the safe guard limit {safe_guard}, --apply will refuse it")
+        ems.close()
+        exit(0)
+
+    if args.apply:
         try:
-            # first sync state
-            ldap_emails = ems.get_email_list()
-            sync_result = SyncResult.factory(vwc, ls, ldap_emails)
+            apply_saved_plan(ChangePlan.load(args.apply), executor, vwc, ls, options)
+        except (ValueError, ConnectionError) as e:
+            logging.error(f'Could not apply {args.apply}: {e}')
+            exit(1)
+        exit(0)
 
-            logging.debug(sync_result.summary())
+    scheduler = SyncScheduler.from_env(args.interval)
+    scheduler.install_signal_handlers()
+    scheduler.start()
 
-            if should_adopt:
-                if len(sync_result.adoption_candidates) == 0:
-                    logging.info("Nothing to adopt")
+    metrics = SyncMetrics(max_age=scheduler.health_max_age, transport_stats=vwc.transport.get_stats,
+                          server_stats=ems.get_server_stats)
+    if os.getenv('METRICS_PORT'):
+        metrics_server = MetricsServer(metrics, host=os.getenv('METRICS_BIND', '0.0.0.0'),
+                                       port=int(os.getenv('METRICS_PORT'))).start()
+        logging.info(f'Serving /metrics, /healthz and /readyz on port {metrics_server.port}')
+
+    profiler = CycleProfiler(os.getenv('PROFILE_DIR', args.profile_dir),
+                             profile_cycles=int(os.getenv('PROFILE_CYCLES', args.profile)),
+                             trace_memory_cycles=int(os.getenv('TRACE_MEMORY_CYCLES', args.trace_memory)),
+                             sample_interval=float(os.getenv('PROFILE_SAMPLE_INTERVAL', args.profile_sample_interval)))
+    if profiler.enabled:
+        logging.info(f'Profiling data is written to {profiler.output_dir}')
+
+    while not scheduler.stopping:
+        try:
+            with profiler.cycle():
+                if engine == 'async':
+                    report = asyncio.run(run_cycle_async(ems, vwc, ls, executor, options))
                 else:
-                    for vw_user in sync_result.adoption_candidates:
-                        state = "ENABLED" if vw_user.enabled else "DISABLED"
-                        if not is_dry_run:
-                            ls.register_user(user_email=vw_user.email, user_id=vw_user.user_id, state=state)
-                        logging.info(f"{log_prefix} Adopted {vw_user.email}")
-
-            for user_email in sync_result.email_vanished_in_both:
-                if os.getenv('CLEANUP_VANISHED_USERS') == '1':
-                    if not is_dry_run:
-                        ls.delete_user_by_email(user_email)
-                    logging.info(
-                        f'{log_prefix} Cleanup vanished user: {user_email}')
-
-            for user_id in sync_result.user_ids_vanished_in_vw:
-                if not is_dry_run:
-                    ls.set_user_state(user_id, 'DELETED')
-                logging.info(
-                    f"{log_prefix} Set state to DELETED for: {sync_result.get_ma_user_by_id(user_id).invite_email}")
-
-            for user_id in sync_result.user_ids_disabled_in_vw:
-                if not is_dry_run:
-                    ls.set_user_state(user_id, 'DISABLED')
-                logging.info(
-                    f"{log_prefix} Set state to DISABLED for: {sync_result.get_ma_user_by_id(user_id).invite_email}")
-
-            for changed_user in sync_result.users_with_changed_email:
-                if not is_dry_run:
-                    ls.update_vw_email(changed_user.user_id, changed_user.new_email)
-                logging.info(f'{log_prefix}Changed email from {changed_user.old_email} to {changed_user.new_email}')
-
-            for user_id in sync_result.user_ids_enabled_in_vw:
-                if os.getenv('UNTIE_RE-ENABLED_USERS') == '1':
-                    if not is_dry_run:
-                        ls.delete_user_by_id(user_id)
-                    logging.warning(
-                        f"{log_prefix} User {sync_result.get_ma_user_by_id(user_id).invite_email} forcefully enabled by Admin. Permanently untie this user from automatic management")
-
-            if (len(sync_result.pending_changes.enable_user_ids) > safe_guard or
-                    len(sync_result.pending_changes.disable_user_ids) > safe_guard or
-                    len(sync_result.pending_changes.invite_emails) > safe_guard):
-                logging.warning(
-                    f"{log_prefix} Users to disable/invite/enable exceed the safe guard limit {safe_guard} if you are sure increase the MAX_USERS_AT_ONCE env var")
-            else:
-                for user_email in sync_result.pending_changes.invite_emails:
-                    if not is_dry_run:
-                        user_id = vwc.invite_user(user_email)
-                        ls.register_user(user_email, user_id)
-                    logging.info(f'{log_prefix} Invite user {user_email}')
-
-                for user_id in sync_result.pending_changes.disable_user_ids:
-                    if not is_dry_run:
-                        vwc.disable_user(user_id)
-                        ls.set_user_state(user_id, 'DISABLED')
-                    logging.info(
-                        f'{log_prefix} User {sync_result.get_ma_user_by_id(user_id).vw_email} DISABLED in Vaultwarden')
-
-                for user_id in sync_result.pending_changes.enable_user_ids:
-                    if not is_dry_run:
-                        vwc.enable_user(user_id)
-                        ls.set_user_state(user_id, 'ENABLED')
-                    logging.info(
-                        f'{log_prefix} User {sync_result.get_ma_user_by_id(user_id).vw_email} ENABLED in Vaultwarden')
+                    report = run_cycle(ems, vwc, ls, executor, options)
+            metrics.observe_cycle(report)
+            logging.debug(f'Cycle phases: {report.phase_durations}')
+            if report.phase_peak_memory:
+                logging.debug(f'Cycle phase peak memory: {report.phase_peak_memory}')
+            logging.debug(f'Vaultwarden transport: {vwc.transport.get_stats()}')
 
             if args.runonce:
                 logging.warning(
                     "Exiting as requested. Either --run_once is explicitly set or implicitly through --reset or --adopt")
+                # Lets a background refresh of the email source snapshot complete
+                ems.close()
                 exit(0)
-            # Touch heartbeat file
-            with open(args.heartbeat_file, 'a'):
-                os.utime(args.heartbeat_file, None)
-            time.sleep(args.interval)
+            outcome = OUTCOME_CHANGED if report.found_changes else OUTCOME_UNCHANGED
         except Exception as e:
+            metrics.observe_error(e)
             logging.error(f'Something went wrong. Error: {e}')
             logging.debug(traceback.format_exc())
-            time.sleep(args.interval)
+            outcome = OUTCOME_ERROR
+        delay = scheduler.next_delay(outcome)
+        # Loosened while the error backoff runs
+        metrics.max_age = scheduler.health_max_age
+        if metrics.last_cycle_succeeded:
+            touch_heartbeat(args.heartbeat_file, metrics.max_age)
+        logging.debug(f'Next cycle in {delay:.1f}s')
+        scheduler.wait(delay)
+
+    scheduler.close()
+    ems.close()
+    ls.con.close()
+    logging.info('Shut down')
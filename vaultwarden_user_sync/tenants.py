@@ -0,0 +1,252 @@
+"""
+Multi-tenant mode: One process keeps several Vaultwarden instances in sync (TENANTS_CONFIG). The tenants are listed in
+a JSON file, each with the variables it needs on top of (or instead of) the ones of the process:
+
+    {
+      "defaults": {"LDAP_SERVER": "dc1.example.com,dc2.example.com", "SYNC_INTERVAL_SECONDS": "300"},
+      "tenants": [
+        {"name": "team-a", "settings": {"VAULTWARDEN_URL": "https://a.example.com", "VAULTWARDEN_ADMIN_TOKEN": "...",
+                                        "LDAP_SEARCH_FILTER": "(memberOf=CN=team-a,...)",
+                                        "SQLITE_DB": "/data/a.sqlite"}}
+      ]
+    }
+
+Settings of a tenant take precedence over the defaults, which take precedence over the environment. Every variable of
+the single tenant mode can be used, except the ones concerning the process (logging, METRICS_PORT, triggers).
+
+Tenants run on a pool of TENANT_WORKERS threads, each on its own schedule (SYNC_INTERVAL_SECONDS and the SYNC_*
+interval settings). A failing tenant only backs off itself. Tenants searching the same directory share one
+LdapConnector, and identical searches within TENANT_LDAP_CACHE_SECONDS are run once (see SharedSearchSource).
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Dict, List, Callable, Optional
+
+from vaultwarden_user_sync.backends.localstore import LocalStore
+from vaultwarden_user_sync.backends.vaultwarden import VaultwardenConnector
+from vaultwarden_user_sync.cycle import CycleOptions, run_cycle, run_cycle_async
+from vaultwarden_user_sync.email_key import EmailKeyRules
+from vaultwarden_user_sync.email_sources import EmailSource
+from vaultwarden_user_sync.executor import ChangeExecutor
+from vaultwarden_user_sync.metrics import SyncMetrics
+from vaultwarden_user_sync.scheduler import SyncScheduler, OUTCOME_CHANGED, OUTCOME_UNCHANGED, OUTCOME_ERROR, \
+    touch_heartbeat
+
+TENANT_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+$')
+# Settings every tenant needs, the process environment is no sensible default for them
+REQUIRED_TENANT_SETTINGS = ['VAULTWARDEN_URL', 'SQLITE_DB']
+# Files written by each tenant, tenants must not share them
+UNIQUE_TENANT_SETTINGS = ['SQLITE_DB', 'VAULTWARDEN_COOKIE_FILE', 'EMAIL_SOURCE_SNAPSHOT_FILE']
+# Serializes tenant_environment(), the overlay is process wide
+_environment_lock = threading.Lock()
+
+
+@dataclass
+class TenantConfig:
+    name: str
+    # Variables of the tenant (merged with the defaults of the config file)
+    settings: Dict[str, str]
+
+
+def load_tenant_config(path: str) -> List[TenantConfig]:
+    """
+    :param path: JSON file as described in the module documentation
+    :return: The tenants in the order listed
+    """
+    with open(path) as f:
+        config = json.load(f)
+    defaults = {key: str(value) for key, value in config.get('defaults', {}).items()}
+    tenants = []
+    for entry in config.get('tenants', []):
+        name = entry.get('name', '')
+        if not TENANT_NAME_PATTERN.match(name):
+            raise ValueError('Invalid tenant name: {!r}. Allowed: letters, digits, _ . -'.format(name))
+        if name in {tenant.name for tenant in tenants}:
+            raise ValueError('Duplicate tenant name: {}'.format(name))
+        settings = dict(defaults, **{key: str(value) for key, value in entry.get('settings', {}).items()})
+        missing = [key for key in REQUIRED_TENANT_SETTINGS if not settings.get(key)]
+        if missing:
+            raise ValueError('Tenant {} is missing {}'.format(name, ', '.join(missing)))
+        tenants.append(TenantConfig(name, settings))
+    if not tenants:
+        raise ValueError('No tenants configured in {}'.format(path))
+    for key in UNIQUE_TENANT_SETTINGS:
+        values = [tenant.settings.get(key, os.getenv(key)) for tenant in tenants]
+        values = [value for value in values if value]
+        if len(set(values)) != len(values):
+            raise ValueError('Each tenant needs its own {}'.format(key))
+    return tenants
+
+
+@contextlib.contextmanager
+def tenant_environment(settings: Dict[str, str]):
+    """
+    Overlays the environment with the settings of a tenant, so the components reading their configuration from the
+    environment (VaultwardenConnector, LdapConnector, CycleOptions, ...) pick up the tenant's. Only meant for setting
+    up tenants, not while cycles are running.
+    """
+    with _environment_lock:
+        previous = {key: os.environ.get(key) for key in settings}
+        os.environ.update(settings)
+        try:
+            yield
+        finally:
+            for key, value in previous.items():
+                if value is None:
+                    del os.environ[key]
+                else:
+                    os.environ[key] = value
+
+
+class Tenant:
+    """
+    One Vaultwarden instance with its email source, local state, schedule and metrics
+    """
+
+    def __init__(self, name: str, vwc: VaultwardenConnector, ems: EmailSource, sqlite_file: str,
+                 options: CycleOptions, scheduler: SyncScheduler, metrics: SyncMetrics,
+                 email_key: Optional[EmailKeyRules] = None, executor: Optional[ChangeExecutor] = None,
+                 engine: str = 'sync'):
+        """
+        :param sqlite_file: LocalStore of the tenant, opened by the worker running the cycle
+        :param scheduler: Only used to compute the delay until the next cycle (see SyncScheduler.next_delay)
+        """
+        self.name = name
+        self.vwc = vwc
+        self.ems = ems
+        self.sqlite_file = sqlite_file
+        self.options = options
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.email_key = email_key or EmailKeyRules()
+        self.executor = executor or ChangeExecutor(vwc)
+        self.engine = engine
+        # Monotonic time of the next cycle
+        self.next_run = 0.0
+
+    @staticmethod
+    def from_config(config: TenantConfig, email_source_factory: Callable[[], EmailSource], interval: float,
+                    dry_run: bool = False, safe_guard: int = 20, engine: str = 'sync') -> "Tenant":
+        """
+        :param email_source_factory: Builds the email source from the (tenant) environment
+        :param interval: Default of SYNC_INTERVAL_SECONDS
+        """
+        with tenant_environment(config.settings):
+            vwc = VaultwardenConnector()
+            scheduler = SyncScheduler.from_env(float(os.getenv('SYNC_INTERVAL_SECONDS', interval)))
+            return Tenant(config.name, vwc, email_source_factory(), os.getenv('SQLITE_DB'),
+                          options=CycleOptions.from_env(dry_run=dry_run or os.getenv('DRYRUN', '0') == '1',
+                                                        safe_guard=int(os.getenv('MAX_USERS_AT_ONCE', safe_guard)),
+                                                        adopt=False),
+                          scheduler=scheduler,
+                          metrics=SyncMetrics(max_age=scheduler.health_max_age,
+                                              transport_stats=vwc.transport.get_stats),
+                          email_key=EmailKeyRules.from_spec(os.getenv('EMAIL_KEY_RULES')),
+                          executor=ChangeExecutor(vwc, max_rps=float(os.getenv('VAULTWARDEN_MAX_RPS', '10'))),
+                          engine=os.getenv('SYNC_ENGINE', engine))
+
+    def run_cycle(self) -> str:
+        """
+        Runs one cycle on the calling thread. Errors are logged and recorded in the metrics of this tenant only.
+
+        :return: Outcome for the scheduler
+        """
+        thread = threading.current_thread()
+        thread_name, thread.name = thread.name, 'tenant-{}'.format(self.name)
+        try:
+            # The sqlite connection is bound to the thread creating it, and cycles of a tenant may run on any worker
+            ls = LocalStore(self.sqlite_file, email_key=self.email_key)
+            try:
+                if self.engine == 'async':
+                    report = asyncio.run(run_cycle_async(self.ems, self.vwc, ls, self.executor, self.options))
+                else:
+                    report = run_cycle(self.ems, self.vwc, ls, self.executor, self.options)
+            finally:
+                ls.close()
+            self.metrics.observe_cycle(report)
+            logging.debug(f'Cycle phases: {report.phase_durations}')
+            return OUTCOME_CHANGED if report.found_changes else OUTCOME_UNCHANGED
+        except Exception as e:
+            self.metrics.observe_error(e)
+            logging.error(f'Something went wrong. Error: {e}')
+            logging.debug(traceback.format_exc())
+            return OUTCOME_ERROR
+        finally:
+            thread.name = thread_name
+
+
+class TenantRunner:
+    """
+    Runs the cycles of all tenants on a worker pool, each tenant when its own schedule says so. A tenant is never
+    run twice at the same time. Triggers of the process scheduler (SIGHUP, trigger file/socket) run all tenants now,
+    a shutdown lets the running cycles complete.
+    """
+
+    def __init__(self, tenants: List[Tenant], scheduler: SyncScheduler, workers: int = 4,
+                 heartbeat_file: Optional[str] = None):
+        """
+        :param scheduler: Process wide scheduler, provides signal handling and triggers
+        :param workers: Number of tenants synced at the same time
+        :param heartbeat_file: Touched after every successful cycle of any tenant
+        """
+        self.tenants = tenants
+        self.scheduler = scheduler
+        self.workers = max(1, min(workers, len(tenants)))
+        self.heartbeat_file = heartbeat_file
+        self.cycles: Dict[str, int] = {tenant.name: 0 for tenant in tenants}
+
+    def _completed(self, tenant: Tenant, outcome: str):
+        self.cycles[tenant.name] += 1
+        delay = tenant.scheduler.next_delay(outcome)
+        tenant.next_run = time.monotonic() + delay
+        # Loosened while the error backoff of the tenant runs
+        tenant.metrics.max_age = tenant.scheduler.health_max_age
+        logging.debug(f'Next cycle of tenant {tenant.name} in {delay:.1f}s')
+        if tenant.metrics.last_cycle_succeeded and self.heartbeat_file:
+            # Any tenant keeps the process healthy, so the longest gap of any tenant applies
+            touch_heartbeat(self.heartbeat_file, max(t.metrics.max_age for t in self.tenants))
+
+    def run(self, once: bool = False):
+        """
+        :param once: Run every tenant a single time and return
+        """
+        running: Dict[concurrent.futures.Future, Tenant] = {}
+        pending = list(self.tenants) if once else []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='tenant') as pool:
+            while True:
+                for future in [future for future in running if future.done()]:
+                    self._completed(running.pop(future), future.result())
+                if self.scheduler.stopping or (once and not pending and not running):
+                    break
+                now = time.monotonic()
+                busy = set(running.values())
+                for tenant in (pending if once else self.tenants):
+                    if tenant not in busy and tenant.next_run <= now:
+                        future = pool.submit(tenant.run_cycle)
+                        running[future] = tenant
+                        future.add_done_callback(lambda _: self.scheduler.wake())
+                if once:
+                    pending = [tenant for tenant in pending if tenant not in running.values()]
+                idle = [tenant.next_run for tenant in self.tenants if tenant not in running.values()]
+                delay = max(0.0, min(idle) - time.monotonic()) if idle and not once else 3600.0
+                triggers = self.scheduler.triggers
+                self.scheduler.wait(delay)
+                if self.scheduler.triggers != triggers:
+                    for tenant in self.tenants:
+                        tenant.next_run = 0.0
+            # Let the running cycles complete (the pool shutdown waits for them)
+            for future in concurrent.futures.as_completed(list(running)):
+                self._completed(running.pop(future), future.result())
+
+    def close(self):
+        for tenant in self.tenants:
+            tenant.ems.close()